@@ -1,3 +1,5 @@
+import argparse
+import json
 import sys
 import os
 from pathlib import Path
@@ -5,30 +7,44 @@ from pathlib import Path
 # Thêm src vào path
 sys.path.append(str(Path(__file__).parent / 'src'))
 
-from preprocessing import preprocess_image
-from feature_extraction import FeatureExtractor
+from feature_extraction import FeatureExtractor, list_images
 from image_matching import ImageMatcher
+from instrumentation import collect
+from perceptual_hash import HashIndex, hash_images, image_hash, prefilter_results
 from utils import display_search_results 
 
 # Cấu hình
 DATA_DIR = "data"           # Thư mục chứa ảnh gốc
 FEATURE_DIR = "features"    # Thư mục chứa CSV
 QUERY_IMG = "data/query.jpg" # Đường dẫn ảnh input 
+ALGO = 'SIFT'               # Thuật toán đặc trưng khi index: 'SIFT' / 'ORB' (nhị phân, nhanh hơn, kho nhỏ hơn)
+WORKERS = None              # Số tiến trình trích xuất (None = dùng tất cả CPU)
+VERIFY = None               # Kiểm chứng hình học top ứng viên: None / 'homography' / 'affine'
+MAX_SIDE = 1024             # Cạnh dài tối đa khi tiền xử lý (None = giữ nguyên độ phân giải)
+MAX_KEYPOINTS = 2000        # Số keypoint tối đa mỗi ảnh (None = không giới hạn)
+COARSE_KEYPOINTS = None     # Tập descriptor thô cho --mode coarse (vd. 64; None = không lưu)
+SKIP_DUPLICATES = False     # Không trích xuất ảnh gần trùng với ảnh đã có trong kho
+BATCH_SIZE = 256            # Số truy vấn mỗi lần search_many ở chế độ hàng loạt
 
-def main():
+def main(profile=False):
     print("=== HỆ THỐNG TÌM KIẾM ẢNH TƯƠNG TỰ (SIFT) ===")
     
     # BƯỚC 1: TRÍCH XUẤT ĐẶC TRƯNG 
-    extractor = FeatureExtractor(algo='SIFT')
+    extractor = FeatureExtractor(algo=ALGO, max_side=MAX_SIDE, max_keypoints=MAX_KEYPOINTS,
+                                 coarse_keypoints=COARSE_KEYPOINTS)
     
     # Kiểm tra xem có cần trích xuất lại không
     if not os.path.exists(FEATURE_DIR) or len(os.listdir(FEATURE_DIR)) == 0:
         print("Chưa có dữ liệu đặc trưng. Đang tạo mới...")
-        extractor.process_dataset(DATA_DIR, FEATURE_DIR)
+        extractor.process_dataset(DATA_DIR, FEATURE_DIR, workers=WORKERS,
+                                  skip_duplicates=SKIP_DUPLICATES)
     else:
-        choice = input("Bạn có muốn trích xuất lại dữ liệu không? (y/n): ")
-        if choice.lower() == 'y':
-            extractor.process_dataset(DATA_DIR, FEATURE_DIR)
+        # Cập nhật tăng dần: chỉ trích xuất ảnh mới/đã sửa, xoá đặc trưng của ảnh đã bị xoá
+        choice = input("Bạn có muốn cập nhật dữ liệu không? (y = tăng dần / f = build lại toàn bộ / n): ")
+        if choice.lower() in ('y', 'f'):
+            extractor.process_dataset(DATA_DIR, FEATURE_DIR, workers=WORKERS,
+                                      incremental=choice.lower() == 'y',
+                                      skip_duplicates=SKIP_DUPLICATES)
 
     # BƯỚC 2: TÌM KIẾM
     if not os.path.exists(QUERY_IMG):
@@ -37,21 +53,21 @@ def main():
 
     print(f"\nĐang xử lý ảnh query: {QUERY_IMG}")
     
-    # 2.1 Tiền xử lý ảnh query
-    query_processed = preprocess_image(QUERY_IMG)
-    
-    # 2.2 Trích xuất đặc trưng query
-    kps, query_desc = extractor.extract(query_processed)
-    print(f"Tìm thấy {len(kps)} keypoints trên ảnh query.")
-
-    if query_desc is None:
-        print("Không tìm thấy đặc trưng nào trên ảnh query (ảnh quá mờ hoặc trơn).")
+    # Đo thời gian từng giai đoạn (giải mã, CLAHE, SIFT, nạp CSDL, knnMatch...)
+    with collect(profile=profile) as stats:
+        # 2.0 Ảnh query gần trùng một ảnh trong kho (pHash) -> trả kết quả ngay, không cần SIFT
+        hits = HashIndex.load(FEATURE_DIR).query(image_hash(QUERY_IMG))
+        if hits:
+            print("Ảnh query gần trùng với ảnh đã có trong kho (pHash), bỏ qua so khớp SIFT.")
+            results, prefilter = prefilter_results(hits, 5)
+        else:
+            prefilter = None
+            results = _search_query()
+    if profile:
+        print("\n" + stats.report())
+    if results is None:
         return
 
-    # 2.3 So khớp
-    matcher = ImageMatcher(method='BF') # Dùng BF cho chính xác
-    results = matcher.search(query_desc, FEATURE_DIR, top_n=5)
-
     # BƯỚC 3: HIỂN THỊ
     if len(results) == 0:
         print("Không tìm thấy ảnh nào tương tự.")
@@ -59,8 +75,13 @@ def main():
         print("\nKẾT QUẢ TOP 5:")
         paths = []
         scores = []
-        for path, score in results:
-            print(f" - Ảnh: {path} | Điểm match: {score}")
+        for i, (path, score) in enumerate(results):
+            if prefilter is not None:
+                # Kết quả từ pHash: không có điểm match SIFT
+                score = f"gần trùng (pHash {prefilter['distances'][i]} bit khác)"
+                print(f" - Ảnh: {path} | {score}")
+            else:
+                print(f" - Ảnh: {path} | Điểm match: {score}")
             paths.append(path)
             scores.append(score)
         
@@ -69,5 +90,146 @@ def main():
         except Exception as e:
             print(f"Lỗi hiển thị: {e}")
 
+
+def _search_query():
+    """Trích xuất SIFT của QUERY_IMG rồi so khớp với CSDL; None nếu ảnh không có đặc trưng"""
+    # 2.1 Tiền xử lý ảnh query (cùng cấu hình với lúc index)
+    extractor = FeatureExtractor.from_index(FEATURE_DIR)
+    query_processed = extractor.preprocess(QUERY_IMG)
+
+    # 2.2 Trích xuất đặc trưng query
+    kps, query_desc = extractor.extract(query_processed)
+    print(f"Tìm thấy {len(kps)} keypoints trên ảnh query.")
+
+    if query_desc is None:
+        print("Không tìm thấy đặc trưng nào trên ảnh query (ảnh quá mờ hoặc trơn).")
+        return None
+
+    # 2.3 So khớp (CSDL đặc trưng được nạp một lần và giữ trong matcher)
+    matcher = ImageMatcher(method='BF', verify=VERIFY) # Dùng BF cho chính xác
+    matcher.get_database(FEATURE_DIR)
+    return matcher.search(query_desc, FEATURE_DIR, top_n=5, query_kps=kps)
+
+
+def collect_queries(inputs):
+    """Danh sách ảnh truy vấn từ các đường dẫn ảnh hoặc thư mục (duyệt đệ quy)"""
+    query_files = []
+    for item in inputs:
+        path = Path(item)
+        query_files.extend(list_images(path) if path.is_dir() else [path])
+    return query_files
+
+
+def run_batch(args):
+    """Chế độ không tương tác: tìm kiếm hàng loạt, ghi kết quả dạng JSON lines"""
+    with collect(profile=args.profile) as stats:
+        _run_batch(args)
+    if args.profile:
+        print("\n" + stats.report())
+
+
+def _run_batch(args):
+    extractor = FeatureExtractor(algo=args.algo, max_side=MAX_SIDE, max_keypoints=MAX_KEYPOINTS,
+                                 coarse_keypoints=args.coarse_keypoints)
+    if not os.path.exists(args.feature_dir) or len(os.listdir(args.feature_dir)) == 0:
+        print("Chưa có dữ liệu đặc trưng. Đang tạo mới...")
+        extractor.process_dataset(args.data_dir, args.feature_dir, workers=args.workers,
+                                  skip_duplicates=args.skip_duplicates)
+    elif args.update != 'none':
+        extractor.process_dataset(args.data_dir, args.feature_dir, workers=args.workers,
+                                  incremental=args.update == 'incremental',
+                                  skip_duplicates=args.skip_duplicates)
+
+    query_files = collect_queries(args.queries)
+    print(f"Tìm kiếm {len(query_files)} ảnh truy vấn -> {args.output}")
+
+    # Truy vấn được trích xuất với đúng cấu hình đã index
+    extractor = FeatureExtractor.from_index(args.feature_dir)
+    matcher = ImageMatcher(method=args.method, mode=args.mode, verify=args.verify, coarse_keep=args.coarse_keep)
+    if args.mode != 'stream':
+        # mode='stream' đọc kho theo khối ở mỗi lượt, không nạp CSDL vào RAM
+        matcher.get_database(args.feature_dir)
+
+    n_done = 0
+    with open(args.output, 'w', encoding='utf-8') as out:
+        # Truy vấn gần trùng một ảnh trong kho (pHash) được trả lời ngay, không trích xuất SIFT;
+        # các dòng này được ghi trước các truy vấn còn lại
+        hash_index = HashIndex.load(args.feature_dir) if args.prefilter else HashIndex()
+        if len(hash_index):
+            remaining = []
+            for path, code in zip(query_files, hash_images(query_files)):
+                hits = hash_index.query(code)
+                if not hits:
+                    remaining.append(path)
+                    continue
+                results, prefilter = prefilter_results(hits, args.top_n)
+                record = {"query": str(path),
+                          "results": [{"path": p, "score": score} for p, score in results],
+                          "prefilter": prefilter}
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                n_done += 1
+            print(f"{n_done} truy vấn gần trùng ảnh trong kho (pHash), bỏ qua so khớp SIFT")
+            query_files = remaining
+
+        batch = []
+
+        def flush():
+            results = matcher.search_many([descs for _, descs, _, _ in batch], args.feature_dir,
+                                          top_n=args.top_n, query_kps=[kps for _, _, kps, _ in batch])
+            for (path, _, _, error), result in zip(batch, results):
+                record = {"query": str(path),
+                          "results": [{"path": p, "score": score} for p, score in result]}
+                if error is not None:
+                    record["error"] = error
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            batch.clear()
+
+        for item in extractor.iter_extract(query_files, workers=args.workers):
+            batch.append(item)
+            if len(batch) >= args.batch_size:
+                n_done += len(batch)
+                flush()
+        if batch:
+            n_done += len(batch)
+            flush()
+    print(f"Đã ghi kết quả của {n_done} truy vấn vào {args.output}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tìm kiếm ảnh tương tự. Không truyền ảnh truy vấn -> chạy chế độ tương tác với QUERY_IMG.")
+    parser.add_argument("queries", nargs="*", help="Ảnh truy vấn hoặc thư mục chứa ảnh truy vấn")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--feature-dir", default=FEATURE_DIR)
+    parser.add_argument("-o", "--output", default="results.jsonl", help="File kết quả JSON lines")
+    parser.add_argument("-k", "--top-n", type=int, default=5)
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS,
+                        help="Số tiến trình trích xuất (mặc định: tất cả CPU)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="Số truy vấn được so khớp cùng lúc trong một lượt duyệt CSDL")
+    parser.add_argument("--algo", choices=["SIFT", "ORB", "AKAZE"], default=ALGO,
+                        help="Khi index: thuật toán đặc trưng (ORB / AKAZE: descriptor nhị phân, so khớp Hamming)")
+    parser.add_argument("--method", choices=["BF", "FLANN", "NUMPY"], default="BF")
+    parser.add_argument("--mode", choices=["scan", "global", "bow", "prune", "stream", "coarse"], default="scan")
+    parser.add_argument("--coarse-keypoints", type=int, default=COARSE_KEYPOINTS,
+                        help="Khi index: lưu tập descriptor thô k keypoint mạnh nhất (cần cho --mode coarse)")
+    parser.add_argument("--coarse-keep", type=float, default=0.1,
+                        help="--mode coarse: tỉ lệ ảnh được so khớp đầy đủ sau tầng thô")
+    parser.add_argument("--verify", choices=["homography", "affine"], default=VERIFY)
+    parser.add_argument("--update", choices=["none", "incremental", "full"], default="none",
+                        help="Cập nhật kho đặc trưng trước khi tìm kiếm")
+    parser.add_argument("--skip-duplicates", action="store_true",
+                        help="Khi index: không trích xuất ảnh gần trùng với ảnh đã có (pHash)")
+    parser.add_argument("--no-prefilter", dest="prefilter", action="store_false",
+                        help="Luôn so khớp SIFT, kể cả khi ảnh truy vấn gần trùng một ảnh trong kho")
+    parser.add_argument("--profile", action="store_true",
+                        help="In thời gian từng giai đoạn, các bộ đếm và top hàm theo cProfile")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.queries:
+        run_batch(args)
+    else:
+        main(profile=args.profile)
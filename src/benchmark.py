@@ -0,0 +1,436 @@
+"""
+Bộ benchmark: trích xuất, dựng chỉ mục và độ trễ truy vấn
+
+- Sinh dataset ảnh tổng hợp (offline, cố định theo seed) kèm ảnh truy vấn là bản biến đổi
+  (xoay, co giãn, đổi độ sáng) của một ảnh trong dataset -> biết trước đáp án đúng.
+- Đo: tốc độ trích xuất (ảnh/giây), thời gian dựng chỉ mục, dung lượng kho trên đĩa,
+  peak RSS, độ trễ truy vấn p50/p95/p99, độ chính xác top-1 và recall@top_n (ảnh đúng nằm trong
+  top_n kết quả) cho từng cặp method / mode.
+- Mỗi cặp method / mode được đo trong một tiến trình con mới, nên peak RSS của từng mode so sánh được
+  với nhau (vd. 'stream' đọc kho theo khối so với các mode nạp cả CSDL vào RAM).
+- Kết quả là JSON; so với một file baseline để phát hiện hồi quy hiệu năng.
+
+Cách dùng:
+    python src/benchmark.py --images 200 --queries 30 -o bench.json
+    python src/benchmark.py --images 200 --queries 30 -o new.json --baseline bench.json
+    python src/benchmark.py --images 200 --queries 30 --algos SIFT ORB   # ORB tiết kiệm bao nhiêu
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from feature_extraction import BINARY_ALGOS, FeatureExtractor
+from geometry import keypoints_to_array
+from image_matching import ImageMatcher
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DATASET_META = "synthetic.json"
+SCHEMA_VERSION = 1
+
+# Chỉ số càng thấp càng tốt / càng cao càng tốt (dùng khi so với baseline)
+LOWER_IS_BETTER = ("seconds", "_ms", "rss_mb", "_bytes")
+HIGHER_IS_BETTER = ("per_sec", "accuracy", "recall")
+# Chênh lệch tuyệt đối nhỏ hơn mức này được coi là nhiễu đo (giây / mili giây)
+NOISE_FLOOR = {"seconds": 0.05, "_ms": 1.0}
+# Kích thước tập descriptor thô khi index nếu chạy mode coarse mà không chỉ định
+COARSE_KEYPOINTS = 64
+
+
+def _random_image(rng, width, height):
+    # Nền nhiễu mịn + các hình ngẫu nhiên -> đủ góc cạnh để SIFT tìm keypoint
+    img = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    img = cv2.resize(img, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(rng.integers(25, 50)):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        kind = rng.integers(0, 4)
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        if kind == 0:
+            x2, y2 = int(rng.integers(0, width)), int(rng.integers(0, height))
+            cv2.rectangle(img, (x, y), (x2, y2), color, int(rng.choice([-1, 2, 4])))
+        elif kind == 1:
+            cv2.circle(img, (x, y), int(rng.integers(5, min(width, height) // 6)), color,
+                       int(rng.choice([-1, 2, 3])))
+        elif kind == 2:
+            pts = rng.integers(0, (width, height), (int(rng.integers(3, 7)), 2)).astype(np.int32)
+            cv2.fillPoly(img, [pts], color)
+        else:
+            cv2.putText(img, str(int(rng.integers(0, 10000))), (x, y), cv2.FONT_HERSHEY_SIMPLEX,
+                        float(rng.uniform(0.5, 2.0)), color, 2)
+    return img
+
+
+def distort_image(img, rng):
+    # Biến đổi nhẹ để ảnh truy vấn không trùng khít ảnh gốc
+    h, w = img.shape[:2]
+    m = cv2.getRotationMatrix2D((w / 2, h / 2), float(rng.uniform(-15, 15)),
+                                float(rng.uniform(0.8, 1.1)))
+    out = cv2.warpAffine(img, m, (w, h), borderMode=cv2.BORDER_REFLECT)
+    return cv2.convertScaleAbs(out, alpha=float(rng.uniform(0.8, 1.2)),
+                               beta=float(rng.uniform(-20, 20)))
+
+
+def make_synthetic_dataset(out_dir, n_images=200, n_queries=30, size=(320, 240), seed=0):
+    """
+    Sinh out_dir/data/ (n_images ảnh) và out_dir/queries/ (n_queries ảnh biến đổi).
+    Dùng lại nếu out_dir đã có dataset cùng cấu hình.
+
+    Returns:
+        (data_dir, danh sách (ảnh truy vấn, đường dẫn tương đối của ảnh gốc đúng))
+    """
+    out_dir = Path(out_dir)
+    data_dir = out_dir / "data"
+    query_dir = out_dir / "queries"
+    config = {"n_images": n_images, "n_queries": n_queries, "size": list(size), "seed": seed}
+
+    meta_path = out_dir / DATASET_META
+    if meta_path.exists():
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta["config"] == config:
+            return data_dir, [(query_dir / q, truth) for q, truth in meta["queries"]]
+
+    shutil.rmtree(data_dir, ignore_errors=True)
+    shutil.rmtree(query_dir, ignore_errors=True)
+    data_dir.mkdir(parents=True)
+    query_dir.mkdir(parents=True)
+
+    rng = np.random.default_rng(seed)
+    width, height = size
+    names = []
+    for i in range(n_images):
+        # Chia thư mục con giống dataset thật
+        rel_path = Path(f"group{i % 10:02d}") / f"img{i:06d}.jpg"
+        (data_dir / rel_path.parent).mkdir(exist_ok=True)
+        cv2.imwrite(str(data_dir / rel_path), _random_image(rng, width, height))
+        names.append(str(rel_path))
+
+    queries = []
+    for j, src in enumerate(rng.choice(n_images, size=min(n_queries, n_images), replace=False)):
+        query_name = f"query{j:05d}.jpg"
+        cv2.imwrite(str(query_dir / query_name), distort_image(cv2.imread(str(data_dir / names[src])), rng))
+        queries.append((query_name, names[src]))
+
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({"config": config, "queries": queries}, f, ensure_ascii=False, indent=2)
+    return data_dir, [(query_dir / q, truth) for q, truth in queries]
+
+
+def peak_rss_mb():
+    """Peak RSS của tiến trình hiện tại và các tiến trình con đã kết thúc (MB), None nếu không đo được"""
+    if resource is None:
+        return None
+    # Linux: KB, macOS: byte
+    unit = 1 if sys.platform == "darwin" else 1024
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return round(max(self_rss, child_rss) / 2 ** 20, 1)
+
+
+def dir_size(path):
+    return sum(p.stat().st_size for p in Path(path).rglob('*') if p.is_file())
+
+
+def latency_percentiles(times_ms):
+    if not times_ms:
+        return {}
+    p50, p95, p99 = np.percentile(times_ms, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 3), "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3), "mean_ms": round(float(np.mean(times_ms)), 3)}
+
+
+@contextlib.contextmanager
+def _quiet():
+    # Các module in tiến trình ra stdout; tắt trong lúc đo để không lẫn vào kết quả
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def benchmark_queries(matcher, feature_dir, queries, top_n=5, repeat=1):
+    """
+    Đo độ trễ search() cho từng truy vấn (descriptor đã trích xuất sẵn).
+    Lần gọi đầu (nạp CSDL + dựng chỉ mục) được đo riêng là index_build_seconds;
+    mode='stream' không nạp CSDL (mỗi truy vấn đọc kho theo khối).
+
+    Args:
+        queries: danh sách (descriptors, keypoints, đường dẫn đúng)
+    """
+    with _quiet():
+        start = time.perf_counter()
+        db = feature_dir if matcher.mode == 'stream' else matcher.get_database(feature_dir)
+        if matcher.mode == 'global':
+            matcher.get_global_index(db)
+        elif matcher.mode == 'bow':
+            matcher.get_bow_index(db)
+        build_seconds = time.perf_counter() - start
+
+        times_ms = []
+        correct = 0
+        recalled = 0
+        for _ in range(repeat):
+            for descs, kps, truth in queries:
+                start = time.perf_counter()
+                results = matcher.search(descs, db, top_n=top_n, query_kps=kps)
+                times_ms.append((time.perf_counter() - start) * 1000)
+                correct += bool(results) and results[0][0] == truth
+                recalled += any(path == truth for path, _ in results)
+
+    report = {"index_build_seconds": round(build_seconds, 4), "n_queries": len(times_ms)}
+    report.update(latency_percentiles(times_ms))
+    report["top1_accuracy"] = round(correct / max(len(times_ms), 1), 4)
+    report["recall_at_n"] = round(recalled / max(len(times_ms), 1), 4)
+    return report
+
+
+def _benchmark_mode(method, mode, kwargs, feature_dir, queries, top_n, repeat):
+    # Chạy trong tiến trình con: peak RSS chỉ gồm mode này (cộng phần nền của trình thông dịch + thư viện)
+    baseline_rss = peak_rss_mb()
+    report = benchmark_queries(ImageMatcher(method=method, mode=mode, **kwargs), feature_dir, queries,
+                               top_n=top_n, repeat=repeat)
+    report["baseline_rss_mb"] = baseline_rss
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def _benchmark_extractor(data_dir, query_list, feature_dir, extractor_kwargs, methods, modes,
+                         top_n, repeat, workers, bow_words, coarse_keep, isolate=True):
+    """Trích xuất, dựng chỉ mục và đo truy vấn với một cấu hình extractor"""
+    shutil.rmtree(feature_dir, ignore_errors=True)
+    extractor = FeatureExtractor(**extractor_kwargs)
+    with _quiet():
+        start = time.perf_counter()
+        report = extractor.process_dataset(data_dir, feature_dir, workers=workers, incremental=False)
+        extract_seconds = time.perf_counter() - start
+
+    # Trích xuất truy vấn một lần, các cấu hình so khớp dùng chung
+    query_extractor = FeatureExtractor.from_index(feature_dir)
+    start = time.perf_counter()
+    queries = []
+    for path, truth in query_list:
+        kps, descs = query_extractor.extract(query_extractor.preprocess(path))
+        # Mảng n x 5 thay cho cv2.KeyPoint để gửi được sang tiến trình con
+        queries.append((descs, keypoints_to_array(kps), truth))
+    query_extract_ms = (time.perf_counter() - start) * 1000 / max(len(query_list), 1)
+
+    results = {
+        "extractor": extractor.config(),
+        "extraction": {
+            "seconds": round(extract_seconds, 4),
+            "images_per_sec": round(report["indexed"] / max(extract_seconds, 1e-9), 2),
+            "indexed": report["indexed"],
+            "errors": len(report["errors"]),
+            "query_extract_ms": round(query_extract_ms, 3),
+        },
+        # store_bytes: kho đặc trưng; disk_bytes: cả thư mục sau khi dựng các chỉ mục (vd. bow/)
+        "index": {"store_bytes": dir_size(feature_dir)},
+        "queries": {},
+    }
+
+    label = extractor_kwargs.get("algo", "SIFT")
+    for method in methods:
+        for mode in modes:
+            if mode == 'bow' and label in BINARY_ALGOS:
+                # Từ điển BoW (k-means) chưa hỗ trợ descriptor nhị phân
+                continue
+            if mode == 'prune' and method == 'FLANN':
+                # FLANN/prune chạy như FLANN/scan
+                continue
+            # BoW chỉ dùng descriptor để lọc ứng viên, rồi so khớp lại bằng method
+            kwargs = {} if bow_words is None else {"bow_words": bow_words}
+            if mode == 'coarse':
+                kwargs["coarse_keep"] = coarse_keep
+            args = (method, mode, kwargs, feature_dir, queries, top_n, repeat)
+            if isolate:
+                # Tiến trình mới cho mỗi mode: peak RSS không bị mode chạy trước đẩy lên
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                    results["queries"][f"{method}/{mode}"] = pool.submit(_benchmark_mode, *args).result()
+            else:
+                results["queries"][f"{method}/{mode}"] = _benchmark_mode(*args)
+            print(f" {label} {method}/{mode}: {results['queries'][f'{method}/{mode}']}")
+
+    results["index"]["disk_bytes"] = dir_size(feature_dir)
+    return results
+
+
+def _compare_to(results, base):
+    """Tỉ lệ so với cấu hình gốc: tăng tốc trích xuất / truy vấn (>1 = nhanh hơn), kích thước kho (<1 = nhỏ hơn)"""
+    summary = {
+        "extract_speedup": round(base["extraction"]["seconds"] / max(results["extraction"]["seconds"], 1e-9), 2),
+        "store_ratio": round(results["index"]["store_bytes"] / max(base["index"]["store_bytes"], 1), 3),
+        "query_speedup": {},
+    }
+    for name, stats in results["queries"].items():
+        if name in base["queries"]:
+            summary["query_speedup"][name] = round(base["queries"][name]["mean_ms"] / max(stats["mean_ms"], 1e-9), 2)
+    return summary
+
+
+def run_benchmark(n_images=200, n_queries=30, work_dir=None, workers=1,
+                  methods=('BF', 'FLANN', 'NUMPY'),
+                  modes=('scan', 'global', 'bow', 'prune', 'stream', 'coarse'),
+                  top_n=5, repeat=1, extractor_kwargs=None, bow_words=None, size=(320, 240),
+                  coarse_keep=0.1, algos=('SIFT',), isolate=True):
+    """
+    Chạy toàn bộ benchmark, trả về dict (ghi được ra JSON).
+    work_dir=None -> dùng thư mục tạm và xoá sau khi chạy xong.
+    algos: thuật toán đặc trưng; thuật toán đầu tiên cho kết quả chính, các thuật toán còn lại
+    (vd. 'ORB') được đo trên cùng dataset và ghi vào results["algos"] kèm tỉ lệ so với thuật toán đầu.
+    isolate: đo mỗi method / mode trong một tiến trình con mới (peak_rss_mb riêng cho từng mode);
+    False = chạy tất cả trong tiến trình hiện tại, peak RSS của các mode khi đó không tách được.
+    """
+    cleanup = work_dir is None
+    work_dir = Path(work_dir or tempfile.mkdtemp(prefix="sift-bench-"))
+    try:
+        data_dir, query_list = make_synthetic_dataset(work_dir, n_images, n_queries, size=size)
+
+        extractor_kwargs = dict(extractor_kwargs or {})
+        if 'coarse' in modes and not extractor_kwargs.get("coarse_keypoints"):
+            extractor_kwargs["coarse_keypoints"] = COARSE_KEYPOINTS
+        runs = []
+        for algo in algos:
+            feature_dir = work_dir / ("features" if not runs else f"features_{algo.lower()}")
+            runs.append(_benchmark_extractor(
+                data_dir, query_list, feature_dir, dict(extractor_kwargs, algo=algo), methods, modes,
+                top_n, repeat, workers, bow_words, coarse_keep, isolate))
+
+        base = runs[0]
+        results = {
+            "schema": SCHEMA_VERSION,
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "opencv": cv2.__version__,
+                "numpy": np.__version__,
+                "cpu_count": os.cpu_count(),
+                "platform": platform.platform(),
+                "n_images": n_images,
+                "image_size": list(size),
+                "n_queries": len(query_list),
+                "workers": workers,
+                "extractor": base["extractor"],
+            },
+            "extraction": base["extraction"],
+            "index": base["index"],
+            "queries": base["queries"],
+        }
+        if len(runs) > 1:
+            results["algos"] = {}
+            for algo, run in zip(algos[1:], runs[1:]):
+                run[f"vs_{algos[0]}"] = _compare_to(run, base)
+                results["algos"][algo] = run
+                print(f" {algo} so với {algos[0]}: {run[f'vs_{algos[0]}']}")
+        results["peak_rss_mb"] = peak_rss_mb()
+        return results
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _flatten(d, prefix=""):
+    flat = {}
+    for key, value in d.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(current, baseline, tolerance=0.10):
+    """
+    So sánh kết quả với baseline. Trả về danh sách hồi quy
+    (tên chỉ số, giá trị baseline, giá trị hiện tại, tỉ lệ thay đổi) vượt quá tolerance.
+    Chỉ so các chỉ số đo hiệu năng (bỏ qua mục meta).
+    """
+    cur = _flatten({k: v for k, v in current.items() if k not in ("meta", "schema")})
+    base = _flatten({k: v for k, v in baseline.items() if k not in ("meta", "schema")})
+    regressions = []
+    for name in sorted(set(cur) & set(base)):
+        old, new = base[name], cur[name]
+        if old == 0:
+            continue
+        if any(tag in name and abs(new - old) < floor for tag, floor in NOISE_FLOOR.items()):
+            continue
+        change = (new - old) / abs(old)
+        if any(tag in name for tag in LOWER_IS_BETTER) and change > tolerance:
+            regressions.append((name, old, new, change))
+        elif any(tag in name for tag in HIGHER_IS_BETTER) and change < -tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark trích xuất / chỉ mục / truy vấn trên dataset tổng hợp")
+    parser.add_argument("--images", type=int, default=200, help="Số ảnh dataset")
+    parser.add_argument("--queries", type=int, default=30, help="Số ảnh truy vấn")
+    parser.add_argument("--size", type=int, nargs=2, default=[320, 240], metavar=("W", "H"),
+                        help="Kích thước ảnh tổng hợp")
+    parser.add_argument("--workers", type=int, default=1, help="Số tiến trình trích xuất")
+    parser.add_argument("--methods", nargs="+", default=["BF", "FLANN", "NUMPY"])
+    parser.add_argument("--modes", nargs="+", default=["scan", "global", "bow", "prune", "stream", "coarse"])
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=1, help="Số lần lặp lại bộ truy vấn")
+    parser.add_argument("--bow-words", type=int, default=None)
+    parser.add_argument("--algos", nargs="+", default=["SIFT"],
+                        help="Thuật toán đặc trưng; từ thuật toán thứ hai (vd. ORB) được so với thuật toán đầu")
+    parser.add_argument("--max-side", type=int, default=None)
+    parser.add_argument("--max-keypoints", type=int, default=None)
+    parser.add_argument("--coarse-keypoints", type=int, default=None,
+                        help=f"Kích thước tập descriptor thô khi index (mặc định {COARSE_KEYPOINTS} nếu chạy mode coarse)")
+    parser.add_argument("--coarse-keep", type=float, default=0.1,
+                        help="Tỉ lệ ảnh được so khớp đầy đủ sau tầng thô (mode coarse)")
+    parser.add_argument("--no-isolate", dest="isolate", action="store_false",
+                        help="Đo mọi mode trong cùng tiến trình (nhanh hơn, không có peak RSS riêng từng mode)")
+    parser.add_argument("--work-dir", default=None, help="Giữ dataset tổng hợp ở đây để dùng lại")
+    parser.add_argument("-o", "--output", default=None, help="Ghi kết quả JSON")
+    parser.add_argument("--baseline", default=None, help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Mức chênh lệch cho phép (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(
+        n_images=args.images, n_queries=args.queries, work_dir=args.work_dir, workers=args.workers,
+        methods=args.methods, modes=args.modes, top_n=args.top_n, repeat=args.repeat,
+        extractor_kwargs={"max_side": args.max_side, "max_keypoints": args.max_keypoints,
+                          "coarse_keypoints": args.coarse_keypoints},
+        bow_words=args.bow_words, size=tuple(args.size), coarse_keep=args.coarse_keep,
+        algos=args.algos, isolate=args.isolate)
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+        print(f" Đã ghi kết quả vào {args.output}")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f" {len(regressions)} chỉ số kém hơn baseline quá {args.tolerance:.0%}:")
+            for name, old, new, change in regressions:
+                print(f"   - {name}: {old} -> {new} ({change:+.1%})")
+            return 1
+        print(" Không có hồi quy so với baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
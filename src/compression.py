@@ -0,0 +1,109 @@
+"""
+Mã hoá descriptor gọn nhẹ cho kho đặc trưng
+
+- 'float32': giữ nguyên (512 byte / keypoint SIFT)
+- 'uint8':   descriptor SIFT của OpenCV vốn là số nguyên 0..255 nên lưu uint8 không mất thông tin
+             (128 byte / keypoint)
+- 'pca64', 'pca32': chiếu PCA xuống 64 / 32 chiều, lưu float16 (128 / 64 byte / keypoint).
+             Phép chiếu được huấn luyện một lần khi build lại toàn bộ và lưu cùng kho
+             (pca-<generation>.npz); ảnh truy vấn được chiếu bằng đúng phép chiếu đó.
+- 'binary':  descriptor nhị phân (ORB 32 byte, AKAZE 61 byte / keypoint) lưu nguyên dạng bit đã đóng gói
+             (uint8), so khớp bằng khoảng cách Hamming. Truy vấn giữ nguyên uint8.
+
+CSDL giữ descriptor ở dạng nén trong RAM; các bộ so khớp chuyển sang float32 theo từng ảnh / khối.
+"""
+
+import numpy as np
+from pathlib import Path
+
+ENCODINGS = ('float32', 'uint8', 'pca64', 'pca32', 'binary')
+
+
+class DescriptorCodec:
+    def __init__(self, encoding='float32', mean=None, components=None, filename=None):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Kiểu mã hoá không hỗ trợ: {encoding}")
+        self.encoding = encoding
+        self.mean = mean
+        self.components = components
+        self.filename = filename
+
+    @property
+    def is_pca(self):
+        return self.encoding.startswith('pca')
+
+    @property
+    def is_binary(self):
+        return self.encoding == 'binary'
+
+    @property
+    def trained(self):
+        """PCA đã được huấn luyện (kho rỗng dựng với PCA thì chưa)"""
+        return not self.is_pca or self.mean is not None
+
+    @property
+    def dtype(self):
+        if self.encoding in ('uint8', 'binary'):
+            return np.dtype(np.uint8)
+        if self.is_pca:
+            return np.dtype(np.float16)
+        return np.dtype(np.float32)
+
+    @property
+    def n_components(self):
+        return int(self.encoding[3:]) if self.is_pca else None
+
+    def project(self, descs):
+        """Đưa descriptor float32 gốc về không gian so khớp (chỉ khác gốc khi dùng PCA)"""
+        if descs is None:
+            return None
+        if self.is_binary:
+            return np.asarray(descs, dtype=np.uint8)
+        descs = np.asarray(descs, dtype=np.float32)
+        if self.is_pca:
+            return (descs - self.mean) @ self.components.T
+        return descs
+
+    def encode(self, descs):
+        """descriptor float32 gốc -> dạng lưu trữ"""
+        if self.encoding == 'uint8':
+            return np.clip(np.rint(descs), 0, 255).astype(np.uint8)
+        return self.project(descs).astype(self.dtype)
+
+    def prepare_query(self, query_desc):
+        """Descriptor truy vấn (float32 gốc) -> float32 cùng không gian với CSDL (nhị phân: giữ uint8)"""
+        return self.project(query_desc)
+
+    def train(self, sample):
+        """Huấn luyện phép chiếu PCA từ một mẫu descriptor float32"""
+        if not self.is_pca:
+            return self
+        sample = np.asarray(sample, dtype=np.float64)
+        mean = sample.mean(axis=0)
+        cov = np.cov(sample - mean, rowvar=False)
+        eigvals, eigvecs = np.linalg.eigh(cov)
+        order = np.argsort(eigvals)[::-1][:self.n_components]
+        self.mean = mean.astype(np.float32)
+        self.components = eigvecs[:, order].T.astype(np.float32)
+        return self
+
+    def save(self, feature_dir, generation):
+        if not self.is_pca:
+            return
+        self.filename = f"pca-{generation:06d}.npz"
+        np.savez(Path(feature_dir) / self.filename, mean=self.mean, components=self.components)
+
+    def to_manifest(self):
+        return {"encoding": self.encoding, "file": self.filename}
+
+
+def load_codec(feature_dir, info):
+    """Đọc codec từ mục "codec" của manifest (None -> float32 như kho cũ)"""
+    if not info:
+        return DescriptorCodec('float32')
+    codec = DescriptorCodec(info["encoding"], filename=info.get("file"))
+    if codec.is_pca and codec.filename:
+        with np.load(Path(feature_dir) / codec.filename) as data:
+            codec.mean = data["mean"]
+            codec.components = data["components"]
+    return codec
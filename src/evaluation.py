@@ -0,0 +1,217 @@
+"""
+Đánh giá chất lượng / độ trễ tìm kiếm và tinh chỉnh tham số FLANN
+
+- Bộ truy vấn có nhãn: file JSON lines, mỗi dòng {"query": ảnh truy vấn, "relevant": [ảnh đúng, ...]}
+  (đường dẫn ảnh đúng tương đối với data_dir như trong kết quả tìm kiếm; "relevant" có thể là một chuỗi).
+  Không có nhãn thì sinh bộ truy vấn từ bản biến đổi (xoay, co giãn, đổi độ sáng) của ảnh trong dataset.
+- Đo recall@k (tỉ lệ truy vấn có ít nhất một ảnh đúng trong top-k), mAP@k, top-1 và độ trễ p50/p95/p99
+  cho BF và các cấu hình FLANN (trees, checks).
+- --tune: dò lưới trees x checks, chọn cấu hình nhanh nhất đạt recall mục tiêu rồi lưu vào
+  feature_dir/flann_params.json; ImageMatcher(method='FLANN') tự dùng tham số này.
+
+Cách dùng:
+    python src/evaluation.py features --data-dir data --queries 50
+    python src/evaluation.py features --labels labels.jsonl -k 5 --tune --target-recall 0.95
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import time
+import cv2
+import numpy as np
+from pathlib import Path
+from benchmark import distort_image, latency_percentiles
+from feature_extraction import FeatureExtractor, list_images
+from image_matching import DEFAULT_FLANN_PARAMS, ImageMatcher, save_flann_params
+from result_cache import clear_disk_cache
+
+LABELS_NAME = "labels.jsonl"
+TREES_GRID = (1, 2, 4, 8)
+CHECKS_GRID = (16, 32, 64, 128, 256)
+
+
+def load_labels(labels_path):
+    """Đọc bộ truy vấn có nhãn: danh sách (đường dẫn ảnh truy vấn, tập ảnh đúng)"""
+    labels_path = Path(labels_path)
+    queries = []
+    with open(labels_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            relevant = record["relevant"]
+            if isinstance(relevant, str):
+                relevant = [relevant]
+            # Đường dẫn truy vấn tương đối tính từ thư mục chứa file nhãn
+            queries.append((labels_path.parent / record["query"], set(relevant)))
+    return queries
+
+
+def make_augmented_queries(data_dir, out_dir, n_queries=50, seed=0):
+    """
+    Sinh out_dir/queryNNNNN.jpg là bản biến đổi của n_queries ảnh ngẫu nhiên trong data_dir,
+    kèm out_dir/labels.jsonl. Trả về giống load_labels.
+    """
+    data_dir = Path(data_dir)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    images = list_images(data_dir)
+    rng = np.random.default_rng(seed)
+    with open(out_dir / LABELS_NAME, 'w', encoding='utf-8') as f:
+        for j, i in enumerate(rng.choice(len(images), size=min(n_queries, len(images)), replace=False)):
+            img = cv2.imread(str(images[i]))
+            if img is None:
+                continue
+            query_name = f"query{j:05d}.jpg"
+            cv2.imwrite(str(out_dir / query_name), distort_image(img, rng))
+            record = {"query": query_name, "relevant": [str(images[i].relative_to(data_dir))]}
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return load_labels(out_dir / LABELS_NAME)
+
+
+def average_precision(result_paths, relevant, k):
+    """AP@k của một danh sách kết quả: trung bình precision tại các vị trí có ảnh đúng"""
+    hits = 0
+    total = 0.0
+    for rank, path in enumerate(result_paths[:k], 1):
+        if path in relevant:
+            hits += 1
+            total += hits / rank
+    return total / min(len(relevant), k) if relevant else 0.0
+
+
+def extract_queries(feature_dir, labelled):
+    """Trích xuất truy vấn một lần (cùng cấu hình với kho): danh sách (descriptors, keypoints, tập ảnh đúng)"""
+    extractor = FeatureExtractor.from_index(feature_dir)
+    queries = []
+    for path, relevant in labelled:
+        kps, descs = extractor.extract(extractor.preprocess(path))
+        queries.append((descs, kps, relevant))
+    return queries
+
+
+def evaluate(matcher, feature_dir, queries, k=5):
+    """
+    Chạy từng truy vấn qua matcher.search, trả về dict:
+    recall_at_k, map_at_k, top1_accuracy và độ trễ p50/p95/p99/mean (ms).
+    Lần nạp CSDL / dựng chỉ mục đầu tiên không tính vào độ trễ.
+    """
+    # Các module in tiến trình ra stdout; tắt trong lúc đo
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = feature_dir if matcher.mode == 'stream' else matcher.get_database(feature_dir)
+        if matcher.mode == 'global':
+            matcher.get_global_index(db)
+        times_ms = []
+        recalled, correct, ap_sum = 0, 0, 0.0
+        for descs, kps, relevant in queries:
+            start = time.perf_counter()
+            results = matcher.search(descs, db, top_n=k, query_kps=kps)
+            times_ms.append((time.perf_counter() - start) * 1000)
+            paths = [path for path, _ in results]
+            recalled += any(path in relevant for path in paths)
+            correct += bool(paths) and paths[0] in relevant
+            ap_sum += average_precision(paths, relevant, k)
+
+    n = max(len(queries), 1)
+    report = {"n_queries": len(queries), "recall_at_k": round(recalled / n, 4),
+              "map_at_k": round(ap_sum / n, 4), "top1_accuracy": round(correct / n, 4)}
+    report.update(latency_percentiles(times_ms))
+    return report
+
+
+def tune_flann(feature_dir, queries, target_recall=0.95, k=5, mode='scan',
+               trees_grid=TREES_GRID, checks_grid=CHECKS_GRID):
+    """
+    Dò lưới trees x checks cho FLANN KD-tree. Với mỗi trees, checks được tăng dần và dừng ngay khi
+    đạt target_recall (checks lớn hơn chỉ chậm hơn). Chọn cấu hình có mean_ms nhỏ nhất trong
+    các cấu hình đạt mục tiêu; không cấu hình nào đạt thì chọn recall cao nhất.
+
+    Returns:
+        (tham số tốt nhất {"trees", "checks"}, danh sách (tham số, báo cáo) đã đo)
+    """
+    trials = []
+    for trees in trees_grid:
+        for checks in checks_grid:
+            params = {"trees": trees, "checks": checks}
+            matcher = ImageMatcher(method='FLANN', mode=mode, flann_params=params)
+            report = evaluate(matcher, feature_dir, queries, k=k)
+            trials.append((params, report))
+            print(f" FLANN trees={trees:<2} checks={checks:<4} recall@{k}={report['recall_at_k']:.4f} "
+                  f"mAP@{k}={report['map_at_k']:.4f} mean={report['mean_ms']:.1f} ms")
+            if report["recall_at_k"] >= target_recall:
+                break
+
+    reached = [(params, report) for params, report in trials if report["recall_at_k"] >= target_recall]
+    if reached:
+        best = min(reached, key=lambda t: t[1]["mean_ms"])
+    else:
+        print(f" Không cấu hình nào đạt recall {target_recall}, chọn cấu hình có recall cao nhất")
+        best = max(trials, key=lambda t: (t[1]["recall_at_k"], -t[1]["mean_ms"]))
+    return best[0], trials
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Đo recall@k / mAP / độ trễ, tinh chỉnh tham số FLANN")
+    parser.add_argument("feature_dir")
+    parser.add_argument("--labels", default=None, help="Bộ truy vấn có nhãn (JSON lines: query, relevant)")
+    parser.add_argument("--data-dir", default="data", help="Dataset để sinh truy vấn khi không có --labels")
+    parser.add_argument("--queries", type=int, default=50, help="Số truy vấn sinh từ dataset")
+    parser.add_argument("--query-dir", default=None,
+                        help="Nơi ghi truy vấn sinh ra (mặc định feature_dir/eval_queries)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--mode", choices=["scan", "global", "prune", "stream"], default="scan")
+    parser.add_argument("--tune", action="store_true",
+                        help="Dò tham số FLANN và lưu cấu hình tốt nhất vào feature_dir/flann_params.json")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("-o", "--output", default=None, help="Ghi báo cáo JSON")
+    args = parser.parse_args(argv)
+
+    if args.labels:
+        labelled = load_labels(args.labels)
+    else:
+        query_dir = args.query_dir or Path(args.feature_dir) / "eval_queries"
+        labelled = make_augmented_queries(args.data_dir, query_dir, args.queries, seed=args.seed)
+    print(f"Trích xuất {len(labelled)} truy vấn...")
+    queries = extract_queries(args.feature_dir, labelled)
+
+    report = {"k": args.k, "mode": args.mode, "n_queries": len(queries), "configs": {}}
+    bf = evaluate(ImageMatcher(method='BF', mode=args.mode), args.feature_dir, queries, k=args.k)
+    report["configs"]["BF"] = bf
+    print(f" BF: recall@{args.k}={bf['recall_at_k']:.4f} mAP@{args.k}={bf['map_at_k']:.4f} "
+          f"mean={bf['mean_ms']:.1f} ms")
+
+    if args.tune:
+        best, trials = tune_flann(args.feature_dir, queries, args.target_recall, k=args.k, mode=args.mode)
+        for params, trial in trials:
+            report["configs"][f"FLANN trees={params['trees']} checks={params['checks']}"] = trial
+        best_report = next(trial for params, trial in trials if params == best)
+        save_flann_params(args.feature_dir, best, k=args.k, mode=args.mode, target_recall=args.target_recall,
+                          recall_at_k=best_report["recall_at_k"], map_at_k=best_report["map_at_k"],
+                          mean_ms=best_report["mean_ms"], bf_recall_at_k=bf["recall_at_k"],
+                          timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        # Kết quả đã cache với tham số FLANN cũ không còn đúng
+        clear_disk_cache(args.feature_dir)
+        report["best"] = best
+        print(f" Đã lưu FLANN trees={best['trees']} checks={best['checks']} "
+              f"(recall@{args.k}={best_report['recall_at_k']:.4f}) vào {args.feature_dir}")
+    else:
+        matcher = ImageMatcher(method='FLANN', mode=args.mode)
+        matcher.load_tuned_flann(args.feature_dir)
+        flann = evaluate(matcher, args.feature_dir, queries, k=args.k)
+        params = matcher.flann_params
+        report["configs"][f"FLANN trees={params['trees']} checks={params['checks']}"] = flann
+        print(f" FLANN trees={params['trees']} checks={params['checks']}"
+              f"{'' if params != DEFAULT_FLANN_PARAMS else ' (mặc định)'}: recall@{args.k}="
+              f"{flann['recall_at_k']:.4f} mAP@{args.k}={flann['map_at_k']:.4f} mean={flann['mean_ms']:.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f" Đã ghi báo cáo vào {args.output}")
+
+
+if __name__ == "__main__":
+    main()
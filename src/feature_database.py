@@ -0,0 +1,175 @@
+"""
+CSDL đặc trưng thường trú trong bộ nhớ
+
+FeatureDatabase nạp descriptor của toàn bộ feature_dir một lần rồi giữ lại giữa các lần truy vấn.
+Mỗi lần refresh() chỉ kiểm tra mtime của file đặc trưng; khi có thay đổi thì chỉ nạp lại
+những ảnh được thêm / sửa và bỏ những ảnh đã bị xoá.
+"""
+
+import hashlib
+import numpy as np
+from pathlib import Path
+from compression import DescriptorCodec
+from feature_store import FeatureStore, MANIFEST_NAME, is_store, read_feature_csv
+from instrumentation import count, stage
+
+
+def _file_signature(path):
+    st = path.stat()
+    return st.st_mtime_ns, st.st_size
+
+
+class FeatureDatabase:
+    def __init__(self, feature_dir):
+        self.feature_dir = Path(feature_dir)
+        # key -> (đường dẫn ảnh gốc, descriptors trong RAM - giữ nguyên dạng nén của kho)
+        self._entries = {}
+        self._order = []
+        # key -> hình học keypoint (n x 5) nếu kho có lưu, và bảng tra theo đường dẫn ảnh
+        self._keypoints = {}
+        self._path_keys = {}
+        # Chữ ký (mtime, size) của file nguồn đã nạp
+        self._signatures = {}
+        # Tăng mỗi khi nội dung CSDL thay đổi (để các chỉ mục dẫn xuất biết cần build lại)
+        self.version = 0
+        self.algo = None
+        # Tham số trích xuất lưu trong manifest (None với thư mục CSV)
+        self.params = None
+        # Cách mã hoá descriptor của kho; truy vấn phải qua codec.prepare_query() trước khi so khớp
+        self.codec = DescriptorCodec('float32')
+
+    def __len__(self):
+        return len(self._order)
+
+    @property
+    def dim(self):
+        """Số chiều descriptor (số byte với descriptor nhị phân), None nếu CSDL rỗng"""
+        for key in self._order:
+            return self._entries[key][1].shape[1]
+        return None
+
+    def items(self):
+        """Danh sách (đường dẫn ảnh gốc, descriptors) theo thứ tự trong CSDL"""
+        return [self._entries[key] for key in self._order]
+
+    def get_keypoints(self, path):
+        """Hình học keypoint (n x 5: x, y, size, angle, response) của ảnh, hoặc None"""
+        key = self._path_keys.get(path)
+        return self._keypoints.get(key) if key is not None else None
+
+    def fingerprint(self):
+        """Dấu vân tay nội dung CSDL (ổn định giữa các tiến trình), dùng để kiểm tra chỉ mục lưu trên đĩa"""
+        h = hashlib.blake2b(digest_size=16)
+        for key in self._order:
+            h.update(repr(key).encode('utf-8'))
+        return h.hexdigest()
+
+    def refresh(self):
+        """
+        Đồng bộ với feature_dir. Trả về True nếu CSDL có thay đổi.
+        """
+        with stage("db.refresh"):
+            if is_store(self.feature_dir):
+                added, removed = self._refresh_store()
+            else:
+                added, removed = self._refresh_csv()
+
+        if added or removed:
+            self.version += 1
+            print(f"CSDL đặc trưng: +{added} / -{removed} ảnh (tổng {len(self)})")
+            return True
+        return False
+
+    def _apply(self, new_entries):
+        # new_entries: danh sách (key, loader) theo thứ tự mới; chỉ gọi loader cho key chưa có.
+        # loader trả về (đường dẫn, descriptors, keypoints) hoặc None
+        old_keys = set(self._entries)
+        entries = {}
+        keypoints = {}
+        added = 0
+        for key, loader in new_entries:
+            if key in self._entries:
+                entries[key] = self._entries[key]
+                if key in self._keypoints:
+                    keypoints[key] = self._keypoints[key]
+                count("db.reused")
+                continue
+            entry = loader()
+            if entry is None:
+                count("db.skipped")
+                continue
+            path, descs, kps = entry
+            entries[key] = (path, descs)
+            if kps is not None:
+                keypoints[key] = kps
+            added += 1
+
+        count("db.loaded", added)
+        removed = len(old_keys - set(entries))
+        self._entries = entries
+        self._keypoints = keypoints
+        self._order = list(entries)
+        self._path_keys = {entry[0]: key for key, entry in entries.items()}
+        return added, removed
+
+    def _refresh_store(self):
+        manifest_path = self.feature_dir / MANIFEST_NAME
+        signature = _file_signature(manifest_path)
+        if self._signatures.get(manifest_path) == signature:
+            return 0, 0
+
+        store = FeatureStore(self.feature_dir)
+        self.algo = store.algo
+        self.params = store.params
+        if store.codec.to_manifest() != self.codec.to_manifest():
+            # Đổi cách mã hoá -> descriptor cũ trong RAM không còn dùng được
+            self._entries = {}
+        self.codec = store.codec
+
+        def loader(idx):
+            # Sao chép từ memmap vào RAM để truy vấn sau không phải đọc đĩa
+            path, descs = store.get(idx)
+            kps = store.get_keypoints(idx)
+            return (path, np.array(descs),
+                    np.array(kps) if kps is not None else None)
+
+        new_entries = []
+        for idx, path in enumerate(store.paths):
+            # Kho cũ không có digest thì dùng vị trí trong file (tức là nạp lại toàn bộ)
+            digest = store.digests[idx] if store.digests else (signature, idx)
+            new_entries.append(((path, digest), lambda idx=idx: loader(idx)))
+
+        self._signatures = {manifest_path: signature}
+        return self._apply(new_entries)
+
+    def _refresh_csv(self):
+        csv_files = sorted(self.feature_dir.glob('*.csv'))
+        signatures = {}
+        new_entries = []
+        for csv_file in csv_files:
+            try:
+                signature = _file_signature(csv_file)
+            except OSError:
+                continue
+            signatures[csv_file] = signature
+
+            def loader(csv_file=csv_file):
+                try:
+                    original_path, descs = read_feature_csv(csv_file)
+                except Exception as e:
+                    print(f"Lỗi: {e}")
+                    count("db.errors")
+                    return None
+                if descs is None:
+                    return None
+                return original_path, descs, None
+
+            new_entries.append(((csv_file, signature), loader))
+
+        if signatures == self._signatures:
+            return 0, 0
+        self.codec = DescriptorCodec('float32')
+        if not self._signatures and csv_files:
+            print("Gợi ý: chạy feature_store.convert_csv_dir() để chuyển CSV sang kho nhị phân.")
+        self._signatures = signatures
+        return self._apply(new_entries)
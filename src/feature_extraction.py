@@ -1,91 +1,441 @@
 import cv2
-import csv
 import os
 import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from preprocessing import preprocess_image
+from preprocessing import iter_preprocessed, preprocess_image
+from geometry import keypoints_to_array
+from compression import DescriptorCodec
+from instrumentation import count, stage
+from perceptual_hash import HashIndex, hash_images, to_hex
+from result_cache import clear_disk_cache
+from feature_store import (FeatureStore, StoreWriter, compact_store, is_store, needs_compaction,
+                           source_fingerprint)
+
+# Thuật toán cho descriptor nhị phân (bit đã đóng gói, so khớp Hamming)
+BINARY_ALGOS = ('ORB', 'AKAZE')
+# Số keypoint tối đa ORB tìm khi không đặt max_keypoints (như mặc định của OpenCV)
+ORB_FEATURES = 500
+
+
+class IndexingCancelled(Exception):
+    """process_dataset bị huỷ giữa chừng (cancel.set()); kho giữ nguyên phiên bản trước"""
+
+
+def _check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise IndexingCancelled()
+
+
+def _hash_images(image_files, cancel=None, chunk=64):
+    """hash_images theo từng đợt nhỏ để huỷ có hiệu lực cả trong lúc tính pHash (phải giải mã từng ảnh)"""
+    for start in range(0, len(image_files), chunk):
+        _check_cancel(cancel)
+        yield from hash_images(image_files[start:start + chunk])
+
+
+def _original_rank(item):
+    # Trong một nhóm ảnh gần trùng, ảnh gốc là file lớn nhất (thường ít nén / độ phân giải cao nhất),
+    # rồi tới ảnh cũ nhất; đường dẫn chỉ để thứ tự luôn xác định
+    img_path, fingerprint = item
+    return -fingerprint["size"], fingerprint["mtime_ns"], img_path
+
 
 class FeatureExtractor:
-    def __init__(self, algo='SIFT'):
+    def __init__(self, algo='SIFT', encoding='float32', blur_method='gaussian', max_side=None,
+                 max_keypoints=None, coarse_keypoints=None):
+        """
+        Args:
+            algo: 'SIFT', 'SURF', hoặc 'ORB' / 'AKAZE' (descriptor nhị phân: nhanh hơn, kho nhỏ hơn nhiều,
+                  so khớp bằng khoảng cách Hamming; luôn lưu dạng encoding='binary')
+            encoding: cách lưu descriptor trong kho - 'float32', 'uint8', 'pca64', 'pca32'
+                      (xem compression.py). Chỉ ảnh hưởng tới process_dataset.
+            blur_method: phương pháp lọc nhiễu khi tiền xử lý ('gaussian' / 'median')
+            max_side: cạnh dài tối đa của ảnh (thu nhỏ trước khi lọc nhiễu / CLAHE), None = giữ nguyên
+            max_keypoints: số keypoint tối đa mỗi ảnh, giữ các điểm có response mạnh nhất
+            coarse_keypoints: bật tập descriptor thô cho ImageMatcher(mode='coarse'): keypoint của mỗi ảnh
+                      được sắp theo response giảm dần, nên coarse_keypoints dòng đầu là tập thô
+                      (không tốn thêm dung lượng kho)
+        Các tham số này được lưu trong manifest của kho; truy vấn nên dùng FeatureExtractor.from_index()
+        để trích xuất với đúng cấu hình đã index.
+        """
+        if algo in BINARY_ALGOS:
+            if encoding not in ('float32', 'binary'):
+                raise ValueError(f"{algo} cho descriptor nhị phân, không dùng được encoding='{encoding}'")
+            encoding = 'binary'
+        elif encoding == 'binary':
+            raise ValueError(f"encoding='binary' chỉ dùng cho {', '.join(BINARY_ALGOS)}")
         self.algo_name = algo
+        self.encoding = encoding
+        self.blur_method = blur_method
+        self.max_side = max_side
+        self.max_keypoints = max_keypoints
+        self.coarse_keypoints = coarse_keypoints
         # Khởi tạo thuật toán
         if algo == 'SIFT':
             self.algo = cv2.SIFT_create()
         elif algo == 'SURF':
             self.algo = cv2.xfeatures2d.SURF_create() 
+        elif algo == 'ORB':
+            self.algo = cv2.ORB_create(nfeatures=max_keypoints or ORB_FEATURES)
+        elif algo == 'AKAZE':
+            if not hasattr(cv2, 'AKAZE_create'):
+                raise ValueError("Bản OpenCV này không có AKAZE, hãy dùng algo='ORB'")
+            self.algo = cv2.AKAZE_create()
         else:
             print("Mặc định dùng SIFT")
             self.algo = cv2.SIFT_create()
 
+    @classmethod
+    def from_index(cls, feature_dir, **overrides):
+        """Tạo extractor với đúng tham số đã dùng khi index feature_dir (nếu có)"""
+        params = {}
+        if is_store(feature_dir):
+            params = FeatureStore(feature_dir).params or {}
+        config = {key: params[key] for key in
+                  ('algo', 'encoding', 'blur_method', 'max_side', 'max_keypoints', 'coarse_keypoints')
+                  if key in params}
+        config.update(overrides)
+        return cls(**config)
+
+    def config(self):
+        """Tham số khởi tạo (để tạo lại extractor giống hệt ở tiến trình khác)"""
+        return {"algo": self.algo_name, "encoding": self.encoding, "blur_method": self.blur_method,
+                "max_side": self.max_side, "max_keypoints": self.max_keypoints,
+                "coarse_keypoints": self.coarse_keypoints}
+
+    def preprocess(self, image):
+        """Tiền xử lý ảnh (đường dẫn, bytes hoặc ndarray) với cấu hình của extractor"""
+        return preprocess_image(image, blur_method=self.blur_method, max_side=self.max_side)
+
     def extract(self, img):
         #Trả về keypoints và descriptors
         if img is None:
             return None, None
-        return self.algo.detectAndCompute(img, None)
+        with stage("extract.sift"):
+            if not self.max_keypoints:
+                kps, descs = self.algo.detectAndCompute(img, None)
+            else:
+                # Giới hạn số keypoint: chỉ tính descriptor cho các điểm có response mạnh nhất
+                kps = self.algo.detect(img, None)
+                if len(kps) > self.max_keypoints:
+                    kps = sorted(kps, key=lambda kp: kp.response, reverse=True)[:self.max_keypoints]
+                if not kps:
+                    return (), None
+                kps, descs = self.algo.compute(img, kps)
+            if self.coarse_keypoints and descs is not None:
+                # Response giảm dần: k dòng đầu là tập thô (mode='coarse')
+                order = np.argsort([-kp.response for kp in kps], kind='stable')
+                kps, descs = tuple(kps[i] for i in order), descs[order]
+        count("extract.keypoints", len(kps))
+        return kps, descs
+
+    def index_params(self):
+        """
+        Tham số ảnh hưởng tới descriptor, được lưu trong manifest của kho.
+        Nếu khác với lần index trước thì mọi đặc trưng cũ đều không còn hợp lệ.
+        """
+        params = {"algo": self.algo_name, "blur_method": self.blur_method, "keypoints": True,
+                  "decode": "grayscale",
+                  "encoding": self.encoding, "max_side": self.max_side,
+                  "max_keypoints": self.max_keypoints}
+        if self.coarse_keypoints:
+            # Chỉ ghi khi bật, để kho cũ không phải build lại
+            params["coarse_keypoints"] = self.coarse_keypoints
+        return params
 
-    def process_dataset(self, data_dir, feature_dir):
+    def process_dataset(self, data_dir, feature_dir, workers=1, max_in_flight=None, progress=None,
+                        incremental=True, skip_duplicates=False, cancel=None):
+        """
+        Quét thư mục data, trích xuất và lưu vào feature_dir dưới dạng kho nhị phân (xem feature_store.py)
 
-        #Quét thư mục data, trích xuất và lưu vào feature_dir dưới dạng CSV
+        Args:
+            workers: số tiến trình trích xuất song song (1 = chạy tuần tự, None = số CPU)
+            max_in_flight: số ảnh tối đa đang được xử lý cùng lúc (mặc định 4 * workers)
+            progress: hàm progress(done, total) được gọi sau mỗi ảnh; mặc định in ra mỗi 50 ảnh
+            incremental: chỉ trích xuất ảnh mới / đã sửa và xoá đặc trưng của ảnh không còn tồn tại.
+                Tự động build lại toàn bộ nếu thuật toán hoặc tham số đã thay đổi.
+            skip_duplicates: không trích xuất ảnh gần trùng (pHash/dHash, xem perceptual_hash.py) với một
+                ảnh đã có trong kho; ảnh đó chỉ được ghi nhận trong manifest kèm "duplicate_of". Trong các ảnh mới,
+                ảnh gốc là file lớn nhất, rồi tới ảnh cũ nhất
+            cancel: threading.Event (hoặc đối tượng có is_set()); được kiểm tra sau mỗi ảnh (cả lúc tính pHash),
+                khi đã set thì bỏ segment đang ghi dở và raise IndexingCancelled. Kho cũ vẫn dùng được suốt quá trình index
+                vì manifest mới chỉ thay thế manifest cũ (nguyên tử) khi đã ghi xong.
 
+        Returns:
+            dict thống kê: total, indexed, unchanged, removed, no_features, errors (danh sách (đường dẫn, lỗi)),
+            duplicates (danh sách (đường dẫn, ảnh gốc) của các ảnh gần trùng mới phát hiện)
+        """
         data_path = Path(data_dir)
         feat_path = Path(feature_dir)
         feat_path.mkdir(parents=True, exist_ok=True)
-        
-        # Hỗ trợ các đuôi ảnh phổ biến
-        valid_exts = ['*.jpg', '*.jpeg', '*.png', '*.bmp']
-        image_files = []
-        for ext in valid_exts:
-            image_files.extend(list(data_path.rglob(ext)))
-            image_files.extend(list(data_path.rglob(ext.upper())))
-
-        print(f"Tìm thấy {len(image_files)} ảnh. Bắt đầu trích xuất...")
-
-        for idx, img_path in enumerate(image_files):
-            # Tiền xử lý
-            processed_img = preprocess_image(str(img_path))
-            if processed_img is None:
+
+        image_files = list_images(data_path)
+        params = self.index_params()
+
+        base = None
+        if incremental and is_store(feat_path):
+            base = FeatureStore(feat_path)
+            if base.params != params:
+                print("Thuật toán / tham số trích xuất đã thay đổi -> build lại toàn bộ")
+                base = None
+            elif not base.codec.trained:
+                # Kho rỗng dựng với PCA: chưa có phép chiếu để mã hoá ảnh mới -> build lại (không tốn gì)
+                base = None
+        old_sources = base.sources if base is not None else {}
+
+        report = {"total": len(image_files), "indexed": 0, "unchanged": 0, "removed": 0,
+                  "no_features": 0, "errors": [], "duplicates": []}
+
+        # So dấu vân tay để chỉ trích xuất ảnh mới hoặc đã sửa
+        to_extract = []
+        touched = {}
+        seen = set()
+        for img_path in image_files:
+            rel_path = str(img_path.relative_to(data_path))
+            seen.add(rel_path)
+            previous = old_sources.get(rel_path)
+            try:
+                fingerprint = source_fingerprint(img_path, previous)
+            except OSError as e:
+                report["errors"].append((rel_path, f"{type(e).__name__}: {e}"))
+                continue
+            if previous is not None and previous["sha1"] == fingerprint["sha1"]:
+                # Giữ dấu vân tay pHash / duplicate_of đã tính
+                fingerprint = dict(previous, **fingerprint)
+                report["unchanged"] += 1
+                count("index.skipped_unchanged")
+                if previous != fingerprint:
+                    touched[rel_path] = fingerprint
                 continue
+            to_extract.append((img_path, fingerprint))
+        orphans = [rel_path for rel_path in old_sources if rel_path not in seen]
 
-            # Trích xuất đặc trưng
-            kps, descs = self.extract(processed_img)
+        # Ảnh từng bị bỏ qua vì trùng mà ảnh gốc đã bị xoá / sửa -> trích xuất lại
+        changed = set(orphans) | {str(img_path.relative_to(data_path)) for img_path, _ in to_extract}
+        for rel_path, source in old_sources.items():
+            if source.get("duplicate_of") in changed and rel_path in seen and rel_path not in changed:
+                fingerprint = {key: value for key, value in touched.pop(rel_path, source).items()
+                               if key != "duplicate_of"}
+                to_extract.append((data_path / rel_path, fingerprint))
+                report["unchanged"] -= 1
 
-            if descs is not None:
-                # Tạo tên file CSV unique để tránh trùng lặp
+        # Kho cũ chưa có pHash: tính bổ sung một lần cho các ảnh không đổi (không cần trích xuất lại)
+        if base is not None:
+            extracting = {img_path for img_path, _ in to_extract}
+            missing = [rel_path for rel_path in seen if rel_path in old_sources
+                       and data_path / rel_path not in extracting
+                       and not touched.get(rel_path, old_sources[rel_path]).get("phash")]
+            for rel_path, code in zip(missing, _hash_images([data_path / p for p in missing], cancel)):
+                if code is not None:
+                    touched[rel_path] = dict(touched.get(rel_path, old_sources[rel_path]), phash=to_hex(code))
+
+        if base is not None and not to_extract and not orphans and not touched:
+            print(f"Tìm thấy {len(image_files)} ảnh, không có thay đổi nào.")
+            return report
+
+        # Dấu vân tay pHash của ảnh mới / đã sửa; phát hiện ảnh gần trùng với ảnh đã có trong kho
+        # (ảnh đã index vẫn là ảnh gốc), hoặc với ảnh được ưu tiên hơn trong lần chạy này (xem _original_rank)
+        to_extract.sort(key=_original_rank)
+        extracting = {str(img_path.relative_to(data_path)) for img_path, _ in to_extract}
+        hash_index = HashIndex.from_sources(
+            {rel_path: source for rel_path, source in old_sources.items()
+             if rel_path in seen and rel_path not in extracting and not source.get("duplicate_of")})
+        duplicates = {}
+        for (img_path, fingerprint), code in zip(to_extract,
+                                                 _hash_images([img_path for img_path, _ in to_extract], cancel)):
+            if code is None:
+                continue
+            fingerprint["phash"] = to_hex(code)
+            hits = hash_index.query(code)
+            rel_path = str(img_path.relative_to(data_path))
+            if hits:
+                report["duplicates"].append((rel_path, hits[0][0]))
+                count("index.duplicates")
+                if skip_duplicates:
+                    duplicates[img_path] = dict(fingerprint, duplicate_of=hits[0][0])
+                    continue
+            hash_index.add(rel_path, code)
+        if report["duplicates"]:
+            action = "bỏ qua" if skip_duplicates else "vẫn trích xuất"
+            print(f"Phát hiện {len(report['duplicates'])} ảnh gần trùng ({action}, xem report['duplicates'])")
+        to_extract = sorted(((img_path, fingerprint) for img_path, fingerprint in to_extract
+                             if img_path not in duplicates), key=lambda item: item[0])
+
+        _check_cancel(cancel)
+
+        total = len(to_extract)
+        print(f"Tìm thấy {len(image_files)} ảnh ({total} ảnh mới/đã sửa, {len(orphans)} ảnh đã xoá). "
+              f"Bắt đầu trích xuất...")
+
+        if progress is None:
+            def progress(done, total):
+                if done % 50 == 0 or done == total:
+                    print(f" Đã xử lý {done}/{total} ảnh")
+
+        codec = None
+        if base is None:
+            codec = DescriptorCodec(self.encoding)
+            if codec.is_pca and to_extract:
+                # Không có ảnh nào để trích xuất -> ghi kho rỗng, PCA được huấn luyện ở lần index có ảnh
+                self._train_codec(codec, [img_path for img_path, _ in to_extract])
+
+        with StoreWriter(feat_path, algo=self.algo_name, codec=codec, params=params, base=base) as writer:
+            for rel_path in orphans:
+                writer.remove(rel_path)
+                report["removed"] += 1
+            for rel_path, fingerprint in touched.items():
+                writer.touch_source(rel_path, fingerprint)
+            for img_path, fingerprint in duplicates.items():
+                # Chỉ ghi nhận trong manifest, xoá descriptor cũ nếu có
+                writer.set_source(img_path.relative_to(data_path), fingerprint)
+
+            fingerprints = dict(to_extract)
+            # Kết quả luôn được ghi theo đúng thứ tự image_files nên kho giống hệt chế độ tuần tự
+            for done, (img_path, descs, kps, error) in enumerate(
+                    self.iter_extract([img_path for img_path, _ in to_extract], workers, max_in_flight), 1):
                 rel_path = img_path.relative_to(data_path)
-                safe_name = str(rel_path).replace(os.sep, '_').replace('.', '_')
-                csv_name = f"{safe_name}.csv"
-                save_path = feat_path / csv_name
-
-                # Lưu đường dẫn gốc vào dòng đầu tiên của CSV để sau này tìm lại cho dễ
-                with open(save_path, 'w', newline='') as f:
-                    writer = csv.writer(f)
-                    # Dòng 1: Đường dẫn tương đối của ảnh gốc
-                    writer.writerow(["ORIGINAL_PATH", str(rel_path)])
-                    # Các dòng sau: Vector đặc trưng
-                    for desc in descs:
-                        writer.writerow(desc)
-            
-            if idx % 50 == 0:
-                print(f" Đã xử lý {idx}/{len(image_files)} ảnh")
-        
+                if error is not None:
+                    # Không ghi dấu vân tay -> lần index sau sẽ thử lại
+                    report["errors"].append((str(rel_path), error))
+                    count("index.errors")
+                    writer.remove(rel_path)
+                elif descs is None:
+                    report["no_features"] += 1
+                    writer.set_source(rel_path, fingerprints[img_path])
+                else:
+                    # Lưu đường dẫn tương đối của ảnh gốc để sau này tìm lại cho dễ
+                    writer.add(rel_path, descs, source=fingerprints[img_path], keypoints=kps)
+                    report["indexed"] += 1
+                progress(done, total)
+                if cancel is not None and cancel.is_set():
+                    # StoreWriter.__exit__ bỏ segment dở dang, manifest cũ không bị đụng tới
+                    raise IndexingCancelled()
+
+        if needs_compaction(FeatureStore(feat_path)):
+            compact_store(feat_path)
+        # Kết quả truy vấn đã cache không còn đúng với CSDL mới
+        clear_disk_cache(feat_path)
+
+        if report["errors"]:
+            print(f" Có {len(report['errors'])} ảnh lỗi (xem report['errors'])")
         print(" Hoàn tất trích xuất đặc trưng!")
+        return report
+
+    def _train_codec(self, codec, image_files, max_images=100):
+        # Huấn luyện PCA trên descriptor của một mẫu ảnh trải đều trong dataset
+        step = max(1, len(image_files) // max_images)
+        sample = []
+        for img_path in image_files[::step][:max_images]:
+            descs, _, _ = _extract_file(self, img_path)
+            if descs is not None:
+                sample.append(descs)
+        if not sample:
+            raise ValueError("Không có descriptor nào để huấn luyện PCA")
+        sample = np.vstack(sample)
+        print(f"Huấn luyện PCA {codec.encoding} trên {len(sample)} descriptor...")
+        codec.train(sample)
+
+    def iter_extract(self, image_files, workers=1, max_in_flight=None):
+        """
+        Trích xuất một loạt ảnh (tuần tự có đọc trước, hoặc song song nhiều tiến trình).
+        Sinh (đường dẫn, descriptors, keypoints n x 5, lỗi) theo đúng thứ tự đầu vào.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1 or len(image_files) <= 1:
+            # Đọc + giải mã + tiền xử lý chạy trước trên luồng nền, SIFT chạy ở luồng chính
+            for img_path, processed_img, error in iter_preprocessed(
+                    image_files, blur_method=self.blur_method, max_side=self.max_side,
+                    prefetch=max_in_flight or 8):
+                yield (img_path,) + _extract_processed(self, processed_img, error)
+            return
+
+        max_in_flight = max_in_flight or 4 * workers
+        pending = deque()
+        files = iter(image_files)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(self.config(),)) as pool:
+            for img_path in files:
+                pending.append((img_path, pool.submit(_extract_in_worker, img_path)))
+                if len(pending) >= max_in_flight:
+                    break
+            while pending:
+                img_path, future = pending.popleft()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = (None, None, f"{type(e).__name__}: {e}")
+                # Giữ số ảnh đang xử lý không vượt quá max_in_flight
+                next_path = next(files, None)
+                if next_path is not None:
+                    pending.append((next_path, pool.submit(_extract_in_worker, next_path)))
+                yield (img_path,) + result
+
+
+def list_images(data_dir):
+    """Danh sách ảnh trong data_dir (đệ quy), sắp xếp để thứ tự trích xuất ổn định"""
+    data_path = Path(data_dir)
+    # Hỗ trợ các đuôi ảnh phổ biến
+    valid_exts = ['*.jpg', '*.jpeg', '*.png', '*.bmp']
+    image_files = set()
+    for ext in valid_exts:
+        image_files.update(data_path.rglob(ext))
+        image_files.update(data_path.rglob(ext.upper()))
+    return sorted(image_files)
+
+
+def _extract_file(extractor, img_path):
+    # Tiền xử lý + trích xuất một ảnh. Trả về (descriptors, mảng keypoint n x 5, lỗi)
+    # Keypoint được đổi sang mảng NumPy vì cv2.KeyPoint không gửi được qua tiến trình
+    try:
+        processed_img = extractor.preprocess(img_path)
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+    return _extract_processed(extractor, processed_img,
+                              None if processed_img is not None else "Không đọc được ảnh")
+
+
+def _extract_processed(extractor, processed_img, error=None):
+    # Trích xuất từ ảnh đã tiền xử lý (error: lỗi ở bước đọc / tiền xử lý nếu có)
+    if error is not None:
+        return None, None, error
+    try:
+        kps, descs = extractor.extract(processed_img)
+        if descs is None:
+            return None, None, None
+        return descs, keypoints_to_array(kps), None
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+
+
+# Extractor riêng của mỗi tiến trình con (đối tượng cv2 không pickle được)
+_worker_extractor = None
+
+
+def _init_worker(config):
+    global _worker_extractor
+    # Mỗi tiến trình chỉ dùng 1 luồng OpenCV để không tranh CPU với nhau
+    cv2.setNumThreads(1)
+    _worker_extractor = FeatureExtractor(**config)
+
+
+def _extract_in_worker(img_path):
+    return _extract_file(_worker_extractor, img_path)
 
 if __name__ == "__main__":
     # Test feature extraction
-    extractor = FeatureExtractor(method='SIFT')
+    extractor = FeatureExtractor(algo='SIFT', max_side=1024, max_keypoints=2000)
     
     # Test với 1 ảnh
     test_image = "../data/test.jpg"
     
     try:
-        kp, desc = extractor.extract_from_path(test_image)
+        kp, desc = extractor.extract(extractor.preprocess(test_image))
         print(f" Trích xuất thành công!")
         print(f"   - Số keypoints: {len(kp)}")
         print(f"   - Kích thước descriptor: {desc.shape}")
         
-        # Lưu vào CSV
-        extractor.save_features_to_csv(desc, "../features/test_features.csv", "test.jpg")
-        print(f" Đã lưu features vào CSV")
-        
     except Exception as e:
         print(f" Lỗi: {e}")
@@ -0,0 +1,555 @@
+"""
+Kho đặc trưng nhị phân (thay cho mỗi ảnh một file CSV)
+
+Cấu trúc thư mục feature_dir:
+    manifest.json        - Thông tin kho: thuật toán, kiểu mã hoá descriptor, số chiều, tham số trích xuất,
+                           danh sách segment (kèm các ảnh đã bị xoá trong từng segment)
+                           và dấu vân tay (size, mtime, sha1) của từng ảnh nguồn
+    seg-000001/          - Một segment, không bao giờ bị sửa sau khi ghi xong:
+        descriptors.bin  - Ma trận descriptor liền mạch (N x dim), ghi thô theo thứ tự C
+        offsets.npy      - Mảng int64 độ dài n_images + 1: ảnh i chiếm các dòng [offsets[i], offsets[i+1])
+        keypoints.bin    - Hình học keypoint song song với descriptors.bin (N x 5 float32:
+                           x, y, size, angle, response); NaN nếu ảnh không có thông tin keypoint
+        segment.json     - Đường dẫn ảnh gốc và mã băm (digest) descriptor của từng ảnh
+    pca-000001.npz       - Phép chiếu PCA nếu kho dùng mã hoá 'pca64' / 'pca32' (xem compression.py)
+
+Build lại toàn bộ tạo ra một segment duy nhất. Cập nhật tăng dần chỉ ghi thêm một segment mới
+cho ảnh mới / đã sửa và đánh dấu xoá các entry cũ; manifest.json được thay thế nguyên tử
+nên người đọc luôn thấy một phiên bản kho hoàn chỉnh. Khi có quá nhiều entry bị xoá
+hoặc quá nhiều segment, compact_store() gộp lại thành một segment.
+Segment cũ bị xoá ngay sau khi đổi manifest: người đọc vừa đọc manifest cũ gặp segment đã mất
+thì FeatureStore đọc lại manifest mới; iter_chunks mở sẵn file của mọi segment trước khi đọc.
+
+Khi đọc, descriptors.bin được mở bằng np.memmap nên gần như không tốn chi phí load
+và các trang bộ nhớ được chia sẻ giữa các tiến trình.
+"""
+
+import contextlib
+import csv
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from pathlib import Path
+from compression import DescriptorCodec, load_codec
+from instrumentation import count, stage
+
+MANIFEST_NAME = "manifest.json"
+DESCRIPTORS_NAME = "descriptors.bin"
+OFFSETS_NAME = "offsets.npy"
+KEYPOINTS_NAME = "keypoints.bin"
+KEYPOINT_DIM = 5
+SEGMENT_META_NAME = "segment.json"
+SEGMENT_PREFIX = "seg-"
+STORE_FORMAT = 2
+# Số lần đọc lại manifest khi segment của manifest vừa đọc đã bị lần ghi mới xoá
+OPEN_RETRIES = 3
+
+
+def is_store(feature_dir):
+    """Kiểm tra thư mục có chứa kho đặc trưng nhị phân hay không"""
+    return (Path(feature_dir) / MANIFEST_NAME).exists()
+
+
+def read_manifest(feature_dir):
+    with open(Path(feature_dir) / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def descriptor_digest(data):
+    """Mã băm ngắn của descriptor một ảnh, dùng để nhận biết entry nào đã thay đổi"""
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def source_fingerprint(path, previous=None):
+    """
+    Dấu vân tay của một ảnh nguồn: kích thước, mtime và sha1 nội dung.
+    Nếu size và mtime trùng với `previous` thì dùng lại sha1 cũ, không đọc lại file.
+    """
+    st = Path(path).stat()
+    fingerprint = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if previous is not None and previous.get("size") == st.st_size \
+            and previous.get("mtime_ns") == st.st_mtime_ns:
+        fingerprint["sha1"] = previous["sha1"]
+        return fingerprint
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    fingerprint["sha1"] = h.hexdigest()
+    return fingerprint
+
+
+def count_indexed_images(feature_dir):
+    """Số ảnh đã có đặc trưng (kho nhị phân hoặc các file CSV kiểu cũ)"""
+    if is_store(feature_dir):
+        return read_manifest(feature_dir)["n_images"]
+    return len(list(Path(feature_dir).glob('*.csv')))
+
+
+class Segment:
+    """Một segment của kho: ma trận descriptor liền mạch + offsets + danh sách đường dẫn"""
+
+    def __init__(self, seg_dir, dtype, dim, deleted=(), meta=None):
+        self.seg_dir = Path(seg_dir)
+        self.name = self.seg_dir.name
+        if meta is None:
+            with open(self.seg_dir / SEGMENT_META_NAME, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        self.paths = meta["paths"]
+        self.digests = meta.get("digests")
+        self.deleted = set(deleted)
+        self.offsets = np.load(self.seg_dir / OFFSETS_NAME)
+
+        n_desc = int(self.offsets[-1])
+        if len(self.offsets) != len(self.paths) + 1:
+            raise ValueError(f"Segment {self.name} không nhất quán (offsets và danh sách ảnh lệch nhau)")
+
+        self.keypoints = None
+        if n_desc == 0:
+            self.descriptors = np.empty((0, dim), dtype=dtype)
+        else:
+            self.descriptors = np.memmap(self.seg_dir / DESCRIPTORS_NAME, dtype=dtype,
+                                         mode='r', shape=(n_desc, dim))
+            if meta.get("keypoints"):
+                self.keypoints = np.memmap(self.seg_dir / KEYPOINTS_NAME, dtype=np.float32,
+                                           mode='r', shape=(n_desc, KEYPOINT_DIM))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.paths[idx], self.descriptors[start:end]
+
+    def get_keypoints(self, idx):
+        if self.keypoints is None:
+            return None
+        kps = self.keypoints[self.offsets[idx]:self.offsets[idx + 1]]
+        if len(kps) and np.isnan(kps[0, 0]):
+            return None
+        return kps
+
+    def live_indices(self):
+        return [idx for idx in range(len(self.paths)) if idx not in self.deleted]
+
+
+class FeatureStore:
+    """Đọc kho đặc trưng nhị phân (descriptor được ánh xạ bằng np.memmap)"""
+
+    def __init__(self, feature_dir):
+        self.feature_dir = Path(feature_dir)
+        for attempt in range(OPEN_RETRIES):
+            try:
+                self._open()
+                return
+            except FileNotFoundError:
+                # Đọc manifest cũ ngay trước khi một lần ghi đổi manifest mới vào và xoá segment cũ
+                # (StoreWriter.close) -> đọc lại manifest mới
+                if attempt == OPEN_RETRIES - 1:
+                    raise
+                count("store.open_retries")
+
+    def _open(self):
+        self.manifest = read_manifest(self.feature_dir)
+
+        fmt = self.manifest.get("format")
+        if fmt not in (1, STORE_FORMAT):
+            raise ValueError(f"Định dạng kho không hỗ trợ: {fmt}")
+
+        self.algo = self.manifest["algo"]
+        self.dtype = np.dtype(self.manifest["dtype"])
+        self.dim = self.manifest["dim"]
+        self.params = self.manifest.get("params")
+        self.generation = self.manifest.get("generation", 0)
+        self.sources = self.manifest.get("sources", {})
+        self.codec = load_codec(self.feature_dir, self.manifest.get("codec"))
+
+        if fmt == 1:
+            # Kho phiên bản đầu: một segment duy nhất nằm ngay trong feature_dir
+            self.segments = [Segment(self.feature_dir, self.dtype, self.dim, meta=self.manifest)]
+        else:
+            self.segments = [Segment(self.feature_dir / seg["name"], self.dtype, self.dim,
+                                     deleted=seg.get("deleted", ()))
+                             for seg in self.manifest["segments"]]
+
+        # Các entry còn sống theo thứ tự: (chỉ số segment, chỉ số trong segment)
+        self._entries = [(s, idx) for s, segment in enumerate(self.segments)
+                         for idx in segment.live_indices()]
+        self.paths = [self.segments[s].paths[idx] for s, idx in self._entries]
+        if all(segment.digests is not None for segment in self.segments):
+            self.digests = [self.segments[s].digests[idx] for s, idx in self._entries]
+        else:
+            self.digests = None
+        self._locations = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, idx):
+        """Trả về (đường dẫn ảnh gốc, descriptors) của ảnh thứ idx, không sao chép dữ liệu"""
+        s, local = self._entries[idx]
+        return self.segments[s].get(local)
+
+    def __iter__(self):
+        for idx in range(len(self._entries)):
+            yield self.get(idx)
+
+    def get_keypoints(self, idx):
+        """Hình học keypoint (n x 5: x, y, size, angle, response) của ảnh thứ idx, hoặc None"""
+        s, local = self._entries[idx]
+        return self.segments[s].get_keypoints(local)
+
+    def locate(self, rel_path):
+        """(chỉ số segment, chỉ số trong segment) của entry còn sống ứng với rel_path, hoặc None"""
+        if self._locations is None:
+            self._locations = dict(zip(self.paths, self._entries))
+        return self._locations.get(str(rel_path))
+
+    def get_entry(self, rel_path):
+        """(descriptors, keypoints) của ảnh rel_path (đọc qua memmap), hoặc (None, None)"""
+        loc = self.locate(rel_path)
+        if loc is None:
+            return None, None
+        segment = self.segments[loc[0]]
+        return segment.get(loc[1])[1], segment.get_keypoints(loc[1])
+
+    def iter_chunks(self, max_bytes):
+        """
+        Duyệt kho theo từng khối ảnh liên tiếp, mỗi khối đọc tối đa ~max_bytes descriptor
+        (một ảnh lớn hơn max_bytes vẫn nằm trọn trong một khối).
+
+        Đọc bằng file thường (không qua memmap) vào một buffer riêng của khối, nên khi khối bị bỏ
+        thì bộ nhớ được trả lại ngay; các trang page cache của hệ điều hành không tính vào RSS.
+
+        Yields:
+            danh sách (chỉ số ảnh trong kho, descriptors) của từng khối, theo thứ tự của kho
+        """
+        row_bytes = self.dim * self.dtype.itemsize
+        max_rows = max(int(max_bytes // max(row_bytes, 1)), 1)
+        with contextlib.ExitStack() as files:
+            # Mở sẵn file của mọi segment: lần ghi khác xoá segment cũ giữa chừng thì vẫn đọc tiếp được
+            # (file đã mở vẫn đọc được sau khi bị xoá trên POSIX)
+            handles = [files.enter_context(open(segment.seg_dir / DESCRIPTORS_NAME, 'rb'))
+                       if segment.live_indices() and len(segment.descriptors) else None
+                       for segment in self.segments]
+            yield from self._iter_chunks(handles, row_bytes, max_rows)
+
+    def _iter_chunks(self, handles, row_bytes, max_rows):
+        idx = 0
+        for segment, f in zip(self.segments, handles):
+            live = segment.live_indices()
+            pos = 0
+            while pos < len(live):
+                # Gom các ảnh liên tiếp cho tới khi đủ max_rows dòng
+                first = live[pos]
+                end = pos + 1
+                while end < len(live) and segment.offsets[live[end] + 1] - segment.offsets[first] <= max_rows:
+                    end += 1
+                start_row = int(segment.offsets[first])
+                end_row = int(segment.offsets[live[end - 1] + 1])
+                with stage("stream.read"):
+                    if end_row > start_row:
+                        f.seek(start_row * row_bytes)
+                        buf = np.fromfile(f, dtype=self.dtype, count=(end_row - start_row) * self.dim)
+                    else:
+                        buf = np.empty(0, dtype=self.dtype)
+                    buf = buf.reshape(-1, self.dim)
+                count("stream.bytes_read", buf.nbytes)
+                chunk = []
+                for local in live[pos:end]:
+                    a = int(segment.offsets[local]) - start_row
+                    b = int(segment.offsets[local + 1]) - start_row
+                    chunk.append((idx, buf[a:b]))
+                    idx += 1
+                yield chunk
+                pos = end
+
+    def dead_ratio(self):
+        total = sum(len(segment) for segment in self.segments)
+        if total == 0:
+            return 0.0
+        return 1.0 - len(self) / total
+
+
+class _SegmentWriter:
+    # Ghi một segment mới vào thư mục tạm, đổi tên khi hoàn tất
+    def __init__(self, seg_dir, dtype):
+        self.seg_dir = Path(seg_dir)
+        self.tmp_dir = self.seg_dir.with_name(self.seg_dir.name + ".tmp")
+        if self.tmp_dir.exists():
+            shutil.rmtree(self.tmp_dir)
+        self.tmp_dir.mkdir(parents=True)
+        self.dtype = dtype
+        self.dim = None
+        self.paths = []
+        self.digests = []
+        self.offsets = [0]
+        self.has_keypoints = False
+        self._f = open(self.tmp_dir / DESCRIPTORS_NAME, 'wb')
+        self._kf = open(self.tmp_dir / KEYPOINTS_NAME, 'wb')
+
+    def add(self, rel_path, descs, keypoints=None):
+        descs = np.ascontiguousarray(descs, dtype=self.dtype)
+        if self.dim is None:
+            self.dim = descs.shape[1]
+        elif descs.shape[1] != self.dim:
+            raise ValueError(f"Số chiều descriptor không khớp: {descs.shape[1]} != {self.dim}")
+
+        if keypoints is None:
+            keypoints = np.full((len(descs), KEYPOINT_DIM), np.nan, dtype=np.float32)
+        else:
+            keypoints = np.ascontiguousarray(keypoints, dtype=np.float32)
+            if keypoints.shape != (len(descs), KEYPOINT_DIM):
+                raise ValueError(f"Kích thước keypoint không khớp: {keypoints.shape}")
+            self.has_keypoints = True
+
+        data = descs.tobytes()
+        self._f.write(data)
+        self._kf.write(keypoints.tobytes())
+        self.paths.append(str(rel_path))
+        self.digests.append(descriptor_digest(data))
+        self.offsets.append(self.offsets[-1] + len(descs))
+
+    def close(self):
+        self._f.close()
+        self._kf.close()
+        if not self.has_keypoints:
+            (self.tmp_dir / KEYPOINTS_NAME).unlink()
+        if not self.paths:
+            shutil.rmtree(self.tmp_dir)
+            return False
+        with open(self.tmp_dir / OFFSETS_NAME, 'wb') as f:
+            np.save(f, np.asarray(self.offsets, dtype=np.int64))
+        with open(self.tmp_dir / SEGMENT_META_NAME, 'w', encoding='utf-8') as f:
+            json.dump({"paths": self.paths, "digests": self.digests,
+                       "keypoints": self.has_keypoints}, f, ensure_ascii=False)
+        if self.seg_dir.exists():
+            # Segment mồ côi của một lần ghi bị ngắt sau os.replace nhưng trước khi ghi manifest:
+            # tên segment mang số generation chưa có trong manifest nên không ai tham chiếu tới nó
+            shutil.rmtree(self.seg_dir)
+        os.replace(self.tmp_dir, self.seg_dir)
+        return True
+
+    def abort(self):
+        self._f.close()
+        self._kf.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class StoreWriter:
+    """
+    Ghi kho đặc trưng theo kiểu streaming: descriptor của từng ảnh được nối thẳng
+    vào file nhị phân của một segment mới, nên không cần giữ toàn bộ dataset trong RAM.
+    manifest.json được ghi sau cùng, nên người đọc không bao giờ thấy kho dở dang.
+
+    base=None: build lại toàn bộ (các segment cũ bị xoá khi close()).
+    base=FeatureStore: cập nhật tăng dần - giữ các segment cũ, ghi thêm một segment mới.
+    """
+
+    def __init__(self, feature_dir, algo='SIFT', codec=None, params=None, base=None):
+        """
+        codec: DescriptorCodec quyết định dạng lưu descriptor (mặc định float32; khi ghi tiếp
+               vào base thì luôn dùng codec của base). Codec PCA phải được train() trước.
+        """
+        self.feature_dir = Path(feature_dir)
+        self.feature_dir.mkdir(parents=True, exist_ok=True)
+        self.algo = algo
+        if base is not None:
+            codec = base.codec
+        self.codec = codec or DescriptorCodec('float32')
+        self.dtype = self.codec.dtype
+        self.params = params
+        self.base = base
+
+        if base is not None:
+            self.generation = base.generation + 1
+            self.sources = dict(base.sources)
+            self.deleted = [set(segment.deleted) for segment in base.segments]
+        else:
+            self.generation = (read_manifest(self.feature_dir).get("generation", 0) + 1
+                               if is_store(self.feature_dir) else 1)
+            self.sources = {}
+            self.deleted = []
+
+        self._segment = _SegmentWriter(self.feature_dir / f"{SEGMENT_PREFIX}{self.generation:06d}",
+                                       self.dtype)
+        self._written = set()
+
+    def _tombstone(self, rel_path):
+        if self.base is None:
+            return
+        loc = self.base.locate(rel_path)
+        if loc is not None:
+            self.deleted[loc[0]].add(loc[1])
+
+    def add(self, rel_path, descs, source=None, keypoints=None, encoded=False):
+        """Thêm descriptor float32 gốc của một ảnh (encoded=True nếu descs đã ở dạng lưu trữ)"""
+        rel_path = str(rel_path)
+        if descs is None or len(descs) == 0:
+            self.set_source(rel_path, source)
+            return
+        self._tombstone(rel_path)
+        if not encoded:
+            descs = self.codec.encode(descs)
+        self._segment.add(rel_path, descs, keypoints)
+        self._written.add(rel_path)
+        if source is not None:
+            self.sources[rel_path] = source
+
+    def set_source(self, rel_path, source):
+        """Ghi nhận dấu vân tay ảnh nguồn không có đặc trưng (ảnh trơn), xoá entry cũ nếu có"""
+        rel_path = str(rel_path)
+        if rel_path not in self._written:
+            self._tombstone(rel_path)
+        if source is not None:
+            self.sources[rel_path] = source
+
+    def touch_source(self, rel_path, source):
+        """Cập nhật dấu vân tay (vd. mtime đổi nhưng nội dung giữ nguyên), không đụng tới descriptor"""
+        self.sources[str(rel_path)] = source
+
+    def remove(self, rel_path):
+        """Xoá ảnh khỏi kho (ảnh nguồn đã bị xoá)"""
+        rel_path = str(rel_path)
+        self._tombstone(rel_path)
+        self.sources.pop(rel_path, None)
+
+    def close(self):
+        has_new = self._segment.close()
+        if self.codec.is_pca and self.codec.filename is None and self.codec.trained:
+            self.codec.save(self.feature_dir, self.generation)
+
+        segments = []
+        dim = self._segment.dim
+        n_images = 0
+        n_descriptors = 0
+        if self.base is not None:
+            dim = dim or self.base.dim
+            for segment, deleted in zip(self.base.segments, self.deleted):
+                live = len(segment) - len(deleted)
+                if live == 0:
+                    continue
+                segments.append({"name": segment.name, "deleted": sorted(deleted)})
+                n_images += live
+                counts = np.diff(segment.offsets)
+                n_descriptors += int(counts.sum()) - int(counts[sorted(deleted)].sum())
+        if has_new:
+            segments.append({"name": self._segment.seg_dir.name, "deleted": []})
+            n_images += len(self._segment.paths)
+            n_descriptors += self._segment.offsets[-1]
+
+        manifest = {
+            "format": STORE_FORMAT,
+            "algo": self.algo,
+            "dtype": self.dtype.name,
+            "dim": dim or 0,
+            "params": self.params,
+            "codec": self.codec.to_manifest(),
+            "generation": self.generation,
+            "n_images": n_images,
+            "n_descriptors": int(n_descriptors),
+            "segments": segments,
+            "sources": self.sources,
+        }
+        tmp_manifest = self.feature_dir / (MANIFEST_NAME + ".tmp")
+        with open(tmp_manifest, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_manifest, self.feature_dir / MANIFEST_NAME)
+
+        self._remove_unreferenced({seg["name"] for seg in segments} | {self.codec.filename})
+
+    def _remove_unreferenced(self, keep):
+        # Xoá segment không còn được manifest tham chiếu (tiến trình đang memmap vẫn đọc được trên POSIX)
+        for seg_dir in self.feature_dir.glob(SEGMENT_PREFIX + "*"):
+            if seg_dir.is_dir() and seg_dir.name not in keep and not seg_dir.name.endswith(".tmp"):
+                shutil.rmtree(seg_dir, ignore_errors=True)
+        for pca_file in self.feature_dir.glob("pca-*.npz"):
+            if pca_file.name not in keep:
+                pca_file.unlink()
+        # File của kho phiên bản đầu (format 1) nằm ngay trong feature_dir
+        for name in (DESCRIPTORS_NAME, OFFSETS_NAME):
+            old = self.feature_dir / name
+            if old.exists():
+                old.unlink()
+
+    def abort(self):
+        self._segment.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def needs_compaction(store, max_segments=8, max_dead_ratio=0.3):
+    return len(store.segments) > max_segments or store.dead_ratio() > max_dead_ratio
+
+
+def compact_store(feature_dir):
+    """Gộp mọi entry còn sống vào một segment duy nhất (bỏ hẳn các entry đã xoá)"""
+    store = FeatureStore(feature_dir)
+    with StoreWriter(feature_dir, algo=store.algo, codec=store.codec, params=store.params) as writer:
+        for idx, (path, descs) in enumerate(store):
+            writer.add(path, descs, source=store.sources.get(path), keypoints=store.get_keypoints(idx),
+                       encoded=True)
+        for path, source in store.sources.items():
+            if path not in writer.sources:
+                writer.set_source(path, source)
+    print(f" Đã gộp kho đặc trưng: {len(store.segments)} segment -> 1")
+
+
+def read_feature_csv(csv_file):
+    """
+    Đọc một file CSV đặc trưng kiểu cũ.
+    Trả về (đường dẫn ảnh gốc, descriptors) hoặc (None, None) nếu file không hợp lệ.
+    """
+    with open(csv_file, 'r', newline='') as f:
+        header = next(csv.reader(f), None)
+        if not header or header[0] != "ORIGINAL_PATH":
+            return None, None
+        descs = np.loadtxt(f, delimiter=',', dtype=np.float32, ndmin=2)
+    if descs.size == 0:
+        return header[1], None
+    return header[1], descs
+
+
+def convert_csv_dir(csv_dir, feature_dir=None, algo='SIFT'):
+    """
+    Chuyển một thư mục features/*.csv kiểu cũ sang kho nhị phân.
+    Mặc định ghi kho ngay trong thư mục CSV; các file CSV được giữ nguyên.
+    """
+    csv_dir = Path(csv_dir)
+    feature_dir = Path(feature_dir) if feature_dir is not None else csv_dir
+    csv_files = sorted(csv_dir.glob('*.csv'))
+
+    print(f"Đang chuyển {len(csv_files)} file CSV sang kho nhị phân...")
+    n_images = 0
+    with StoreWriter(feature_dir, algo=algo) as writer:
+        for csv_file in csv_files:
+            try:
+                original_path, descs = read_feature_csv(csv_file)
+            except ValueError as e:
+                print(f"Bỏ qua {csv_file.name}: {e}")
+                continue
+            if descs is None:
+                continue
+            writer.add(original_path, descs)
+            n_images += 1
+
+    print(f" Đã chuyển {n_images} ảnh vào {feature_dir}")
+    return n_images
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Cách dùng: python feature_store.py <thư_mục_csv> [thư_mục_kho]")
+    else:
+        convert_csv_dir(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
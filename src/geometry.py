@@ -0,0 +1,96 @@
+"""
+Kiểm chứng hình học (RANSAC) cho các ứng viên tốt nhất
+
+Số match tốt sau ratio test khá nhiễu: hai ảnh khác nhau vẫn có thể có vài chục match ngẫu nhiên.
+Ở đây các match được kiểm tra xem có cùng tuân theo một phép biến đổi hình học
+(homography hoặc affine) hay không; số inlier là điểm đáng tin cậy hơn.
+"""
+
+import cv2
+import numpy as np
+from matching_kernel import is_binary
+
+MIN_MATCHES = 4
+
+
+def keypoints_to_array(kps):
+    """Chuyển danh sách cv2.KeyPoint thành mảng (n x 5 float32: x, y, size, angle, response)"""
+    if kps is None:
+        return None
+    if isinstance(kps, np.ndarray):
+        return kps
+    return np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response) for kp in kps],
+                    dtype=np.float32).reshape(-1, 5)
+
+
+def good_match_pairs(query_desc, db_desc, ratio_thresh=0.8, matcher=None):
+    """Các cặp (chỉ số query, chỉ số db) vượt ratio test"""
+    if query_desc is None or db_desc is None or len(db_desc) < 2:
+        return np.empty((0, 2), dtype=np.int64)
+    binary = is_binary(query_desc)
+    matcher = matcher or cv2.BFMatcher(cv2.NORM_HAMMING if binary else cv2.NORM_L2, crossCheck=False)
+    dtype = np.uint8 if binary else np.float32
+    matches = matcher.knnMatch(np.asarray(query_desc, dtype=dtype), np.asarray(db_desc, dtype=dtype), k=2)
+    pairs = [(row[0].queryIdx, row[0].trainIdx) for row in matches
+             if len(row) == 2 and row[0].distance < ratio_thresh * row[1].distance]
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def count_inliers(query_pts, db_pts, model='homography', reproj_thresh=5.0):
+    """Số cặp điểm khớp với mô hình hình học ước lượng bằng RANSAC"""
+    if len(query_pts) < MIN_MATCHES:
+        return 0
+    src = np.asarray(query_pts, dtype=np.float32).reshape(-1, 1, 2)
+    dst = np.asarray(db_pts, dtype=np.float32).reshape(-1, 1, 2)
+    if model == 'affine':
+        _, mask = cv2.estimateAffinePartial2D(src, dst, method=cv2.RANSAC,
+                                              ransacReprojThreshold=reproj_thresh)
+    else:
+        _, mask = cv2.findHomography(src, dst, cv2.RANSAC, reproj_thresh)
+    if mask is None:
+        return 0
+    return int(mask.sum())
+
+
+def verify(query_kps, query_desc, db_kps, db_desc, model='homography', ratio_thresh=0.8,
+           matcher=None):
+    """Số inlier hình học giữa ảnh truy vấn và một ảnh CSDL (0 nếu thiếu keypoint)"""
+    if query_kps is None or db_kps is None:
+        return 0
+    pairs = good_match_pairs(query_desc, db_desc, ratio_thresh, matcher)
+    if len(pairs) < MIN_MATCHES:
+        return 0
+    return count_inliers(query_kps[pairs[:, 0], :2], db_kps[pairs[:, 1], :2], model=model)
+
+
+def rerank(candidates, verify_fn, top_n, early_stop=True):
+    """
+    Sắp xếp lại ứng viên theo số inlier.
+
+    candidates: danh sách (đường dẫn, điểm thô) đã sắp giảm dần theo điểm thô.
+    verify_fn(path) trả về số inlier, hoặc None nếu không kiểm chứng được (ảnh CSDL không có keypoint)
+    -> ứng viên giữ nguyên điểm thô.
+    early_stop: chỉ đúng khi điểm thô là số match tốt chính xác của đúng các cặp mà verify tính lại
+    (BF / NUMPY): khi đó số inlier không thể vượt quá điểm thô, nên khi đã có top_n kết quả
+    mà inlier thấp nhất trong đó > điểm thô của ứng viên kế tiếp thì dừng sớm.
+    Điểm xấp xỉ (FLANN) hay điểm bỏ phiếu (mode='global') cần early_stop=False.
+
+    Returns:
+        (danh sách (đường dẫn, số inlier) giảm dần, số ứng viên đã kiểm chứng)
+    """
+    verified = []
+    n_checked = 0
+    for path, raw_score in candidates:
+        if early_stop and len(verified) >= top_n:
+            nth = sorted((s for _, s in verified), reverse=True)[top_n - 1]
+            # Dừng khi nth > điểm thô: nếu bằng, ứng viên sau vẫn có thể vượt lên nhờ đường dẫn nhỏ hơn
+            if nth > raw_score:
+                break
+        inliers = verify_fn(path)
+        if inliers is None:
+            verified.append((path, raw_score))
+            continue
+        verified.append((path, inliers))
+        n_checked += 1
+    verified.sort(key=lambda x: (-x[1], x[0]))
+    return verified, n_checked
@@ -0,0 +1,137 @@
+"""
+Chỉ mục láng giềng gần nhất toàn cục
+
+Thay vì knnMatch riêng với từng ảnh (FLANN phải dựng KD-tree mới cho mỗi ảnh ở mỗi truy vấn),
+toàn bộ descriptor của CSDL được xếp chồng thành một ma trận duy nhất kèm mảng image-id song song.
+Chỉ mục được dựng một lần; mỗi truy vấn chỉ cần một lời gọi kNN, sau đó bỏ phiếu theo ảnh.
+Tìm kiếm chính xác (BF) trả thẳng mảng chỉ số / khoảng cách, không duyệt từng DMatch trong Python:
+descriptor số thực dùng kNN của nhân NumPy (matching_kernel.knn, phép nhân ma trận theo khối).
+Descriptor nhị phân (uint8) dùng khoảng cách Hamming: cv2.batchDistance (popcount trên bit đóng gói) hoặc FLANN LSH.
+"""
+
+import cv2
+import numpy as np
+from instrumentation import count, stage
+from matching_kernel import knn
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+LSH_PARAMS = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+
+
+class GlobalIndex:
+    def __init__(self, items, method='BF', k=10, trees=5, checks=50, binary=False):
+        """
+        Args:
+            items: danh sách (đường dẫn ảnh gốc, descriptors) - thường là FeatureDatabase.items()
+            method: 'FLANN' (KD-tree xấp xỉ, LSH với descriptor nhị phân), các giá trị khác
+                    dùng tìm kiếm chính xác (BF)
+            k: số láng giềng lấy cho mỗi descriptor truy vấn
+            binary: descriptor nhị phân (kho mã hoá 'binary') -> khoảng cách Hamming
+        """
+        self.method = method
+        self.k = k
+        self.checks = checks
+        self.paths = [path for path, _ in items]
+
+        counts = np.array([len(descs) for _, descs in items], dtype=np.int64)
+        self.counts = counts
+        self.binary = binary
+        self.dtype = np.uint8 if self.binary else np.float32
+        if len(items) > 0:
+            self.descriptors = np.ascontiguousarray(
+                np.vstack([descs for _, descs in items]), dtype=self.dtype)
+        else:
+            self.descriptors = np.empty((0, 128), dtype=np.float32)
+        self.image_ids = np.repeat(np.arange(len(items), dtype=np.int32), counts)
+
+        self._flann = None
+        if len(self.descriptors) > 0 and method == 'FLANN':
+            index_params = LSH_PARAMS if self.binary else dict(algorithm=FLANN_INDEX_KDTREE, trees=trees)
+            self._flann = cv2.flann_Index(self.descriptors, index_params)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def knn(self, query_desc, k):
+        """Trả về (indices, khoảng cách bình phương) kích thước (n_query, k), đã sắp tăng dần"""
+        query_desc = np.ascontiguousarray(query_desc, dtype=self.dtype)
+        count("global.query_descriptors", len(query_desc))
+        if self._flann is not None:
+            with stage("global.knn"):
+                indices, dists = self._flann.knnSearch(query_desc, k, params=dict(checks=self.checks))
+            if self.binary:
+                # LSH trả về khoảng cách Hamming, có thể thiếu láng giềng (chỉ số -1)
+                return indices.astype(np.int64), dists.astype(np.float32) ** 2
+            # FLANN KD-tree trả về khoảng cách L2 bình phương
+            return indices.astype(np.int64), dists.astype(np.float32)
+
+        count("match.descriptors_compared", len(query_desc) * len(self.descriptors))
+        with stage("global.knn"):
+            if self.binary:
+                # Hamming trên bit đóng gói nhanh hơn bung bit rồi nhân ma trận
+                dists, indices = cv2.batchDistance(query_desc, self.descriptors, cv2.CV_32S,
+                                                   normType=cv2.NORM_HAMMING, K=k)
+                return indices.astype(np.int64), dists.astype(np.float32) ** 2
+            return knn(query_desc, self.descriptors, k)
+
+    def _good_neighbours(self, query_desc, ratio_thresh):
+        # (image id của từng láng giềng, mặt nạ láng giềng vượt ratio test), cùng kích thước (n_query, k)
+        k = min(self.k, len(self.descriptors))
+        if k < 2:
+            return None, None
+        indices, dists = self.knn(query_desc, k)
+        valid = indices >= 0
+        ids = np.where(valid, self.image_ids[np.clip(indices, 0, None)], -1)
+        ratio2 = ratio_thresh ** 2
+
+        # n cho từng cột: mặc định là cận dưới d_k (không dùng được cho cột cuối cùng)
+        second = np.broadcast_to(dists[:, -1:], dists.shape).copy()
+        has_second = np.zeros(dists.shape, dtype=bool)
+        is_first = valid.copy()
+        for j in range(k):
+            for jj in range(j + 1, k):
+                same = (ids[:, jj] == ids[:, j]) & valid[:, j]
+                is_first[:, jj] &= ~same
+                take = same & ~has_second[:, j]
+                second[take, j] = dists[take, jj]
+                has_second[:, j] |= take
+
+        bounded = has_second.copy()
+        # d_k chỉ là cận dưới khi láng giềng thứ k tồn tại (LSH có thể trả về thiếu)
+        bounded[:, :-1] |= valid[:, -1:]
+        return ids, is_first & bounded & (dists < ratio2 * second)
+
+    def vote(self, query_desc, ratio_thresh=0.8):
+        """
+        Số match tốt của truy vấn với từng ảnh trong CSDL (mảng dài len(self)).
+
+        Với mỗi descriptor truy vấn, láng giềng đầu tiên thuộc ảnh I đóng vai trò m, láng giềng
+        kế tiếp cùng ảnh I đóng vai trò n của ratio test như ImageMatcher.match. Nếu ảnh I không
+        có láng giềng thứ hai trong k kết quả thì khoảng cách thứ k là cận dưới của n, nên
+        m < ratio * d_k vẫn bảo đảm vượt ratio test. Nhờ vậy điểm số so sánh được với cách cũ.
+        """
+        return self.vote_many([query_desc], ratio_thresh)[0]
+
+    def vote_many(self, query_descs, ratio_thresh=0.8):
+        """
+        Như vote() cho nhiều truy vấn: descriptor của mọi truy vấn được xếp chồng và tra kNN
+        trong một lần gọi. Trả về mảng (len(query_descs), len(self)).
+        """
+        scores = np.zeros((len(query_descs), len(self)), dtype=np.int64)
+        lengths = [0 if q is None else len(q) for q in query_descs]
+        if len(self.descriptors) == 0 or sum(lengths) == 0:
+            return scores
+
+        query = np.vstack([q for q in query_descs if q is not None and len(q) > 0])
+        ids, good = self._good_neighbours(query, ratio_thresh)
+        if ids is None:
+            return scores
+
+        # Dòng nào thuộc truy vấn nào
+        query_ids = np.repeat(np.arange(len(query_descs)), lengths)
+        rows = np.broadcast_to(query_ids[:, None], ids.shape)
+        np.add.at(scores, (rows[good], ids[good]), 1)
+        # knnMatch với ảnh chỉ có 1 descriptor không cho được cặp (m, n) -> điểm 0 như cách cũ
+        scores[:, self.counts < 2] = 0
+        return scores
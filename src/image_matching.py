@@ -1,94 +1,612 @@
 import cv2
-import csv
+import heapq
+import json
+import math
 import os
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from feature_database import FeatureDatabase
+from feature_store import FeatureStore, is_store
+from geometry import keypoints_to_array, rerank, verify
+from global_index import LSH_PARAMS, GlobalIndex
+from instrumentation import bind, count, stage
+from matching_kernel import is_binary, ratio_match_counts, ratio_match_counts_many
+from vocabulary import load_or_build_bow_index
+
+FLANN_INDEX_KDTREE = 1
+# Tham số FLANN KD-tree mặc định: trees (tham số chỉ mục), checks (tham số tìm kiếm)
+DEFAULT_FLANN_PARAMS = {"trees": 5, "checks": 50}
+# Tham số đã tinh chỉnh cho một kho (ghi bởi evaluation.py --tune)
+FLANN_PARAMS_NAME = "flann_params.json"
+
+
+def load_flann_params(feature_dir):
+    """Tham số FLANN đã tinh chỉnh lưu trong feature_dir ({"trees", "checks"}), hoặc None"""
+    path = Path(feature_dir) / FLANN_PARAMS_NAME
+    if not path.exists():
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)["params"]
+
+
+def save_flann_params(feature_dir, params, **info):
+    """Ghi tham số FLANN (kèm thông tin đo được, vd. recall, độ trễ) cho ImageMatcher của feature_dir"""
+    path = Path(feature_dir) / FLANN_PARAMS_NAME
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(dict(info, params=params), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
 
 class ImageMatcher:
-    def __init__(self, method='BF'):
+    def __init__(self, method='BF', mode='scan', global_k=10, shortlist=50, bow_words=1000,
+                 verify=None, verify_top_k=20, prune_chunks=8, stream_memory_mb=256,
+                 coarse_keypoints=None, coarse_keep=0.1, flann_params=None):
+        """
+        Args:
+            method: 'BF', 'FLANN' hoặc 'NUMPY' (nhân so khớp vector hoá, cho kết quả như BF
+                    nhưng chấm điểm cả loạt ảnh trong một lần gọi - xem matching_kernel.py).
+                    Descriptor nhị phân (ORB / AKAZE, uint8) được so bằng khoảng cách Hamming:
+                    BF NORM_HAMMING, FLANN LSH, NUMPY trên các bit
+            mode: 'scan' - knnMatch lần lượt với từng ảnh trong CSDL
+                  'global' - một chỉ mục kNN chung cho cả CSDL, bỏ phiếu theo ảnh (xem global_index.py)
+                  'bow' - lấy danh sách ứng viên từ inverted file TF-IDF rồi chỉ so khớp lại
+                          các ứng viên đó (xem vocabulary.py)
+                  'prune' - như scan (kết quả giống hệt) nhưng so khớp theo từng khối descriptor
+                            truy vấn và bỏ dở ảnh không thể lọt top-N (xem _rank_prune).
+                            Chỉ cho BF / NUMPY; với FLANN chạy như scan (mỗi khối sẽ phải dựng lại
+                            KD-tree của từng ảnh, và điểm xấp xỉ không cho cận chặt)
+                  'stream' - như scan nhưng không nạp CSDL vào RAM: đọc kho theo từng khối,
+                             đọc trước khối kế tiếp trong lúc so khớp khối hiện tại (xem _rank_stream)
+                  'coarse' - chấm điểm mọi ảnh bằng tập descriptor thô rồi chỉ so khớp đầy đủ
+                             phần ảnh có điểm thô cao nhất (xem _rank_coarse)
+            global_k: số láng giềng mỗi descriptor khi dùng mode='global'
+            shortlist: số ứng viên lấy từ inverted file khi dùng mode='bow'
+            bow_words: kích thước từ điển nếu phải huấn luyện mới khi dùng mode='bow'
+            verify: None, 'homography' hoặc 'affine' - kiểm chứng hình học RANSAC cho các ứng viên
+                    tốt nhất rồi xếp hạng lại theo số inlier (cần truyền query_kps cho search)
+            verify_top_k: số ứng viên tối đa được kiểm chứng hình học
+            prune_chunks: số khối descriptor truy vấn khi dùng mode='prune'
+            stream_memory_mb: giới hạn bộ nhớ cho descriptor CSDL khi dùng mode='stream'
+                              (khối đang so khớp + khối đọc trước)
+            coarse_keypoints: số descriptor mỗi ảnh ở tầng thô khi dùng mode='coarse'
+                              (None = giá trị đã index, xem FeatureExtractor(coarse_keypoints=...))
+            coarse_keep: tỉ lệ ảnh CSDL được so khớp đầy đủ sau tầng thô (ít nhất top_n / verify_top_k ảnh)
+            flann_params: {"trees", "checks"} của FLANN KD-tree. None = tham số đã tinh chỉnh của kho
+                          (feature_dir/flann_params.json, xem evaluation.py) nếu có, ngược lại mặc định.
+                          Mỗi kho dùng tham số của riêng nó; file được đọc lại khi thay đổi
+        """
         self.method = method
+        self.mode = mode
+        self.global_k = global_k
+        self.shortlist = shortlist
+        self.bow_words = bow_words
+        self.verify = verify
+        self.verify_top_k = verify_top_k
+        self.prune_chunks = prune_chunks
+        self.stream_memory_mb = stream_memory_mb
+        self.coarse_keypoints = coarse_keypoints
+        self.coarse_keep = coarse_keep
         self.bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=False)
-        
-        FLANN_INDEX_KDTREE = 1
-        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-        search_params = dict(checks=50)
-        self.flann = cv2.FlannBasedMatcher(index_params, search_params)
+        self.bf_hamming = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+        # flann_params do người gọi truyền vào thì không bị tham số đã tinh chỉnh của kho ghi đè
+        self._flann_fixed = flann_params is not None
+        self._set_flann(flann_params or DEFAULT_FLANN_PARAMS)
+        self._default_flann = self.flann_params
+        # Tham số đã tinh chỉnh của từng feature_dir: đường dẫn -> (mtime_ns của file hoặc None, params)
+        self._tuned_flann = {}
+
+        # CSDL đặc trưng thường trú, mỗi feature_dir một bản
+        self._databases = {}
+        # Chỉ mục toàn cục đã dựng cho từng CSDL: db -> (db.version, flann_params, GlobalIndex)
+        self._global_indexes = {}
+        # BoW index của từng CSDL: db -> (db.version, BowIndex)
+        self._bow_indexes = {}
+        # Descriptor theo đường dẫn cho bước so khớp lại của BoW: db -> (db.version, dict)
+        self._bow_descs = {}
+
+    def config(self, feature_dir=None):
+        """
+        Các tham số ảnh hưởng tới kết quả tìm kiếm (dùng làm một phần khoá cache).
+        Có feature_dir thì flann_params là tham số sẽ dùng cho kho đó (xem flann_params_for).
+        """
+        flann_params = self.flann_params if feature_dir is None else self.flann_params_for(feature_dir)
+        return {"method": self.method, "mode": self.mode, "global_k": self.global_k,
+                "shortlist": self.shortlist, "bow_words": self.bow_words, "verify": self.verify,
+                "verify_top_k": self.verify_top_k, "prune_chunks": self.prune_chunks,
+                "coarse_keypoints": self.coarse_keypoints, "coarse_keep": self.coarse_keep,
+                "flann_params": flann_params}
+
+    def _set_flann(self, params):
+        self.flann_params = {"trees": int(params["trees"]), "checks": int(params["checks"])}
+        self.flann = cv2.FlannBasedMatcher(dict(algorithm=FLANN_INDEX_KDTREE, trees=self.flann_params["trees"]),
+                                           dict(checks=self.flann_params["checks"]))
+        self.flann_lsh = cv2.FlannBasedMatcher(LSH_PARAMS, dict(checks=self.flann_params["checks"]))
+
+    def _knn_matcher(self, binary):
+        if self.method == 'BF':
+            return self.bf_hamming if binary else self.bf
+        return self.flann_lsh if binary else self.flann
+
+    def flann_params_for(self, feature_dir):
+        """
+        Tham số FLANN cho feature_dir: flann_params truyền vào, ngược lại tham số đã tinh chỉnh của kho
+        (feature_dir/flann_params.json) hoặc mặc định. File được đọc lại khi mtime đổi (ghi lại / xoá).
+        """
+        if self._flann_fixed:
+            return self._default_flann
+        if isinstance(feature_dir, FeatureDatabase):
+            feature_dir = feature_dir.feature_dir
+        try:
+            mtime = (Path(feature_dir) / FLANN_PARAMS_NAME).stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        key = str(Path(feature_dir).resolve())
+        cached = self._tuned_flann.get(key)
+        if cached is None or cached[0] != mtime:
+            params = load_flann_params(feature_dir) if mtime is not None else None
+            params = {"trees": int(params["trees"]), "checks": int(params["checks"])} if params else self._default_flann
+            cached = self._tuned_flann[key] = (mtime, params)
+        return cached[1]
+
+    def load_tuned_flann(self, feature_dir):
+        """Chuyển sang tham số FLANN của feature_dir (xem flann_params_for); True nếu tham số thay đổi"""
+        params = self.flann_params_for(feature_dir)
+        if params == self.flann_params:
+            return False
+        self._set_flann(params)
+        return True
 
     def match(self, query_desc, db_desc):
         if query_desc is None or db_desc is None:
             return 0
+
+        count("match.images")
+        count("match.descriptors_compared", len(query_desc) * len(db_desc))
+        if self.method == 'NUMPY':
+            with stage("match.numpy"):
+                return int(ratio_match_counts(query_desc, [db_desc])[0])
+
+        # Descriptor nén (uint8 / float16) được chuyển sang float32 ngay trước khi so khớp;
+        # descriptor nhị phân giữ nguyên uint8 cho NORM_HAMMING / LSH
+        binary = is_binary(query_desc)
+        dtype = np.uint8 if binary else np.float32
+        query_desc = np.asarray(query_desc, dtype=dtype)
+        db_desc = np.asarray(db_desc, dtype=dtype)
         
-        matcher = self.bf if self.method == 'BF' else self.flann
+        matcher = self._knn_matcher(binary)
 
         try:
-            matches = matcher.knnMatch(query_desc, db_desc, k=2)
+            with stage("match.knn"):
+                matches = matcher.knnMatch(query_desc, db_desc, k=2)
             
             good_matches = []
             # Tinh chỉnh: Nới lỏng ratio test từ 0.75 lên 0.8 để bắt được nhiều điểm hơn
             ratio_thresh = 0.8 
-            for m, n in matches:
-                if m.distance < ratio_thresh * n.distance:
-                    good_matches.append(m)
+            with stage("match.ratio_test"):
+                # LSH có thể trả về ít hơn 2 láng giềng
+                for row in matches:
+                    if len(row) == 2 and row[0].distance < ratio_thresh * row[1].distance:
+                        good_matches.append(row[0])
             
             return len(good_matches)
         except Exception:
+            count("match.errors")
             return 0
 
-    def search(self, query_desc, feature_dir, top_n=5):
-        results = [] 
-        feat_path = Path(feature_dir)
-        csv_files = list(feat_path.glob('*.csv'))
-
-        print(f"Đang so khớp với {len(csv_files)} files trong CSDL...")
-
-        for csv_file in csv_files:
-            descriptors = []
-            original_path = ""
-            try:
-                with open(csv_file, 'r') as f:
-                    reader = csv.reader(f)
-                    header = next(reader, None)
-                    if header and header[0] == "ORIGINAL_PATH":
-                        original_path = header[1]
-                    else:
-                        continue 
-
-                    for row in reader:
-                        descriptors.append([float(x) for x in row])
-                
-                if not descriptors: continue
-
-                db_desc = np.array(descriptors, dtype=np.float32)
-                score = self.match(query_desc, db_desc)
-                
-                # Giảm ngưỡng lọc xuống > 4 matches
-                if score > 4: 
-                    results.append((original_path, score))
-
-            except Exception as e:
-                print(f"Lỗi: {e}")
-                continue
-
-        results.sort(key=lambda x: x[1], reverse=True)
-        return results[:top_n]
+    def match_batch(self, query_desc, db_descs):
+        """Số match tốt của query với từng ảnh trong db_descs (mảng int64)"""
+        if self.method == 'NUMPY':
+            count("match.images", len(db_descs))
+            with stage("match.numpy"):
+                return ratio_match_counts(query_desc, db_descs)
+        return np.array([self.match(query_desc, db_desc) for db_desc in db_descs], dtype=np.int64)
+
+    def match_many(self, query_descs, db_desc, ratio_thresh=0.8):
+        """
+        Số match tốt của nhiều truy vấn với một ảnh CSDL (mảng int64 dài len(query_descs)).
+        Descriptor các truy vấn được xếp chồng nên chỉ cần một lần knnMatch cho mỗi ảnh CSDL
+        (với FLANN: chỉ dựng KD-tree của ảnh đó một lần thay vì mỗi truy vấn một lần).
+        """
+        scores = np.zeros(len(query_descs), dtype=np.int64)
+        lengths = [0 if q is None else len(q) for q in query_descs]
+        # knnMatch k=2 với ảnh ít hơn 2 descriptor không cho được cặp (m, n) -> 0 như match()
+        if db_desc is None or len(db_desc) < 2 or sum(lengths) == 0:
+            return scores
+        count("match.images")
+        count("match.descriptors_compared", sum(lengths) * len(db_desc))
+        if self.method == 'NUMPY':
+            with stage("match.numpy"):
+                return ratio_match_counts_many(query_descs, [db_desc])[:, 0]
+
+        # Theo truy vấn: kho SIFT mã hoá 'uint8' cũng là mảng uint8
+        binary = is_binary(next(q for q in query_descs if q is not None and len(q) > 0))
+        dtype = np.uint8 if binary else np.float32
+        query = np.vstack([np.asarray(q, dtype=dtype) for q in query_descs
+                           if q is not None and len(q) > 0])
+        matcher = self._knn_matcher(binary)
+        try:
+            with stage("match.knn"):
+                matches = matcher.knnMatch(query, np.asarray(db_desc, dtype=dtype), k=2)
+        except Exception:
+            count("match.errors")
+            return scores
+
+        with stage("match.ratio_test"):
+            query_ids = np.repeat(np.arange(len(query_descs)), lengths)
+            good = [row[0].queryIdx for row in matches
+                    if len(row) == 2 and row[0].distance < ratio_thresh * row[1].distance]
+            np.add.at(scores, query_ids[good], 1)
+        return scores
+
+    def get_database(self, feature_dir):
+        """
+        Trả về CSDL đặc trưng thường trú cho feature_dir (nạp lần đầu, các lần sau chỉ
+        nạp lại phần thay đổi). Giữ nguyên ImageMatcher giữa các truy vấn để tận dụng.
+        """
+        if isinstance(feature_dir, FeatureDatabase):
+            db = feature_dir
+        else:
+            key = str(Path(feature_dir).resolve())
+            db = self._databases.get(key)
+            if db is None:
+                db = FeatureDatabase(feature_dir)
+                self._databases[key] = db
+        # Mỗi kho một bộ tham số FLANN; kiểm tra lại mỗi lần để nhận flann_params.json mới
+        self.load_tuned_flann(db.feature_dir)
+        db.refresh()
+        return db
+
+    def get_global_index(self, db):
+        """Chỉ mục kNN toàn cục của db, chỉ dựng lại khi CSDL hoặc tham số FLANN của nó thay đổi"""
+        self.load_tuned_flann(db.feature_dir)
+        cached = self._global_indexes.get(db)
+        if cached is not None and cached[:2] == (db.version, self.flann_params):
+            return cached[2]
+        with stage("global.build"):
+            index = GlobalIndex(db.items(), method=self.method, k=self.global_k, binary=db.codec.is_binary,
+                                **self.flann_params)
+        self._global_indexes[db] = (db.version, self.flann_params, index)
+        return index
+
+    def _rank_global(self, query_descs, db):
+        index = self.get_global_index(db)
+        scores = index.vote_many(query_descs)
+        return [_score_results(index.paths, row) for row in scores]
+
+    def get_bow_index(self, db):
+        """BoW index của db (nạp từ feature_dir/bow/ hoặc dựng lại khi CSDL thay đổi)"""
+        if db.codec.is_binary:
+            raise ValueError("mode='bow' chưa hỗ trợ descriptor nhị phân (ORB / AKAZE)")
+        cached = self._bow_indexes.get(db)
+        if cached is not None and cached[0] == db.version:
+            return cached[1]
+        with stage("bow.load"):
+            index = load_or_build_bow_index(db, n_words=self.bow_words)
+        self._bow_indexes[db] = (db.version, index)
+        return index
+
+    def _rank_bow(self, query_descs, db):
+        index = self.get_bow_index(db)
+        cached = self._bow_descs.get(db)
+        if cached is None or cached[0] != db.version:
+            cached = self._bow_descs[db] = (db.version, dict(db.items()))
+        descs_by_path = cached[1]
+        all_results = []
+        for query_desc in query_descs:
+            # Danh sách ứng viên khác nhau theo từng truy vấn
+            with stage("bow.query"):
+                candidates, _ = index.query(query_desc, shortlist=self.shortlist)
+            count("bow.candidates", len(candidates))
+
+            # Chỉ so khớp lại (ratio test) các ứng viên trong danh sách ngắn
+            results = []
+            for i in candidates:
+                path = index.paths[i]
+                score = self.match(query_desc, descs_by_path.get(path))
+                if score > 4:
+                    results.append((path, score))
+            all_results.append(results)
+        return all_results
+
+    def _score_matrix(self, query_descs, db_descs):
+        """Số match tốt của từng truy vấn với từng ảnh (mảng int64 (len(query_descs), len(db_descs)))"""
+        if self.method == 'NUMPY':
+            count("match.images", len(db_descs))
+            count("match.descriptors_compared", sum(0 if q is None else len(q) for q in query_descs) *
+                  sum(0 if d is None else len(d) for d in db_descs))
+            with stage("match.numpy"):
+                return ratio_match_counts_many(query_descs, db_descs)
+        # Duyệt CSDL một lần, mỗi ảnh so khớp với cả loạt truy vấn
+        scores = np.zeros((len(query_descs), len(db_descs)), dtype=np.int64)
+        for j, db_desc in enumerate(db_descs):
+            scores[:, j] = self.match_many(query_descs, db_desc)
+        return scores
+
+    def _rank_scan(self, query_descs, db):
+        items = db.items()
+        scores = self._score_matrix(query_descs, [db_desc for _, db_desc in items])
+        return [_score_results([path for path, _ in items], row) for row in scores]
+
+    def _rank_coarse(self, query_descs, db, keep):
+        """
+        Tìm kiếm hai tầng. Tầng thô: so khớp coarse_keypoints descriptor đầu của truy vấn với
+        coarse_keypoints descriptor đầu của mọi ảnh (kho được index với coarse_keypoints nên đó là
+        các keypoint có response mạnh nhất). Tầng tinh: so khớp đầy đủ như scan, chỉ với
+        max(keep, coarse_keep * số ảnh) ảnh có điểm thô cao nhất. Điểm trả về là điểm đầy đủ,
+        giống scan nếu các ảnh top-N đều lọt qua tầng thô.
+        """
+        indexed = (getattr(db, "params", None) or {}).get("coarse_keypoints")
+        if not indexed:
+            raise ValueError("mode='coarse' cần kho được index với FeatureExtractor(coarse_keypoints=...)")
+        k = self.coarse_keypoints or indexed
+        items = db.items()
+        with stage("coarse.score"):
+            coarse_scores = self._score_matrix(
+                [None if q is None else q[:k] for q in query_descs],
+                [None if d is None else d[:k] for _, d in items])
+
+        n_fine = min(len(items), max(keep, math.ceil(self.coarse_keep * len(items))))
+        ranks = _path_ranks([path for path, _ in items])
+        all_results = []
+        for query_desc, row in zip(query_descs, coarse_scores):
+            # Cùng điểm thô thì đường dẫn nhỏ hơn được chọn, như thứ tự cuối của search_many
+            candidates = np.sort(np.lexsort((ranks, -row))[:n_fine])
+            count("coarse.candidates", len(candidates))
+            with stage("coarse.fine"):
+                scores = self.match_batch(query_desc, [items[j][1] for j in candidates])
+            all_results.append(_score_results([items[j][0] for j in candidates], scores))
+        return all_results
+
+    def _rank_prune(self, query_descs, db, keep):
+        items = db.items()
+        return [self._prune_search(query_desc, items, keep) for query_desc in query_descs]
+
+    def _prune_search(self, query_desc, items, keep):
+        """
+        Top-`keep` của scan cho một truy vấn, bỏ qua các ảnh chắc chắn không lọt top.
+
+        Mỗi descriptor truy vấn đóng góp nhiều nhất 1 match, nên với một ảnh đã so được một phần:
+            điểm đã có <= điểm cuối <= điểm đã có + số descriptor truy vấn chưa so.
+        1. Khối descriptor đầu tiên được so với mọi ảnh -> điểm một phần.
+        2. `keep` ảnh có điểm một phần cao nhất được so hết -> ngưỡng top-`keep` ban đầu.
+        3. Các khối còn lại chỉ so với những ảnh có cận trên còn vượt được phần tử thứ `keep`
+           (theo cận dưới) của tất cả ảnh; mỗi khối là một lần match_batch cho các ảnh còn lại.
+
+        (Cận min(số descriptor truy vấn, số descriptor ảnh) không dùng được: nhiều descriptor truy vấn
+        có thể cùng match tới một descriptor của ảnh.)
+        """
+        if query_desc is None or len(query_desc) == 0:
+            return []
+        n_rows = len(query_desc)
+        bounds = np.linspace(0, n_rows, min(self.prune_chunks, n_rows) + 1).astype(int)
+        # knnMatch k=2 với ảnh ít hơn 2 descriptor không cho được cặp (m, n) -> luôn 0 điểm
+        ids = [j for j, (_, db_desc) in enumerate(items) if db_desc is not None and len(db_desc) >= 2]
+        if not ids:
+            return []
+
+        with stage("prune.first_chunk"):
+            scores = self.match_batch(query_desc[:bounds[1]], [items[j][1] for j in ids])
+
+        # Khoá xếp hạng (điểm, -thứ hạng đường dẫn): cùng điểm thì đường dẫn nhỏ hơn được ưu tiên,
+        # đúng thứ tự của search_many, không phụ thuộc vị trí ảnh trong kho
+        ranks = _path_ranks([items[j][0] for j in ids])
+        order = sorted(range(len(ids)), key=lambda i: (-scores[i], ranks[i]))
+        with stage("prune.fill"):
+            if len(bounds) > 2:
+                rest = query_desc[bounds[1]:]
+                for i in order[:keep]:
+                    scores[i] += self.match(rest, items[ids[i]][1])
+        pending = order[keep:]
+
+        with stage("prune.refine"):
+            for c in range(1, len(bounds) - 1):
+                if not pending:
+                    break
+                remaining = n_rows - bounds[c]
+                threshold = None
+                if len(ids) > keep:
+                    threshold = heapq.nlargest(keep, ((scores[i], -ranks[i]) for i in range(len(ids))))[-1]
+                alive = [i for i in pending if scores[i] + remaining > 4 and
+                         (threshold is None or (scores[i] + remaining, -ranks[i]) >= threshold)]
+                count("prune.skipped_images", len(pending) - len(alive))
+                count("prune.skipped_rows", (len(pending) - len(alive)) * remaining)
+                if alive:
+                    chunk = query_desc[bounds[c]:bounds[c + 1]]
+                    scores[alive] += self.match_batch(chunk, [items[ids[i]][1] for i in alive])
+                pending = alive
+
+        # Ảnh bị bỏ dở có cận trên thấp hơn ngưỡng nên không bao giờ lọt vào đây
+        top = heapq.nlargest(keep, ((int(scores[i]), -ranks[i], ids[i]) for i in range(len(ids)) if scores[i] > 4))
+        return [(items[j][0], score) for score, _, j in top]
+
+    def _rank_stream(self, query_descs, store, keep):
+        """
+        Duyệt kho theo khối (FeatureStore.iter_chunks), mỗi khối so khớp với mọi truy vấn,
+        mỗi truy vấn giữ một min-heap `keep` kết quả tốt nhất. Trong lúc so khớp một khối,
+        một luồng nền đọc khối kế tiếp, nên bộ nhớ tối đa ~ 2 khối = stream_memory_mb.
+        Kết quả giống hệt scan (cùng điểm thì đường dẫn nhỏ hơn được ưu tiên).
+        """
+        chunk_bytes = self.stream_memory_mb * 2 ** 20 // 2
+        ranks = _path_ranks(store.paths)
+        heaps = [[] for _ in query_descs]
+        for chunk in _read_ahead(store.iter_chunks(chunk_bytes)):
+            ids = [idx for idx, _ in chunk]
+            with stage("stream.match"):
+                scores = self._score_matrix(query_descs, [descs for _, descs in chunk])
+            for heap, row in zip(heaps, scores):
+                for j in np.flatnonzero(row > 4):
+                    entry = (int(row[j]), -int(ranks[ids[j]]), ids[j])
+                    if len(heap) < keep:
+                        heapq.heappush(heap, entry)
+                    elif entry > heap[0]:
+                        heapq.heapreplace(heap, entry)
+        return [[(store.paths[idx], score) for score, _, idx in sorted(heap, reverse=True)]
+                for heap in heaps]
+
+    def _verify_results(self, results, query_kps, query_desc, get_entry, top_n):
+        # Kiểm chứng RANSAC tối đa verify_top_k ứng viên đầu.
+        # get_entry(path) -> (descriptors, keypoints) của ảnh CSDL
+        query_kps = keypoints_to_array(query_kps)
+
+        matcher = self.bf_hamming if is_binary(query_desc) else self.bf
+
+        def verify_fn(path):
+            db_desc, db_kps = get_entry(path)
+            if db_kps is None:
+                # Kho cũ (CSV / chưa lưu keypoint): không kiểm chứng được, giữ điểm thô
+                return None
+            return verify(query_kps, query_desc, db_kps, db_desc, model=self.verify, matcher=matcher)
+
+        # Dừng sớm chỉ khi điểm thô là số match chính xác (BF / NUMPY) -> inlier <= điểm thô
+        early_stop = self.method in ('BF', 'NUMPY') and self.mode in ('scan', 'prune', 'stream', 'coarse')
+        verified, n_checked = rerank(results[:self.verify_top_k], verify_fn, top_n, early_stop=early_stop)
+        print(f"Kiểm chứng hình học {n_checked}/{min(len(results), self.verify_top_k)} ứng viên")
+        return [(path, inliers) for path, inliers in verified if inliers > 4]
+
+    def search(self, query_desc, feature_dir, top_n=5, query_kps=None):
+        """
+        Tìm top_n ảnh giống nhất. Trả về danh sách (đường dẫn ảnh gốc, điểm) giảm dần.
+        Điểm là số match tốt, hoặc số inlier hình học nếu bật verify và có query_kps.
+        """
+        return self.search_many([query_desc], feature_dir, top_n=top_n, query_kps=[query_kps])[0]
+
+    def search_many(self, query_descs, feature_dir, top_n=5, query_kps=None):
+        """
+        Tìm kiếm cho nhiều truy vấn cùng lúc: CSDL được nạp và duyệt một lần cho cả loạt
+        (scan: mỗi ảnh CSDL so khớp với mọi truy vấn; global: một lần kNN cho mọi descriptor truy vấn).
+
+        Args:
+            query_descs: danh sách descriptor của từng truy vấn (None = không có đặc trưng)
+            query_kps: danh sách keypoint tương ứng (cho verify), hoặc None
+        Returns:
+            danh sách kết quả, phần tử i giống search(query_descs[i], ...)
+        """
+        with stage("search.total"):
+            # feature_dir có thể là đường dẫn hoặc một FeatureDatabase đã nạp sẵn
+            if self.mode == 'stream':
+                # Không nạp CSDL: chỉ đọc manifest + offsets, descriptor được đọc theo khối
+                if isinstance(feature_dir, FeatureDatabase):
+                    feature_dir = feature_dir.feature_dir
+                if not is_store(feature_dir):
+                    raise ValueError("mode='stream' cần kho đặc trưng nhị phân (xem feature_store.py)")
+                with stage("search.load_db"):
+                    db = FeatureStore(feature_dir)
+                self.load_tuned_flann(feature_dir)
+                get_entry = db.get_entry
+            else:
+                with stage("search.load_db"):
+                    db = self.get_database(feature_dir)
+                descs_by_path = None
+
+                def get_entry(path):
+                    nonlocal descs_by_path
+                    if descs_by_path is None:
+                        descs_by_path = dict(db.items())
+                    return descs_by_path[path], db.get_keypoints(path)
+            print(f"Đang so khớp {len(query_descs)} truy vấn với {len(db)} ảnh trong CSDL...")
+            count("search.queries", len(query_descs))
+            if len(db) == 0:
+                # Kho rỗng (vd. build với PCA khi chưa có ảnh: codec chưa huấn luyện) -> không có kết quả
+                return [[] for _ in query_descs]
+            # Đưa truy vấn về cùng không gian với kho (vd. chiếu PCA)
+            with stage("search.prepare_query"):
+                _check_compatible(query_descs, db)
+                query_descs = [db.codec.prepare_query(query_desc) for query_desc in query_descs]
+                _check_compatible(query_descs, db, prepared=True)
+
+            # Số ứng viên cần giữ: top_n, hoặc verify_top_k nếu còn kiểm chứng hình học phía sau
+            keep = max(top_n, self.verify_top_k) if self.verify else top_n
+
+            with stage(f"search.rank.{self.mode}"):
+                if self.mode == 'stream':
+                    all_results = self._rank_stream(query_descs, db, keep)
+                elif self.mode == 'global':
+                    all_results = self._rank_global(query_descs, db)
+                elif self.mode == 'prune' and self.method != 'FLANN':
+                    all_results = self._rank_prune(query_descs, db, keep)
+                elif self.mode == 'bow':
+                    all_results = self._rank_bow(query_descs, db)
+                elif self.mode == 'coarse':
+                    all_results = self._rank_coarse(query_descs, db, keep)
+                else:
+                    all_results = self._rank_scan(query_descs, db)
+
+            if query_kps is None:
+                query_kps = [None] * len(query_descs)
+            for i, results in enumerate(all_results):
+                count("search.candidates", len(results))
+                with stage("search.sort"):
+                    # Heap giới hạn `keep` phần tử thay vì sort cả danh sách.
+                    # Cùng điểm thì xếp theo đường dẫn, để thứ tự không phụ thuộc cách kho được dựng
+                    # (cập nhật tăng dần hay dựng lại từ đầu)
+                    results = heapq.nsmallest(keep, results, key=lambda x: (-x[1], x[0]))
+                if self.verify and query_kps[i] is not None:
+                    with stage("search.verify"):
+                        results = self._verify_results(results, query_kps[i], query_descs[i], get_entry,
+                                                       top_n)
+                all_results[i] = results[:top_n]
+            return all_results
+
+
+def _check_compatible(query_descs, db, prepared=False):
+    # Không bao giờ so khớp descriptor của hai loại khác nhau (vd. truy vấn ORB với kho SIFT):
+    # kiểu nhị phân / số thực phải khớp với kho, số chiều phải khớp sau khi prepare_query
+    for query_desc in query_descs:
+        if query_desc is None or len(query_desc) == 0:
+            continue
+        if is_binary(query_desc) != db.codec.is_binary or (prepared and db.dim is not None
+                                                           and query_desc.shape[1] != db.dim):
+            kind = "nhị phân" if is_binary(query_desc) else "số thực"
+            raise ValueError(f"Descriptor truy vấn ({kind}, {query_desc.shape[1]} chiều) không tương thích với "
+                             f"kho {db.algo} ({db.codec.encoding}, {db.dim} chiều). Hãy trích xuất truy vấn "
+                             f"bằng FeatureExtractor.from_index(feature_dir)")
+
+
+def _read_ahead(chunks):
+    # Đọc trước một khối trên luồng nền (đọc file nhả GIL) trong lúc khối hiện tại được so khớp
+    chunks = iter(chunks)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(bind(next), chunks, None)
+        while True:
+            chunk = future.result()
+            if chunk is None:
+                return
+            future = pool.submit(bind(next), chunks, None)
+            yield chunk
+
+
+def _path_ranks(paths):
+    # Thứ hạng của từng đường dẫn theo thứ tự sắp xếp, dùng để phá hoà điểm
+    ranks = np.empty(len(paths), dtype=np.int64)
+    ranks[sorted(range(len(paths)), key=paths.__getitem__)] = np.arange(len(paths))
+    return ranks
+
+
+def _score_results(paths, scores):
+    # Giảm ngưỡng lọc xuống > 4 matches
+    return [(paths[i], int(scores[i])) for i in np.flatnonzero(scores > 4)]
 
 if __name__ == "__main__":
     # Test matching
     from feature_extraction import FeatureExtractor
     
-    matcher = ImageMatcher(method='BFMatcher')
-    extractor = FeatureExtractor(method='SIFT')
+    feature_dir = "../features"
+    matcher = ImageMatcher(method='BF')
+    # Truy vấn phải được trích xuất với đúng cấu hình đã index
+    extractor = FeatureExtractor.from_index(feature_dir)
     
     # Test với 1 ảnh truy vấn
     query_image = "../data/test.jpg"
     
     try:
         # Trích xuất features từ query image
-        kp, desc = extractor.extract_from_path(query_image)
+        kp, desc = extractor.extract(extractor.preprocess(query_image))
         print(f"Trích xuất query image: {len(kp)} keypoints")
         
         # Tìm kiếm ảnh tương tự
-        results = matcher.search_similar_images(desc, "../features", top_n=5)
+        results = matcher.search(desc, feature_dir, top_n=5, query_kps=kp)
         
         print(f"\nTop 5 ảnh tương tự:")
         for idx, (img_name, score) in enumerate(results, 1):
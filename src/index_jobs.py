@@ -0,0 +1,137 @@
+"""
+Index chạy nền cho giao diện (Streamlit)
+
+process_dataset chạy trên một luồng nền nên giao diện không bị chặn; người dùng vẫn tìm kiếm được
+trên kho cũ trong suốt quá trình index. Kho mới chỉ được "đổi vào" khi manifest mới thay thế
+manifest cũ bằng os.replace (xem feature_store.StoreWriter) - dịch vụ tìm kiếm tự nạp lại ở truy vấn kế tiếp.
+Huỷ giữa chừng (IndexJob.cancel()) bỏ segment đang ghi dở, kho cũ giữ nguyên.
+
+Sau khi index xong, job tạo luôn thumbnail cho trang kết quả (xem thumbnails.py).
+
+Mỗi feature_dir chỉ có một job chạy tại một thời điểm:
+    job = start_job(FeatureExtractor(), "data", "features")
+    job.status()     # {"state": "running", "phase": "extract", "done": 120, "total": 400, ...}
+    job.cancel()
+"""
+
+import itertools
+import threading
+import time
+import traceback
+from pathlib import Path
+from feature_extraction import IndexingCancelled
+from thumbnails import build_thumbnails
+
+# Trạng thái của một job
+PENDING, RUNNING, DONE, CANCELLED, FAILED = "pending", "running", "done", "cancelled", "failed"
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_ids = itertools.count(1)
+
+
+class IndexJob:
+    """Một lần process_dataset (+ tạo thumbnail) chạy trên luồng nền, có tiến độ và huỷ được"""
+
+    def __init__(self, extractor, data_dir, feature_dir, thumbnails=True, **kwargs):
+        """
+        Args:
+            extractor: FeatureExtractor với cấu hình cần index
+            thumbnails: tạo thumbnail sau khi index xong
+            kwargs: truyền thẳng cho process_dataset (workers, incremental, skip_duplicates...)
+        """
+        self.id = next(_ids)
+        self.extractor = extractor
+        self.data_dir = data_dir
+        self.feature_dir = feature_dir
+        self.thumbnails = thumbnails
+        self.kwargs = kwargs
+        self.state = PENDING
+        self.phase = None
+        self.done = 0
+        self.total = 0
+        self.report = None
+        self.thumbnail_report = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f"index-job-{self.id}", daemon=True)
+
+    @property
+    def running(self):
+        return self.state in (PENDING, RUNNING)
+
+    def start(self):
+        self.started = time.time()
+        self.state = RUNNING
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """Yêu cầu dừng; job dừng sau ảnh đang xử lý (xem wait())"""
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _progress(self, done, total):
+        with self._lock:
+            self.done, self.total = done, total
+
+    def _set_phase(self, phase):
+        with self._lock:
+            self.phase, self.done, self.total = phase, 0, 0
+
+    def _run(self):
+        try:
+            self._set_phase("extract")
+            self.report = self.extractor.process_dataset(
+                self.data_dir, self.feature_dir, progress=self._progress, cancel=self._cancel, **self.kwargs)
+            if self.thumbnails and not self._cancel.is_set():
+                # Kho mới đã được đổi vào; thumbnail còn thiếu được get_thumbnail() tạo khi hiển thị
+                self._set_phase("thumbnails")
+                self.thumbnail_report = build_thumbnails(self.data_dir, self.feature_dir,
+                                                         progress=self._progress, cancel=self._cancel)
+            self.state = DONE
+        except IndexingCancelled:
+            self.state = CANCELLED
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+            self.state = FAILED
+        finally:
+            self.finished = time.time()
+
+    def status(self):
+        """Ảnh chụp trạng thái (dict) để hiển thị"""
+        with self._lock:
+            status = {"id": self.id, "state": self.state, "phase": self.phase,
+                      "done": self.done, "total": self.total}
+        status["elapsed"] = round((self.finished or time.time()) - self.started, 1) if self.started else 0.0
+        status["report"] = self.report
+        status["thumbnails"] = self.thumbnail_report
+        status["error"] = self.error
+        return status
+
+
+def _key(feature_dir):
+    return str(Path(feature_dir).resolve())
+
+
+def start_job(extractor, data_dir, feature_dir, **kwargs):
+    """Bắt đầu index nền cho feature_dir; RuntimeError nếu đã có job đang chạy trên kho đó"""
+    with _jobs_lock:
+        current = _jobs.get(_key(feature_dir))
+        if current is not None and current.running:
+            raise RuntimeError(f"Đang có job index #{current.id} chạy trên {feature_dir}")
+        job = _jobs[_key(feature_dir)] = IndexJob(extractor, data_dir, feature_dir, **kwargs)
+    return job.start()
+
+
+def current_job(feature_dir):
+    """Job gần nhất của feature_dir (đang chạy hoặc đã kết thúc), None nếu chưa có"""
+    with _jobs_lock:
+        return _jobs.get(_key(feature_dir))
@@ -0,0 +1,137 @@
+"""
+Đo thời gian theo từng giai đoạn + bộ đếm, tuỳ chọn cProfile
+
+Các module gọi stage("tên") / count("tên") ở những chỗ quan trọng (giải mã, CLAHE, SIFT,
+nạp CSDL, knnMatch, sắp xếp...). Khi không có collect() nào đang chạy thì hai hàm này gần như
+không tốn gì. Muốn đo thì bọc đoạn code bằng collect():
+
+    with collect() as stats:
+        matcher.search(query_desc, FEATURE_DIR)
+    print(stats.report())
+
+Thời gian của các giai đoạn lồng nhau được tính chồng lên nhau (vd. search.rank gồm cả match.knn).
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import io
+import pstats
+import threading
+import time
+
+_current = contextvars.ContextVar("instrumentation_stats", default=None)
+
+
+class Stats:
+    """Thời gian từng giai đoạn (tổng giây, số lần gọi) và các bộ đếm"""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.profile_text = None
+        # Các luồng đọc trước (xem preprocessing.iter_preprocessed) ghi vào cùng một Stats
+        self._lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            total, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, calls + 1)
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        for name, (seconds, calls) in other.stages.items():
+            with self._lock:
+                total, old_calls = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (total + seconds, old_calls + calls)
+        for name, n in other.counters.items():
+            self.incr(name, n)
+
+    def to_dict(self):
+        return {
+            "stages": {name: {"seconds": round(total, 6), "calls": calls}
+                       for name, (total, calls) in self.stages.items()},
+            "counters": dict(self.counters),
+        }
+
+    def report(self):
+        """Bảng văn bản: giai đoạn, tổng ms, số lần gọi, ms trung bình; sau đó là các bộ đếm"""
+        lines = [f"{'Giai đoạn':<28}{'tổng ms':>12}{'lần':>8}{'ms/lần':>10}"]
+        for name, (total, calls) in self.stages.items():
+            lines.append(f"{name:<28}{total * 1000:>12.2f}{calls:>8}{total * 1000 / calls:>10.3f}")
+        for name, n in self.counters.items():
+            lines.append(f"{name:<28}{n:>12}")
+        if self.profile_text:
+            lines.append("")
+            lines.append(self.profile_text)
+        return "\n".join(lines)
+
+
+def current():
+    """Stats đang thu thập (None nếu không có collect() nào)"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def collect(profile=False, profile_lines=25):
+    """
+    Thu thập số liệu cho đoạn code bên trong, trả về đối tượng Stats.
+    profile=True: chạy kèm cProfile, top `profile_lines` hàm theo cumulative time nằm trong
+    stats.profile_text. Nếu lồng trong một collect() khác thì số liệu được cộng dồn lên cấp ngoài.
+    """
+    stats = Stats()
+    parent = _current.get()
+    token = _current.set(stats)
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield stats
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(profile_lines)
+            stats.profile_text = out.getvalue()
+        _current.reset(token)
+        if parent is not None:
+            parent.merge(stats)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Cộng thời gian chạy của khối lệnh vào giai đoạn `name`"""
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_time(name, time.perf_counter() - start)
+
+
+def count(name, n=1):
+    """Tăng bộ đếm `name` (không làm gì nếu không có collect() nào đang chạy)"""
+    stats = _current.get()
+    if stats is not None:
+        stats.incr(name, n)
+
+
+def bind(fn):
+    """Bọc fn để khi chạy trên luồng khác vẫn ghi số liệu vào Stats đang thu thập ở luồng hiện tại"""
+    stats = _current.get()
+    if stats is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = _current.set(stats)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
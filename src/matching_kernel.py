@@ -0,0 +1,197 @@
+"""
+Nhân so khớp vector hoá bằng NumPy
+
+Thay cho knnMatch + vòng lặp Python qua từng DMatch: khoảng cách L2 bình phương giữa truy vấn
+và nhiều ảnh CSDL được tính cùng lúc bằng phép nhân ma trận theo khối,
+láng giềng gần nhất / gần nhì trong từng ảnh lấy bằng reduceat, ratio test làm trên mảng.
+
+Với descriptor SIFT (giá trị nguyên 0..255) mọi tổng trong phép nhân ma trận float32 đều là
+số nguyên < 2^24 nên khoảng cách được tính chính xác; ratio test được so sánh trên khoảng cách
+đã lấy căn (float32) giống hệt BFMatcher, nên số match trùng với đường BF.
+
+Descriptor nhị phân (ORB / AKAZE, uint8 bit đã đóng gói) được bung thành vector 0/1: khoảng cách
+L2 bình phương giữa hai vector bit chính là khoảng cách Hamming, nên dùng chung phép nhân ma trận;
+ratio test khi đó so trực tiếp khoảng cách Hamming như BFMatcher(NORM_HAMMING).
+"""
+
+import numpy as np
+
+# Số phần tử tối đa của một khối ma trận khoảng cách (n_query x n_db_rows), ~32MB float32
+DEFAULT_BLOCK_ELEMS = 1 << 23
+
+
+def is_binary(descs):
+    """Descriptor nhị phân (bit đã đóng gói) được biểu diễn bằng mảng uint8"""
+    return descs is not None and np.asarray(descs).dtype == np.uint8
+
+
+def _as_matrix(descs, binary):
+    # Ma trận float32 để tính khoảng cách (bung bit với descriptor nhị phân)
+    if binary:
+        return np.unpackbits(np.asarray(descs, dtype=np.uint8), axis=1).astype(np.float32)
+    return np.ascontiguousarray(descs, dtype=np.float32)
+
+
+def _squared_norms(x):
+    return np.einsum('ij,ij->i', x, x)
+
+
+def _block_good(query, q_norms, descs_list, ratio_thresh, binary=False):
+    # Ma trận bool (n_query, số ảnh): descriptor truy vấn có match tốt với ảnh hay không
+    # (mỗi ảnh có ít nhất 2 descriptor)
+    counts = np.array([len(d) for d in descs_list], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    db = _as_matrix(np.vstack(descs_list), binary)
+
+    dist = q_norms[:, None] + _squared_norms(db)[None, :] - 2.0 * (query @ db.T)
+    np.maximum(dist, 0, out=dist)
+
+    # Láng giềng gần nhất trong từng ảnh
+    best = np.minimum.reduceat(dist, starts, axis=1)
+    best_cols = np.repeat(best, counts, axis=1)
+    is_best = dist <= best_cols
+    n_best = np.add.reduceat(is_best, starts, axis=1)
+
+    # Láng giềng gần nhì: che vị trí gần nhất rồi lấy min lần nữa (trùng khoảng cách thì n = m)
+    dist[is_best] = np.inf
+    second = np.minimum.reduceat(dist, starts, axis=1)
+    second = np.where(n_best >= 2, best, second)
+
+    if binary:
+        # Khoảng cách Hamming (số nguyên, không lấy căn)
+        return best.astype(np.float64) < ratio_thresh * second.astype(np.float64)
+    # So sánh trên khoảng cách đã lấy căn giống BFMatcher: m.distance < ratio * n.distance
+    m = np.sqrt(best).astype(np.float64)
+    n = np.sqrt(second).astype(np.float64)
+    return m < ratio_thresh * n
+
+
+def _scan_blocks(n_query_rows, descs_list, block_elems, score_block):
+    # Gom các ảnh liên tiếp thành khối sao cho ma trận khoảng cách <= block_elems phần tử,
+    # gọi score_block(chỉ số ảnh, descriptors) cho từng khối
+    max_rows = max(block_elems // n_query_rows, 2)
+    block_ids, block_descs, block_rows = [], [], 0
+    for idx, descs in enumerate(descs_list):
+        if descs is None or len(descs) < 2:
+            continue
+        if block_ids and block_rows + len(descs) > max_rows:
+            score_block(block_ids, block_descs)
+            block_ids, block_descs, block_rows = [], [], 0
+        block_ids.append(idx)
+        block_descs.append(descs)
+        block_rows += len(descs)
+    if block_ids:
+        score_block(block_ids, block_descs)
+
+
+def ratio_match_counts(query_desc, descs_list, ratio_thresh=0.8, block_elems=DEFAULT_BLOCK_ELEMS):
+    """
+    Số match vượt ratio test giữa query_desc và từng ảnh trong descs_list, trong một lần gọi.
+
+    Args:
+        query_desc: (n_query, dim)
+        descs_list: danh sách ma trận descriptor của các ảnh CSDL
+        block_elems: giới hạn kích thước ma trận khoảng cách của mỗi khối
+
+    Returns:
+        mảng int64 độ dài len(descs_list). Ảnh có ít hơn 2 descriptor được 0 điểm
+        (knnMatch k=2 không cho được cặp (m, n), giống ImageMatcher.match).
+    """
+    scores = np.zeros(len(descs_list), dtype=np.int64)
+    if query_desc is None or len(query_desc) == 0:
+        return scores
+
+    binary = is_binary(query_desc)
+    query = _as_matrix(query_desc, binary)
+    q_norms = _squared_norms(query)
+
+    def score_block(ids, descs):
+        scores[ids] = _block_good(query, q_norms, descs, ratio_thresh, binary).sum(axis=0)
+
+    _scan_blocks(len(query), descs_list, block_elems, score_block)
+    return scores
+
+
+def ratio_match_counts_many(query_descs, descs_list, ratio_thresh=0.8,
+                            block_elems=DEFAULT_BLOCK_ELEMS, max_query_rows=None):
+    """
+    Như ratio_match_counts nhưng cho nhiều truy vấn: descriptor của các truy vấn được xếp chồng
+    thành một ma trận, CSDL chỉ được duyệt một lần cho mỗi nhóm tối đa max_query_rows dòng truy vấn
+    (mặc định block_elems / 1024), rồi số match được cộng lại theo từng truy vấn.
+
+    Returns:
+        mảng int64 (len(query_descs), len(descs_list)), dòng i giống hệt
+        ratio_match_counts(query_descs[i], descs_list)
+    """
+    scores = np.zeros((len(query_descs), len(descs_list)), dtype=np.int64)
+    max_query_rows = max_query_rows or max(block_elems >> 10, 1)
+
+    # Chia các truy vấn khác rỗng thành nhóm liên tiếp có tổng số dòng <= max_query_rows
+    groups, group, group_rows = [], [], 0
+    for qi, query_desc in enumerate(query_descs):
+        if query_desc is None or len(query_desc) == 0:
+            continue
+        if group and group_rows + len(query_desc) > max_query_rows:
+            groups.append(group)
+            group, group_rows = [], 0
+        group.append(qi)
+        group_rows += len(query_desc)
+    if group:
+        groups.append(group)
+
+    for group in groups:
+        binary = is_binary(query_descs[group[0]])
+        query = _as_matrix(np.vstack([query_descs[qi] for qi in group]), binary)
+        q_norms = _squared_norms(query)
+        q_starts = np.concatenate([[0], np.cumsum([len(query_descs[qi]) for qi in group])[:-1]])
+
+        def score_block(ids, descs):
+            good = _block_good(query, q_norms, descs, ratio_thresh, binary)
+            # Cộng số match theo đoạn dòng của từng truy vấn
+            scores[np.ix_(group, ids)] = np.add.reduceat(good, q_starts, axis=0)
+
+        _scan_blocks(len(query), descs_list, block_elems, score_block)
+    return scores
+
+
+def knn(query_desc, train_desc, k, block_elems=DEFAULT_BLOCK_ELEMS):
+    """
+    k láng giềng gần nhất (tìm kiếm chính xác, như BFMatcher.knnMatch) của từng descriptor truy vấn
+    trong train_desc. train_desc được duyệt theo khối, mỗi khối chỉ giữ k ứng viên tốt nhất của nó.
+
+    Returns:
+        (indices int64, khoảng cách bình phương float32) kích thước (n_query, min(k, len(train_desc))),
+        sắp tăng dần (bằng nhau thì chỉ số nhỏ trước). Descriptor nhị phân: bình phương khoảng cách Hamming
+    """
+    binary = is_binary(query_desc)
+    query = _as_matrix(query_desc, binary)
+    q_norms = _squared_norms(query)
+    k = min(k, len(train_desc))
+    best_idx = np.empty((len(query), 0), dtype=np.int64)
+    best_dist = np.empty((len(query), 0), dtype=np.float32)
+    rows = max(block_elems // max(len(query), 1), k)
+    for start in range(0, len(train_desc), rows):
+        train = _as_matrix(train_desc[start:start + rows], binary)
+        dist = q_norms[:, None] + _squared_norms(train)[None, :] - 2.0 * (query @ train.T)
+        np.maximum(dist, 0, out=dist)
+        idx = np.broadcast_to(np.arange(start, start + len(train), dtype=np.int64), dist.shape)
+        if len(train) > k:
+            part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            dist = np.take_along_axis(dist, part, axis=1)
+            idx = part + start
+        # Gộp với k ứng viên tốt nhất của các khối trước
+        dist = np.concatenate([best_dist, dist], axis=1)
+        idx = np.concatenate([best_idx, idx], axis=1)
+        if dist.shape[1] > k:
+            part = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            dist = np.take_along_axis(dist, part, axis=1)
+            idx = np.take_along_axis(idx, part, axis=1)
+        best_dist, best_idx = dist, idx
+
+    order = np.lexsort((best_idx, best_dist), axis=1)
+    best_dist = np.take_along_axis(best_dist, order, axis=1)
+    best_idx = np.take_along_axis(best_idx, order, axis=1)
+    if binary:
+        # Với vector bit, L2 bình phương chính là khoảng cách Hamming
+        best_dist = best_dist ** 2
+    return best_idx, best_dist.astype(np.float32)
@@ -0,0 +1,182 @@
+"""
+Dấu vân tay toàn cục (pHash + dHash) để nhận ra ảnh trùng / gần trùng
+
+Mỗi ảnh có một mã 128 bit: 64 bit pHash (dấu của các hệ số DCT tần số thấp so với trung vị)
+nối với 64 bit dHash (so sánh độ sáng các pixel kề nhau). Hai mã được tính trên ảnh xám thu nhỏ
+nên gần như không đổi khi ảnh bị nén lại (JPEG chất lượng khác), đổi kích thước hay đổi định dạng.
+Hai ảnh được coi là gần trùng khi khoảng cách Hamming <= DUPLICATE_DISTANCE.
+
+process_dataset lưu mã của từng ảnh trong manifest (sources[đường dẫn]["phash"]), nên
+HashIndex.load(feature_dir) không cần đọc lại ảnh nào. Tìm kiếm: XOR + đếm bit trên cả mảng uint64.
+
+Báo cáo ảnh trùng của một kho:
+    python src/perceptual_hash.py features
+"""
+
+import argparse
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from feature_store import is_store, read_manifest
+from instrumentation import bind, count, stage
+from preprocessing import decode_gray
+
+DUPLICATE_DISTANCE = 6
+# Ảnh được giải mã nhỏ (JPEG giải mã thẳng ở 1/2..1/8) trước khi thu về 32x32 / 9x8
+HASH_DECODE_SIDE = 256
+
+# Số bit 1 của mọi giá trị uint8 (cho numpy cũ chưa có np.bitwise_count)
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(x):
+    # Tổng số bit 1 theo hàng của mảng uint64 (n, k)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x).sum(axis=1, dtype=np.int64)
+    return _POPCOUNT8[x.view(np.uint8)].reshape(len(x), -1).sum(axis=1, dtype=np.int64)
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def phash(gray):
+    """pHash 64 bit: DCT của ảnh 32x32, so 8x8 hệ số tần số thấp với trung vị (bỏ hệ số DC)"""
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    median = np.median(low.ravel()[1:])
+    return _bits_to_int(low > median)
+
+
+def dhash(gray):
+    """dHash 64 bit: pixel bên trái sáng hơn pixel bên phải trên ảnh 9x8"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _bits_to_int(small[:, :-1] > small[:, 1:])
+
+
+def image_hash(source):
+    """
+    Mã 128 bit (pHash << 64 | dHash) của ảnh (đường dẫn, bytes, đối tượng file hoặc ndarray),
+    hoặc None nếu không giải mã được
+    """
+    with stage("phash.compute"):
+        gray = decode_gray(source, HASH_DECODE_SIDE)
+        if gray is None:
+            return None
+        return (phash(gray) << 64) | dhash(gray)
+
+
+def hash_images(images, threads=4):
+    """image_hash của nhiều ảnh trên các luồng nền (giải mã của OpenCV nhả GIL), đúng thứ tự đầu vào"""
+    work = bind(_safe_hash)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(work, images))
+
+
+def _safe_hash(image):
+    try:
+        return image_hash(image)
+    except Exception:
+        count("phash.errors")
+        return None
+
+
+def to_hex(code):
+    return f"{code:032x}"
+
+
+def _to_words(code):
+    return code >> 64, code & 0xFFFFFFFFFFFFFFFF
+
+
+class HashIndex:
+    """Chỉ mục Hamming trên mã 128 bit: mỗi ảnh là 2 số uint64"""
+
+    def __init__(self, paths=(), codes=()):
+        self.paths = list(paths)
+        self._words = np.array([_to_words(code) for code in codes], dtype=np.uint64).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def from_sources(cls, sources):
+        """Từ dict sources của manifest (chỉ các ảnh đã có mã "phash")"""
+        items = [(path, int(source["phash"], 16)) for path, source in sources.items()
+                 if source.get("phash")]
+        return cls([path for path, _ in items], [code for _, code in items])
+
+    @classmethod
+    def load(cls, feature_dir):
+        if not is_store(feature_dir):
+            return cls()
+        return cls.from_sources(read_manifest(feature_dir).get("sources", {}))
+
+    def add(self, path, code):
+        self.paths.append(path)
+        self._words = np.vstack([self._words, np.array([_to_words(code)], dtype=np.uint64)])
+
+    def query(self, code, max_distance=DUPLICATE_DISTANCE):
+        """Các ảnh có khoảng cách Hamming <= max_distance: [(đường dẫn, khoảng cách)] tăng dần"""
+        if code is None or not self.paths:
+            return []
+        with stage("phash.query"):
+            distances = _popcount(self._words ^ np.array(_to_words(code), dtype=np.uint64))
+            hits = np.flatnonzero(distances <= max_distance)
+        count("phash.hits", len(hits))
+        return sorted(((self.paths[i], int(distances[i])) for i in hits), key=lambda x: (x[1], x[0]))
+
+
+def prefilter_results(hits, top_n):
+    """
+    Kết quả tìm kiếm cho ảnh truy vấn gần trùng: (results, prefilter).
+    results = [(đường dẫn, None)] - không có điểm match SIFT, khoảng cách pHash không đặt vào ô điểm;
+    prefilter = {"distance": khoảng cách Hamming gần nhất, "distances": khoảng cách của từng kết quả}
+    """
+    hits = hits[:top_n]
+    return [(path, None) for path, _ in hits], {"distance": hits[0][1], "distances": [d for _, d in hits]}
+
+
+def duplicate_groups(sources, max_distance=DUPLICATE_DISTANCE):
+    """
+    Gom các ảnh gần trùng nhau thành nhóm (theo thứ tự đường dẫn, ảnh đầu nhóm là ảnh gốc).
+    Returns:
+        danh sách nhóm, mỗi nhóm [(đường dẫn, khoảng cách tới ảnh gốc)] có ít nhất 2 ảnh
+    """
+    index = HashIndex.from_sources(dict(sorted(sources.items())))
+    assigned = set()
+    groups = []
+    for path, code_hex in ((p, sources[p]["phash"]) for p in index.paths):
+        if path in assigned:
+            continue
+        group = [(other, d) for other, d in index.query(int(code_hex, 16), max_distance)
+                 if other not in assigned]
+        if len(group) > 1:
+            groups.append(group)
+        assigned.update(other for other, _ in group)
+    return groups
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Báo cáo ảnh trùng / gần trùng trong kho đặc trưng")
+    parser.add_argument("feature_dir")
+    parser.add_argument("--max-distance", type=int, default=DUPLICATE_DISTANCE)
+    args = parser.parse_args(argv)
+
+    sources = read_manifest(args.feature_dir).get("sources", {}) if is_store(args.feature_dir) else {}
+    groups = duplicate_groups(sources, args.max_distance)
+    n_hashed = sum(1 for source in sources.values() if source.get("phash"))
+    print(f"{n_hashed} ảnh có dấu vân tay, {len(groups)} nhóm trùng "
+          f"({sum(len(g) - 1 for g in groups)} bản sao)")
+    for group in groups:
+        print(f"\n{group[0][0]}")
+        for path, distance in group[1:]:
+            skipped = " (không trích xuất)" if sources[path].get("duplicate_of") else ""
+            print(f"   = {path} (Hamming {distance}){skipped}")
+
+
+if __name__ == "__main__":
+    main()
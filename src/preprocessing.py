@@ -1,36 +1,189 @@
 import cv2
 import numpy as np
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from instrumentation import bind, stage
 
-def preprocess_image(image_path, blur_method='gaussian'):
+# Mỗi luồng giữ một đối tượng CLAHE riêng (đối tượng cv2 không an toàn khi dùng chung giữa các luồng)
+_local = threading.local()
+
+# Cờ giải mã thẳng sang ảnh xám thu nhỏ 1/2, 1/4, 1/8 (JPEG được thu nhỏ ngay trong bước IDCT)
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                  (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                  (2, cv2.IMREAD_REDUCED_GRAYSCALE_2))
+
+
+def _clahe():
+    clahe = getattr(_local, "clahe", None)
+    if clahe is None:
+        clahe = _local.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return clahe
+
+
+def limit_size(gray, max_side):
+    """Thu nhỏ ảnh (INTER_AREA) sao cho cạnh dài không vượt quá max_side"""
+    if not max_side:
+        return gray
+    h, w = gray.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return gray
+    return cv2.resize(gray, (max(1, round(w * scale)), max(1, round(h * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def image_size(data):
+    """(rộng, cao) đọc từ header JPEG / PNG mà không giải mã ảnh; None nếu không nhận ra định dạng"""
+    data = memoryview(data).cast('B')
+    if bytes(data[:8]) == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return int.from_bytes(data[16:20], 'big'), int.from_bytes(data[20:24], 'big')
+    if bytes(data[:2]) != b'\xff\xd8':
+        return None
+    # JPEG: duyệt các marker tới SOFn (chứa kích thước ảnh)
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[i + 5:i + 7], 'big')
+            width = int.from_bytes(data[i + 7:i + 9], 'big')
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+
+def read_bytes(source):
+    """Nội dung file ảnh đã mã hoá (đường dẫn, bytes hoặc đối tượng file như UploadedFile của Streamlit)"""
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as f:
+            return f.read()
+    if hasattr(source, 'getvalue'):
+        return source.getvalue()
+    if hasattr(source, 'read'):
+        return source.read()
+    return source
+
+
+def decode_gray(source, max_side=None):
+    """
+    Đọc ảnh thẳng sang ảnh xám (uint8), không qua ảnh màu BGR.
+
+    Args:
+        source: đường dẫn, bytes / bytearray / memoryview đã mã hoá, đối tượng file,
+                hoặc ndarray (ảnh đã giải mã: xám, BGR, BGRA; hoặc buffer uint8 1 chiều đã mã hoá)
+        max_side: nếu có, giải mã ở độ phân giải thu nhỏ (1/2, 1/4, 1/8) khi ảnh đủ lớn,
+                  sau đó thu nhỏ tiếp bằng limit_size()
+    Returns:
+        ảnh xám hoặc None nếu không giải mã được
+    """
+    if isinstance(source, np.ndarray) and source.ndim >= 2:
+        gray = source
+        if gray.ndim == 3:
+            code = cv2.COLOR_BGRA2GRAY if gray.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+            gray = cv2.cvtColor(gray, code)
+        with stage("preprocess.resize"):
+            return limit_size(gray, max_side)
+
+    with stage("preprocess.read"):
+        buf = np.frombuffer(read_bytes(source), dtype=np.uint8)
+    if buf.size == 0:
+        return None
+
+    flag = cv2.IMREAD_GRAYSCALE
+    if max_side:
+        size = image_size(buf)
+        if size is not None:
+            for factor, reduced_flag in _REDUCED_FLAGS:
+                # Chỉ giảm tới mức vẫn còn >= max_side, phần còn lại do INTER_AREA đảm nhận
+                if max(size) // factor >= max_side:
+                    flag = reduced_flag
+                    break
+
+    with stage("preprocess.decode"):
+        gray = cv2.imdecode(buf, flag)
+    if gray is None:
+        return None
+    with stage("preprocess.resize"):
+        return limit_size(gray, max_side)
+
+
+def preprocess_image(image, blur_method='gaussian', max_side=None):
     """
     Quy trình tiền xử lý:
-    1. Chuyển ảnh xám (Grayscale)
-    2. Lọc nhiễu (Gaussian Blur hoặc Median Blur)
-    3. Cân bằng sáng (CLAHE)
-    
+    1. Giải mã thẳng sang ảnh xám (Grayscale)
+    2. Thu nhỏ nếu cạnh dài vượt max_side
+    3. Lọc nhiễu (Gaussian Blur hoặc Median Blur)
+    4. Cân bằng sáng (CLAHE)
+
     Args:
-        image_path: Đường dẫn đến ảnh
+        image: Đường dẫn đến ảnh, hoặc ảnh trong bộ nhớ (bytes / ndarray, xem decode_gray)
         blur_method: 'gaussian' hoặc 'median'
+        max_side: cạnh dài tối đa (pixel), None = giữ nguyên độ phân giải
     """
-    # 1. Đọc ảnh
-    img = cv2.imread(image_path)
-    if img is None:
+    # 1-2. Đọc ảnh xám (thu nhỏ trước khi lọc nhiễu / CLAHE để chi phí mỗi ảnh không phụ thuộc
+    # độ phân giải gốc)
+    gray = decode_gray(image, max_side)
+    if gray is None:
         return None
 
-    # 2. Chuyển sang ảnh xám
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
     # 3. Lọc nhiễu
-    if blur_method == 'gaussian':
-        # Gaussian Blur: Tốt cho nhiễu Gaussian, làm mờ đều
-        gray = cv2.GaussianBlur(gray, (5, 5), 0)
-    elif blur_method == 'median':
-        # Median Blur: Tốt cho nhiễu muối tiêu (salt-and-pepper)
-        gray = cv2.medianBlur(gray, 5)
+    with stage("preprocess.blur"):
+        if blur_method == 'gaussian':
+            # Gaussian Blur: Tốt cho nhiễu Gaussian, làm mờ đều
+            gray = cv2.GaussianBlur(gray, (5, 5), 0)
+        elif blur_method == 'median':
+            # Median Blur: Tốt cho nhiễu muối tiêu (salt-and-pepper)
+            gray = cv2.medianBlur(gray, 5)
 
     # 4. Tăng tương phản cục bộ (CLAHE)
     # Giúp SIFT nhìn rõ chi tiết dù ảnh tối hay sáng
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    gray = clahe.apply(gray)
+    with stage("preprocess.clahe"):
+        gray = _clahe().apply(gray)
+
+    return gray
+
+
+def _preprocess_safe(image, blur_method, max_side):
+    try:
+        gray = preprocess_image(image, blur_method=blur_method, max_side=max_side)
+        return gray, None if gray is not None else "Không đọc được ảnh"
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def iter_preprocessed(images, blur_method='gaussian', max_side=None, threads=2, prefetch=8):
+    """
+    Pipeline đọc + giải mã + tiền xử lý chạy trước trên các luồng nền.
+
+    Đọc file và giải mã (OpenCV nhả GIL) chồng lên phần việc của bên tiêu thụ (vd. SIFT),
+    tối đa `prefetch` ảnh nằm chờ trong bộ nhớ.
+
+    Yields:
+        (ảnh đầu vào, ảnh đã tiền xử lý hoặc None, lỗi hoặc None) theo đúng thứ tự đầu vào
+    """
+    images = iter(images)
+    if threads <= 0:
+        for image in images:
+            yield (image,) + _preprocess_safe(image, blur_method, max_side)
+        return
 
-    return gray
\ No newline at end of file
+    pending = deque()
+    # Số liệu đo ở luồng nền được ghi vào Stats của luồng gọi (xem instrumentation.py)
+    work = bind(_preprocess_safe)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for image in images:
+            pending.append((image, pool.submit(work, image, blur_method, max_side)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            image, future = pending.popleft()
+            next_image = next(images, None)
+            if next_image is not None:
+                pending.append((next_image, pool.submit(work, next_image, blur_method, max_side)))
+            yield (image,) + future.result()
@@ -0,0 +1,193 @@
+"""
+Cache kết quả truy vấn theo nội dung
+
+Khoá = hash(nội dung ảnh truy vấn + cấu hình extractor + cấu hình matcher + top_n + phiên bản CSDL).
+Gửi lại đúng ảnh đó (kể cả tải lên lại) thì trả kết quả ngay, bỏ qua tiền xử lý, SIFT và so khớp.
+
+- Tầng bộ nhớ: LRU tối đa max_entries kết quả.
+- Tầng đĩa (tuỳ chọn): mỗi kết quả một file JSON trong disk_dir; tổng dung lượng vượt
+  max_disk_bytes thì xoá các file lâu không dùng nhất (theo mtime, được cập nhật mỗi lần trúng cache).
+
+Phiên bản CSDL lấy từ manifest của kho (inode + mtime + kích thước), nên mọi lần index lại
+làm khoá đổi theo; process_dataset còn xoá luôn thư mục cache mặc định feature_dir/result_cache/.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from feature_store import MANIFEST_NAME, is_store
+from instrumentation import count, stage
+from preprocessing import read_bytes
+
+CACHE_DIR_NAME = "result_cache"
+
+
+def default_cache_dir(feature_dir):
+    return Path(feature_dir) / CACHE_DIR_NAME
+
+
+def clear_disk_cache(feature_dir):
+    """Xoá tầng đĩa mặc định của feature_dir (gọi sau mỗi lần index lại)"""
+    shutil.rmtree(default_cache_dir(feature_dir), ignore_errors=True)
+
+
+def database_token(feature_dir):
+    """Chuỗi nhận diện phiên bản nội dung CSDL, ổn định giữa các tiến trình"""
+    feature_dir = Path(feature_dir)
+    if is_store(feature_dir):
+        # Manifest luôn được ghi mới rồi os.replace -> đổi inode / mtime mỗi lần index lại.
+        # Chỉ stat, không đọc manifest (có thể lớn) ở mỗi truy vấn
+        st = (feature_dir / MANIFEST_NAME).stat()
+        return f"store:{st.st_ino}:{st.st_mtime_ns}:{st.st_size}"
+    # Kho CSV kiểu cũ: chữ ký (tên, mtime, size) của mọi file
+    h = hashlib.blake2b(digest_size=16)
+    for csv_file in sorted(feature_dir.glob('*.csv')):
+        st = csv_file.stat()
+        h.update(f"{csv_file.name}:{st.st_mtime_ns}:{st.st_size};".encode('utf-8'))
+    return f"csv:{h.hexdigest()}"
+
+
+def make_key(query_bytes, extractor_config, matcher_config, top_n, db_token):
+    h = hashlib.sha256()
+    h.update(hashlib.sha256(query_bytes).digest())
+    settings = {"extractor": extractor_config, "matcher": matcher_config, "top_n": top_n,
+                "db": db_token}
+    h.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_entries=256, disk_dir=None, max_disk_bytes=64 * 2 ** 20):
+        """
+        Args:
+            max_entries: số kết quả tối đa giữ trong RAM (LRU)
+            disk_dir: thư mục tầng đĩa (None = chỉ dùng RAM)
+            max_disk_bytes: giới hạn tổng dung lượng tầng đĩa
+        """
+        self.max_entries = max_entries
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _disk_path(self, key):
+        return self.disk_dir / f"{key}.json"
+
+    def get(self, key):
+        """Giá trị đã lưu hoặc None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                count("cache.hit_memory")
+                return self._memory[key]
+
+        value = self._get_disk(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                count("cache.miss")
+                return None
+            self.hits += 1
+            count("cache.hit_disk")
+            self._put_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        """Lưu một giá trị ghi được ra JSON"""
+        with self._lock:
+            self._put_memory(key, value)
+        self._put_disk(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.disk_dir is not None:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+
+    def _put_memory(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _get_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+            # Cập nhật mtime -> file vừa dùng sẽ bị xoá sau cùng
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def _put_disk(self, key, value):
+        if self.disk_dir is None:
+            return
+        self.disk_dir.mkdir(parents=True, exist_ok=True)
+        path = self._disk_path(key)
+        tmp = path.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        total = 0
+        for path in self.disk_dir.glob("*.json"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime_ns, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+
+
+def search_image(cache, extractor, matcher, image, feature_dir, top_n=5):
+    """
+    Tiền xử lý + trích xuất + tìm kiếm một ảnh truy vấn, có cache.
+
+    Args:
+        image: đường dẫn, bytes hoặc đối tượng file của ảnh truy vấn (đã mã hoá)
+    Returns:
+        dict {"results": [(đường dẫn, điểm), ...], "query_kp_count": số keypoint, "cached": bool};
+        results là None nếu ảnh không có đặc trưng
+    """
+    with stage("cache.lookup"):
+        image_bytes = read_bytes(image)
+        key = make_key(image_bytes, extractor.config(), matcher.config(feature_dir), top_n,
+                       database_token(feature_dir))
+        value = cache.get(key)
+    if value is not None:
+        results = None if value["results"] is None else [tuple(r) for r in value["results"]]
+        return {"results": results, "query_kp_count": value["query_kp_count"], "cached": True}
+
+    kps, query_desc = extractor.extract(extractor.preprocess(image_bytes))
+    results = None
+    if query_desc is not None:
+        results = matcher.search(query_desc, feature_dir, top_n=top_n, query_kps=kps)
+    value = {"results": results, "query_kp_count": len(kps) if kps is not None else 0}
+    cache.put(key, value)
+    return dict(value, cached=False)
@@ -0,0 +1,521 @@
+"""
+Dịch vụ tìm kiếm HTTP chạy nền (cục bộ)
+
+Một tiến trình giữ CSDL đặc trưng "nóng" cho mọi người dùng:
+- POST /search       thân request là bytes của ảnh (jpg/png...), tham số query:
+                     top_n, method, mode, verify, profile=1
+                     -> JSON {"results": [{"path", "score"}], "query_kp_count", "cached", "stats", ...}
+                     ("prefilter": {"distance", "distances"} khi ảnh gần trùng một ảnh trong kho, xem bên dưới)
+- POST /match        thân request là descriptor đã trích xuất của nhiều truy vấn (.npz, xem pack_queries),
+                     cùng tham số như /search -> JSON {"results": [[{"path", "score"}], ...]}
+                     (dùng làm worker của một shard, xem sharding.py)
+- GET  /health       -> trạng thái, số ảnh trong CSDL, số request đang chờ
+
+Luồng xử lý một truy vấn:
+    HTTP thread -> (cache) -> (pHash) -> pool trích xuất (tiền xử lý + SIFT, song song)
+                -> hàng đợi so khớp -> luồng gom lô: gom các truy vấn đến gần nhau thành
+                   micro-batch rồi gọi ImageMatcher.search_many một lần cho cả lô.
+Ảnh truy vấn gần trùng một ảnh đã index (khoảng cách pHash <= DUPLICATE_DISTANCE) được trả lời
+ngay từ chỉ mục pHash, không trích xuất SIFT; "score" của các kết quả khi đó là null,
+khoảng cách Hamming của từng kết quả nằm trong prefilter["distances"].
+
+Chống quá tải: tối đa max_pending request đang xử lý, vượt quá thì trả 503 (Retry-After).
+Mỗi request có hạn chót `timeout` giây; quá hạn trả 504, truy vấn quá hạn bị bỏ khỏi lô.
+
+Chạy:
+    python src/search_service.py --feature-dir features --port 8765
+Client: SearchClient("http://127.0.0.1:8765").search(image_bytes, top_n=5)
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import queue
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.parse
+import urllib.request
+import numpy as np
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from feature_database import FeatureDatabase
+from feature_extraction import FeatureExtractor
+from geometry import keypoints_to_array
+from image_matching import ImageMatcher
+from instrumentation import collect
+from perceptual_hash import HashIndex, image_hash, prefilter_results
+from result_cache import ResultCache, database_token, default_cache_dir, make_key
+
+DEFAULT_PORT = 8765
+MAX_BODY_BYTES = 32 * 2 ** 20
+METHODS = ('BF', 'FLANN', 'NUMPY')
+MODES = ('scan', 'global', 'bow', 'prune', 'stream', 'coarse')
+VERIFY_MODES = (None, 'homography', 'affine')
+
+
+class ServiceBusy(Exception):
+    """Quá nhiều request đang xử lý"""
+
+
+class _PendingQuery:
+    def __init__(self, descs, kps, matcher_key, top_n, deadline, profile):
+        self.descs = descs
+        self.kps = kps
+        self.matcher_key = matcher_key
+        self.top_n = top_n
+        self.deadline = deadline
+        self.profile = profile
+        self.future = Future()
+
+    def settle(self, result=None, error=None):
+        # Future có thể đã xong (vd. lỗi đã được báo ở bước trước) -> bỏ qua
+        try:
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+        except InvalidStateError:
+            pass
+
+
+class SearchService:
+    def __init__(self, feature_dir, extract_workers=2, max_batch=16, batch_wait_ms=5,
+                 max_pending=64, timeout=30.0, cache=None, prefilter=True):
+        """
+        Args:
+            extract_workers: số luồng tiền xử lý + SIFT (OpenCV nhả GIL nên chạy song song được)
+            max_batch: số truy vấn tối đa trong một micro-batch so khớp
+            batch_wait_ms: thời gian tối đa chờ thêm truy vấn sau truy vấn đầu tiên của lô
+            max_pending: số request tối đa đang xử lý cùng lúc (vượt -> ServiceBusy / HTTP 503)
+            timeout: hạn chót (giây) của mỗi request
+            cache: ResultCache (mặc định LRU 256 kết quả + tầng đĩa feature_dir/result_cache/)
+            prefilter: trả lời ngay truy vấn gần trùng một ảnh trong kho (pHash), không qua SIFT
+        """
+        self.feature_dir = Path(feature_dir)
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait_ms / 1000
+        self.timeout = timeout
+        self.cache = cache if cache is not None else ResultCache(disk_dir=default_cache_dir(feature_dir))
+        self.prefilter = prefilter
+
+        # Một CSDL thường trú dùng chung cho mọi cấu hình matcher
+        self.db = FeatureDatabase(feature_dir)
+        self.db.refresh()
+        self._matchers = {}
+        self._matchers_lock = threading.Lock()
+        # Cấu hình extractor theo phiên bản kho (dùng cho khoá cache ở luồng HTTP)
+        self._extractor_configs = {}
+        # Chỉ mục pHash của phiên bản kho hiện tại: (token, HashIndex)
+        self._hash_index = (None, None)
+        self._hash_lock = threading.Lock()
+        self._extract_pool = ThreadPoolExecutor(max_workers=extract_workers,
+                                                thread_name_prefix="extract")
+        self._local = threading.local()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._batcher = threading.Thread(target=self._batch_loop, name="batcher", daemon=True)
+        self._batcher.start()
+
+    # --- Trích xuất (chạy trên pool) ---
+
+    def _extractor(self, token):
+        # Mỗi luồng một extractor (đối tượng cv2); tạo lại khi kho được index lại với tham số khác
+        cached = getattr(self._local, "extractor", None)
+        if cached is None or cached[0] != token:
+            cached = self._local.extractor = (token, FeatureExtractor.from_index(self.feature_dir))
+        return cached[1]
+
+    def _extractor_config(self, token):
+        config = self._extractor_configs.get(token)
+        if config is None:
+            config = self._extractor_configs[token] = FeatureExtractor.from_index(self.feature_dir).config()
+        return config
+
+    def _hash_index_for(self, token):
+        with self._hash_lock:
+            if self._hash_index[0] != token:
+                self._hash_index = (token, HashIndex.load(self.feature_dir))
+            return self._hash_index[1]
+
+    def _prefilter(self, image_bytes, token, top_n, profile):
+        # Kết quả từ chỉ mục pHash nếu ảnh gần trùng một ảnh trong kho, ngược lại None
+        hash_index = self._hash_index_for(token)
+        if not len(hash_index):
+            return None, None
+        with collect(profile=profile) as stats:
+            hits = hash_index.query(image_hash(image_bytes))
+        if not hits:
+            return None, None
+        results, prefilter = prefilter_results(hits, top_n)
+        value = {"results": results, "query_kp_count": 0, "prefilter": prefilter}
+        return value, stats
+
+    def _extract(self, image_bytes, token, profile):
+        with collect(profile=profile) as stats:
+            extractor = self._extractor(token)
+            kps, descs = extractor.extract(extractor.preprocess(image_bytes))
+        return kps, descs, stats
+
+    # --- So khớp theo lô (một luồng duy nhất chạm vào CSDL) ---
+
+    def _matcher(self, matcher_key):
+        with self._matchers_lock:
+            matcher = self._matchers.get(matcher_key)
+            if matcher is None:
+                method, mode, verify = matcher_key
+                matcher = self._matchers[matcher_key] = ImageMatcher(method=method, mode=mode,
+                                                                     verify=verify)
+            return matcher
+
+    def _next_batch(self):
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        # Gom thêm các truy vấn đến trong khoảng batch_wait sau truy vấn đầu tiên
+        until = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch:
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _batch_loop(self):
+        while not self._stopped.is_set():
+            batch = self._next_batch()
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                # Luồng gom lô là duy nhất, không được chết (mọi request sau sẽ treo tới 504):
+                # báo lỗi cho các request còn dở của lô này rồi chạy tiếp
+                traceback.print_exc()
+                for item in batch:
+                    item.settle(error=e)
+
+    def _run_batch(self, batch):
+        now = time.monotonic()
+        live = []
+        for item in batch:
+            if item.deadline < now:
+                # Request đã quá hạn (client nhận 504) -> không so khớp nữa
+                item.settle(error=TimeoutError("Quá thời gian chờ"))
+            else:
+                live.append(item)
+
+        # Cùng cấu hình matcher + top_n thì so khớp chung một lần search_many
+        groups = {}
+        for item in live:
+            groups.setdefault((item.matcher_key, item.top_n), []).append(item)
+        for (matcher_key, top_n), items in groups.items():
+            self._run_group(matcher_key, top_n, items)
+
+    def _run_group(self, matcher_key, top_n, items):
+        try:
+            with collect(profile=any(item.profile for item in items)) as stats:
+                results = self._matcher(matcher_key).search_many(
+                    [item.descs for item in items], self.db, top_n=top_n,
+                    query_kps=[item.kps for item in items])
+        except Exception as e:
+            if len(items) == 1:
+                items[0].settle(error=e)
+                return
+            # Một truy vấn lỗi (vd. descriptor không tương thích) không kéo cả nhóm theo:
+            # so khớp lại từng truy vấn, chỉ truy vấn lỗi nhận lỗi
+            for item in items:
+                self._run_group(matcher_key, top_n, [item])
+            return
+        for item, result in zip(items, results):
+            item.settle((result, stats, len(items)))
+
+    # --- API ---
+
+    def search(self, image_bytes, top_n=5, method='BF', mode='scan', verify=None, profile=False):
+        """
+        Tìm kiếm một ảnh (bytes đã mã hoá). Ném ServiceBusy khi quá tải, TimeoutError khi quá hạn.
+        Trả về dict giống JSON của POST /search.
+        """
+        with self._admit(top_n, method, mode, verify):
+            return self._search(image_bytes, top_n, (method, mode, verify), profile)
+
+    def match_many(self, query_descs, query_kps=None, top_n=5, method='BF', mode='scan', verify=None):
+        """
+        So khớp descriptor đã trích xuất sẵn (vd. bộ điều phối shard gửi tới), bỏ qua cache và
+        bước trích xuất. Các truy vấn đi chung micro-batch với truy vấn ảnh khác.
+        Returns:
+            danh sách kết quả [(đường dẫn, điểm), ...] theo từng truy vấn
+        """
+        with self._admit(top_n, method, mode, verify):
+            deadline = time.monotonic() + self.timeout
+            if query_kps is None:
+                query_kps = [None] * len(query_descs)
+            items = []
+            for descs, kps in zip(query_descs, query_kps):
+                item = None
+                if descs is not None and len(descs) > 0:
+                    item = _PendingQuery(descs, kps, (method, mode, verify), top_n, deadline, False)
+                    self._queue.put(item)
+                items.append(item)
+            return [[] if item is None else self._wait(item)[0] for item in items]
+
+    @contextlib.contextmanager
+    def _admit(self, top_n, method, mode, verify):
+        # Kiểm tra tham số và giữ một chỗ trong giới hạn max_pending trong suốt request
+        if method not in METHODS or mode not in MODES or verify not in VERIFY_MODES:
+            raise ValueError(f"Cấu hình không hợp lệ: method={method}, mode={mode}, verify={verify}")
+        if top_n < 1:
+            raise ValueError("top_n phải >= 1")
+        if not self._slots.acquire(blocking=False):
+            raise ServiceBusy()
+        with self._pending_lock:
+            self._pending += 1
+        try:
+            yield
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+            self._slots.release()
+
+    def _wait(self, item):
+        try:
+            return item.future.result(timeout=max(item.deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            raise TimeoutError("Quá thời gian chờ khi so khớp")
+
+    def _search(self, image_bytes, top_n, matcher_key, profile):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        token = database_token(self.feature_dir)
+        key = make_key(image_bytes, self._extractor_config(token), self._matcher(matcher_key).config(self.feature_dir),
+                       top_n, token)
+        cached = None if profile else self.cache.get(key)
+        if cached is not None:
+            return _response(cached, True, None, None, 0, start)
+        if self.prefilter:
+            # Không lưu cache: tra pHash rẻ, và cache chỉ giữ kết quả so khớp SIFT
+            value, stats = self._prefilter(image_bytes, token, top_n, profile)
+            if value is not None:
+                return _response(value, False, stats.to_dict(), stats.profile_text, 0, start)
+
+        future = self._extract_pool.submit(self._extract, image_bytes, token, profile)
+        try:
+            kps, descs, extract_stats = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            future.cancel()
+            raise TimeoutError("Quá thời gian chờ khi trích xuất đặc trưng")
+
+        value = {"results": None, "query_kp_count": len(kps) if kps is not None else 0}
+        batch_stats, batch_size = None, 0
+        if descs is not None:
+            item = _PendingQuery(descs, kps, matcher_key, top_n, deadline, profile)
+            self._queue.put(item)
+            results, batch_stats, batch_size = self._wait(item)
+            value["results"] = results
+        # Cùng định dạng với result_cache.search_image (dùng chung được tầng đĩa)
+        self.cache.put(key, value)
+
+        if batch_stats is not None:
+            extract_stats.merge(batch_stats)
+        profile_text = "\n".join(text for text in (extract_stats.profile_text,
+                                                   batch_stats and batch_stats.profile_text) if text)
+        return _response(value, False, extract_stats.to_dict(), profile_text or None, batch_size, start)
+
+    def health(self):
+        return {"status": "ok", "n_images": len(self.db), "pending": self._pending,
+                "queued": self._queue.qsize(), "feature_dir": str(self.feature_dir)}
+
+    def close(self):
+        self._stopped.set()
+        self._batcher.join()
+        self._extract_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _response(value, cached, stats, profile_text, batch_size, start):
+    results = value["results"]
+    if results is not None:
+        results = [{"path": path, "score": score} for path, score in results]
+    return {"results": results, "query_kp_count": value["query_kp_count"], "cached": cached,
+            "prefilter": value.get("prefilter"), "stats": stats, "profile": profile_text, "batch_size": batch_size,
+            "elapsed_ms": round((time.monotonic() - start) * 1000, 3)}
+
+
+def pack_queries(query_descs, query_kps=None):
+    """Đóng gói descriptor (và keypoint dạng mảng n x 5) của nhiều truy vấn thành bytes .npz"""
+    arrays = {"n": np.array(len(query_descs))}
+    for i, descs in enumerate(query_descs):
+        if descs is not None:
+            arrays[f"d{i}"] = np.asarray(descs)
+        if query_kps is not None and query_kps[i] is not None:
+            arrays[f"k{i}"] = keypoints_to_array(query_kps[i])
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def unpack_queries(data):
+    """Ngược lại của pack_queries: (danh sách descriptor, danh sách keypoint)"""
+    with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+        n = int(npz["n"])
+        query_descs = [npz[f"d{i}"] if f"d{i}" in npz.files else None for i in range(n)]
+        query_kps = [npz[f"k{i}"] if f"k{i}" in npz.files else None for i in range(n)]
+    return query_descs, query_kps
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urllib.parse.urlparse(self.path).path == "/health":
+                self._send_json(200, service.health())
+            else:
+                self._send_json(404, {"error": "Không tìm thấy"})
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path not in ("/search", "/match"):
+                self._send_json(404, {"error": "Không tìm thấy"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                length = 0
+            if length <= 0:
+                self._send_json(400, {"error": "Thiếu nội dung ảnh"})
+                return
+            if length > MAX_BODY_BYTES:
+                self._send_json(413, {"error": "Ảnh quá lớn"})
+                return
+            params = dict(urllib.parse.parse_qsl(url.query))
+            body = self.rfile.read(length)
+            try:
+                # Tham số sai (vd. top_n=abc) -> 400 như mọi lỗi đầu vào khác
+                options = dict(top_n=int(params.get("top_n", 5)), method=params.get("method", "BF"),
+                               mode=params.get("mode", "scan"), verify=params.get("verify") or None)
+                if url.path == "/match":
+                    query_descs, query_kps = unpack_queries(body)
+                    results = service.match_many(query_descs, query_kps, **options)
+                    result = {"results": [[{"path": path, "score": score} for path, score in found]
+                                          for found in results]}
+                else:
+                    result = service.search(body, profile=params.get("profile") == "1", **options)
+            except ServiceBusy:
+                self._send_json(503, {"error": "Dịch vụ đang quá tải, thử lại sau"},
+                                headers={"Retry-After": "1"})
+            except TimeoutError as e:
+                self._send_json(504, {"error": str(e)})
+            except (ValueError, KeyError) as e:
+                self._send_json(400, {"error": f"{type(e).__name__}: {e}"})
+            except Exception as e:
+                self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            else:
+                self._send_json(200, result)
+
+        def log_message(self, format, *args):
+            # Im lặng, tránh một dòng log cho mỗi request
+            pass
+
+    return Handler
+
+
+def serve(feature_dir, host="127.0.0.1", port=DEFAULT_PORT, **kwargs):
+    """Chạy dịch vụ tới khi Ctrl+C"""
+    service = SearchService(feature_dir, **kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    print(f" Search service: http://{host}:{port} ({len(service.db)} ảnh trong CSDL)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+class SearchClient:
+    """Client HTTP tối giản cho SearchService (chỉ dùng thư viện chuẩn)"""
+
+    def __init__(self, base_url=f"http://127.0.0.1:{DEFAULT_PORT}", timeout=60.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def health(self):
+        with urllib.request.urlopen(self.base_url + "/health", timeout=self.timeout) as resp:
+            return json.load(resp)
+
+    def search(self, image_bytes, top_n=5, method='BF', mode='scan', verify=None, profile=False):
+        """
+        Trả về dict của POST /search; results là danh sách (đường dẫn, điểm) hoặc None.
+        Lỗi HTTP (503 quá tải, 504 quá hạn...) được ném ra dưới dạng RuntimeError kèm thông báo.
+        """
+        params = {"top_n": top_n, "method": method, "mode": mode}
+        if verify:
+            params["verify"] = verify
+        if profile:
+            params["profile"] = "1"
+        result = self._post("/search", params, bytes(image_bytes))
+        if result["results"] is not None:
+            result["results"] = [(r["path"], r["score"]) for r in result["results"]]
+        return result
+
+    def match_many(self, query_descs, query_kps=None, top_n=5, method='BF', mode='scan', verify=None,
+                   timeout=None):
+        """So khớp descriptor đã trích xuất (POST /match); trả về danh sách kết quả theo từng truy vấn"""
+        params = {"top_n": top_n, "method": method, "mode": mode}
+        if verify:
+            params["verify"] = verify
+        result = self._post("/match", params, pack_queries(query_descs, query_kps), timeout)
+        return [[(r["path"], r["score"]) for r in found] for found in result["results"]]
+
+    def _post(self, endpoint, params, body, timeout=None):
+        request = urllib.request.Request(
+            f"{self.base_url}{endpoint}?{urllib.parse.urlencode(params)}", data=body,
+            headers={"Content-Type": "application/octet-stream"}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=timeout or self.timeout) as resp:
+                return json.load(resp)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.load(e).get("error", e.reason)
+            except ValueError:
+                message = e.reason
+            raise RuntimeError(f"HTTP {e.code}: {message}") from None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dịch vụ tìm kiếm ảnh tương tự giữ CSDL nóng")
+    parser.add_argument("--feature-dir", default="features")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--extract-workers", type=int, default=2)
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--batch-wait-ms", type=float, default=5)
+    parser.add_argument("--max-pending", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--no-prefilter", dest="prefilter", action="store_false",
+                        help="Luôn so khớp SIFT, kể cả khi ảnh truy vấn gần trùng một ảnh trong kho")
+    args = parser.parse_args()
+    serve(args.feature_dir, host=args.host, port=args.port, extract_workers=args.extract_workers,
+          max_batch=args.max_batch, batch_wait_ms=args.batch_wait_ms, max_pending=args.max_pending,
+          timeout=args.timeout, prefilter=args.prefilter)
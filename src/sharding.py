@@ -0,0 +1,489 @@
+"""
+Chia CSDL đặc trưng thành nhiều shard + tìm kiếm scatter-gather
+
+Cấu trúc thư mục shard_root:
+    shards.json      - {"format", "n_shards", "shards": ["shard-000", ...]}
+    shard-000/       - Một kho đặc trưng đầy đủ (manifest.json + seg-*/, xem feature_store.py)
+    shard-001/
+    ...
+
+Mỗi ảnh thuộc về shard jump_hash(đường dẫn ảnh, n_shards) (jump consistent hash): khi tăng số shard
+từ N lên M chỉ khoảng (M - N) / M số ảnh phải chuyển, và chỉ chuyển sang các shard mới.
+
+Mỗi shard được phục vụ bởi:
+    - ProcessShard: một tiến trình worker trên máy này (CSDL của shard nằm trong tiến trình đó)
+    - HttpShard:    một search_service.py chạy trên máy khác (hoặc 127.0.0.1) với --feature-dir là shard đó
+
+ShardedSearcher gửi descriptor truy vấn tới mọi shard cùng lúc, chờ tối đa `timeout` giây rồi
+gộp top-N của từng shard. Shard chậm / lỗi bị bỏ qua và kết quả được đánh dấu partial.
+
+Điểm của scan / prune / NUMPY chỉ phụ thuộc từng cặp (truy vấn, ảnh) nên kết quả gộp giống hệt
+tìm trên kho gốc (trừ thứ tự giữa các ảnh bằng điểm: sắp theo đường dẫn). Với mode='global' / 'bow'
+mỗi shard có chỉ mục riêng nên điểm có thể khác đôi chút so với một kho duy nhất.
+
+Dùng:
+    python src/sharding.py split features shards --shards 4
+    python src/sharding.py rebalance shards --shards 6
+    python src/sharding.py search shards data/query.jpg -k 5
+    python src/sharding.py search shards data/query.jpg --remote http://10.0.0.2:8765 http://10.0.0.3:8765
+"""
+
+import argparse
+import contextlib
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from pathlib import Path
+from compression import DescriptorCodec
+from feature_store import FeatureStore, StoreWriter, is_store
+from geometry import keypoints_to_array
+
+SHARDS_NAME = "shards.json"
+SHARD_PREFIX = "shard-"
+SHARDS_FORMAT = 1
+
+
+def is_sharded(root):
+    return (Path(root) / SHARDS_NAME).exists()
+
+
+def read_shards(root):
+    with open(Path(root) / SHARDS_NAME, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def shard_dirs(root):
+    """Thư mục của từng shard theo thứ tự"""
+    return [Path(root) / name for name in read_shards(root)["shards"]]
+
+
+def _write_shards(root, n_shards):
+    layout = {"format": SHARDS_FORMAT, "n_shards": n_shards,
+              "shards": [f"{SHARD_PREFIX}{i:03d}" for i in range(n_shards)]}
+    tmp = Path(root) / (SHARDS_NAME + ".tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(layout, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, Path(root) / SHARDS_NAME)
+
+
+def jump_hash(key, n_buckets):
+    """Jump consistent hash (Lamping & Veach) của một chuỗi vào [0, n_buckets)"""
+    k = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+    b, j = -1, 0
+    while j < n_buckets:
+        b = j
+        k = (k * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((k >> 33) + 1)))
+    return b
+
+
+def shard_of(rel_path, n_shards):
+    return jump_hash(str(rel_path), n_shards)
+
+
+def _shard_codec(codec):
+    # Bản sao codec chưa gắn file: PCA được ghi lại vào thư mục của từng shard khi close()
+    return DescriptorCodec(codec.encoding, codec.mean, codec.components)
+
+
+def _featureless_sources(store):
+    # Ảnh nguồn đã index nhưng không có đặc trưng (ảnh trơn) - vẫn cần chuyển theo để index tăng dần
+    indexed = set(store.paths)
+    return {path: source for path, source in store.sources.items() if path not in indexed}
+
+
+def split_store(feature_dir, root, n_shards):
+    """Chia kho feature_dir thành n_shards shard trong root (ghi đè bố cục shard cũ nếu có)"""
+    if not is_store(feature_dir):
+        raise ValueError(f"{feature_dir} không phải kho đặc trưng nhị phân")
+    if n_shards < 1:
+        raise ValueError("Số shard phải >= 1")
+    store = FeatureStore(feature_dir)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    writers = [StoreWriter(root / f"{SHARD_PREFIX}{i:03d}", algo=store.algo,
+                           codec=_shard_codec(store.codec), params=store.params)
+               for i in range(n_shards)]
+    try:
+        for idx, (path, descs) in enumerate(store):
+            writers[shard_of(path, n_shards)].add(path, descs, source=store.sources.get(path),
+                                                  keypoints=store.get_keypoints(idx), encoded=True)
+        for path, source in _featureless_sources(store).items():
+            writers[shard_of(path, n_shards)].set_source(path, source)
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    for writer in writers:
+        writer.close()
+    old = read_shards(root)["n_shards"] if is_sharded(root) else 0
+    _write_shards(root, n_shards)
+    for i in range(n_shards, old):
+        shutil.rmtree(root / f"{SHARD_PREFIX}{i:03d}", ignore_errors=True)
+    print(f" Đã chia {len(store)} ảnh vào {n_shards} shard trong {root}")
+
+
+def rebalance(root, n_shards):
+    """
+    Đổi số shard, chỉ chuyển những ảnh có shard đích thay đổi.
+
+    Thứ tự ghi để người đọc không bao giờ thiếu ảnh: ghi các shard nhận ảnh trước, rồi shards.json,
+    sau cùng mới xoá ảnh khỏi shard nguồn. Trong khoảng giữa một ảnh có thể nằm ở hai shard
+    (ShardedSearcher bỏ trùng theo đường dẫn).
+    """
+    root = Path(root)
+    if n_shards < 1:
+        raise ValueError("Số shard phải >= 1")
+    old_dirs = shard_dirs(root)
+    old_n = len(old_dirs)
+    stores = [FeatureStore(d) for d in old_dirs]
+    template = stores[0]
+
+    # Shard nhận: ghi tiếp vào kho cũ, hoặc tạo kho mới cho shard vừa thêm
+    receivers = {}
+
+    def receiver(i):
+        if i not in receivers:
+            shard_dir = root / f"{SHARD_PREFIX}{i:03d}"
+            if i < old_n:
+                receivers[i] = StoreWriter(shard_dir, algo=stores[i].algo, params=stores[i].params,
+                                           base=stores[i])
+            else:
+                receivers[i] = StoreWriter(shard_dir, algo=template.algo,
+                                           codec=_shard_codec(template.codec), params=template.params)
+        return receivers[i]
+
+    senders = {}
+    moved = 0
+    try:
+        for i, store in enumerate(stores):
+            for idx, (path, descs) in enumerate(store):
+                target = shard_of(path, n_shards)
+                if target == i:
+                    continue
+                receiver(target).add(path, descs, source=store.sources.get(path),
+                                     keypoints=store.get_keypoints(idx), encoded=True)
+                senders.setdefault(i, []).append(path)
+                moved += 1
+            for path, source in _featureless_sources(store).items():
+                target = shard_of(path, n_shards)
+                if target != i:
+                    receiver(target).set_source(path, source)
+                    senders.setdefault(i, []).append(path)
+        # Shard mới không nhận ảnh nào vẫn cần một kho rỗng hợp lệ
+        for i in range(old_n, n_shards):
+            receiver(i)
+    except BaseException:
+        for writer in receivers.values():
+            writer.abort()
+        raise
+
+    for writer in receivers.values():
+        writer.close()
+    _write_shards(root, n_shards)
+
+    for i, paths in senders.items():
+        if i >= n_shards:
+            # Shard bị bỏ (giảm số shard): mọi ảnh đã chuyển đi, xoá cả thư mục
+            shutil.rmtree(old_dirs[i], ignore_errors=True)
+            continue
+        with StoreWriter(old_dirs[i], algo=stores[i].algo, params=stores[i].params,
+                         base=FeatureStore(old_dirs[i])) as writer:
+            for path in paths:
+                writer.remove(path)
+    for i in range(n_shards, old_n):
+        shutil.rmtree(old_dirs[i], ignore_errors=True)
+    print(f" Đã chuyển {moved} ảnh: {old_n} -> {n_shards} shard")
+
+
+class ShardError(Exception):
+    """Shard không trả lời được (tiến trình chết, lỗi mạng, lỗi khi so khớp)"""
+
+
+def _shard_worker(shard_dir, matcher_kwargs, conn, cancel_below):
+    # Chạy trong tiến trình con: giữ CSDL của shard trong một ImageMatcher.
+    # cancel_below: request có id nhỏ hơn giá trị này đã hết hạn phía gọi -> trả lời ngay, không so khớp
+    from image_matching import ImageMatcher
+
+    matcher = ImageMatcher(**matcher_kwargs)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        request_id, query_descs, query_kps, top_n = message
+        if request_id < cancel_below.value:
+            conn.send((request_id, None, "cancelled"))
+            continue
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = matcher.search_many(query_descs, shard_dir, top_n=top_n, query_kps=query_kps)
+            conn.send((request_id, results, None))
+        except Exception as e:
+            conn.send((request_id, None, f"{type(e).__name__}: {e}"))
+
+
+class ProcessShard:
+    """Một shard được phục vụ bởi tiến trình worker cục bộ (tự khởi động lại nếu tiến trình chết)"""
+
+    def __init__(self, shard_dir, **matcher_kwargs):
+        self.shard_dir = str(shard_dir)
+        self.name = Path(shard_dir).name
+        self.matcher_kwargs = matcher_kwargs
+        self._process = None
+        self._conn = None
+        self._cancel_below = None
+        # id của request đã hết hạn mà worker chưa trả lời (worker còn đang bận với nó)
+        self._pending = None
+        self._ids = itertools.count()
+        # Mỗi lúc chỉ một request trên đường ống của worker
+        self._lock = threading.Lock()
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child_conn = ctx.Pipe()
+        self._cancel_below = ctx.Value('q', 0, lock=False)
+        self._pending = None
+        self._process = ctx.Process(target=_shard_worker, name=f"worker-{self.name}",
+                                    args=(self.shard_dir, self.matcher_kwargs, child_conn, self._cancel_below),
+                                    daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def search_many(self, query_descs, top_n, query_kps=None, timeout=None):
+        """
+        Gửi một lô truy vấn tới worker. Request quá hạn không bị để lại chờ trong đường ống:
+        worker bỏ qua nó nếu chưa bắt đầu so khớp, và request sau chỉ được gửi khi worker đã xong
+        request cũ (thời gian chờ này, cũng như chờ lock, tính vào timeout).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"{self.name}: quá thời gian chờ")
+        try:
+            if self._process is None or not self._process.is_alive():
+                self.start()
+            try:
+                if self._pending is not None:
+                    self._wait_reply(self._pending, deadline)
+                    self._pending = None
+                request_id = next(self._ids)
+                self._conn.send((request_id, query_descs, query_kps, top_n))
+                try:
+                    results, error = self._wait_reply(request_id, deadline)
+                except TimeoutError:
+                    # Worker chậm vẫn sống và giữ CSDL nóng; đánh dấu huỷ để worker không so khớp
+                    # request này nếu chưa bắt đầu
+                    self._cancel_below.value = request_id + 1
+                    self._pending = request_id
+                    raise
+            except TimeoutError:
+                # TimeoutError là lớp con của OSError: không đóng worker
+                raise
+            except (EOFError, OSError) as e:
+                self._close_locked()
+                raise ShardError(f"{self.name}: worker không phản hồi ({type(e).__name__})") from None
+        finally:
+            self._lock.release()
+        if error is not None:
+            raise ShardError(f"{self.name}: {error}")
+        return results
+
+    def _wait_reply(self, request_id, deadline):
+        # Đọc trả lời cho tới khi gặp request_id (bỏ qua trả lời của request cũ hơn)
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not self._conn.poll(remaining):
+                raise TimeoutError(f"{self.name}: quá thời gian chờ")
+            reply_id, results, error = self._conn.recv()
+            if reply_id == request_id:
+                return results, error
+
+    def close(self):
+        with self._lock:
+            self._close_locked()
+
+    def _close_locked(self):
+        # Gọi khi đang giữ self._lock; gọi nhiều lần không sao
+        process, conn = self._process, self._conn
+        self._process = self._conn = self._cancel_below = self._pending = None
+        if process is None:
+            return
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+        process.join(timeout=1)
+        if process.is_alive():
+            process.terminate()
+        conn.close()
+
+
+class HttpShard:
+    """Một shard được phục vụ bởi search_service.py ở máy khác (hoặc 127.0.0.1)"""
+
+    def __init__(self, base_url, **matcher_kwargs):
+        from search_service import SearchClient
+
+        self.name = base_url
+        self.client = SearchClient(base_url)
+        self.matcher_kwargs = matcher_kwargs
+
+    def search_many(self, query_descs, top_n, query_kps=None, timeout=None):
+        try:
+            return self.client.match_many(query_descs, query_kps, top_n=top_n, timeout=timeout,
+                                          **self.matcher_kwargs)
+        except (RuntimeError, OSError, ValueError) as e:
+            # socket.timeout / URLError là OSError
+            if isinstance(e, TimeoutError):
+                raise TimeoutError(f"{self.name}: quá thời gian chờ") from None
+            raise ShardError(f"{self.name}: {e}") from None
+
+    def close(self):
+        pass
+
+
+class ShardedSearcher:
+    def __init__(self, shards, timeout=10.0):
+        """
+        Args:
+            shards: danh sách ProcessShard / HttpShard (đối tượng bất kỳ có search_many + close)
+            timeout: thời gian tối đa chờ các shard cho một lượt tìm kiếm (giây)
+        """
+        self.shards = shards
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max(len(shards), 1), thread_name_prefix="scatter")
+
+    @classmethod
+    def local(cls, root, timeout=10.0, **matcher_kwargs):
+        """Mỗi shard trong root một tiến trình worker (khởi động ngay để lượt tìm đầu không bị quá hạn)"""
+        shards = [ProcessShard(d, **matcher_kwargs) for d in shard_dirs(root)]
+        for shard in shards:
+            shard.start()
+        return cls(shards, timeout=timeout)
+
+    @classmethod
+    def remote(cls, urls, timeout=10.0, **matcher_kwargs):
+        """Mỗi shard một search_service.py ở địa chỉ tương ứng"""
+        return cls([HttpShard(url, **matcher_kwargs) for url in urls], timeout=timeout)
+
+    def search_many(self, query_descs, top_n=5, query_kps=None):
+        """
+        Scatter-gather: gửi truy vấn tới mọi shard, gộp top-N.
+        Returns:
+            dict {"results": danh sách kết quả theo từng truy vấn,
+                  "partial": True nếu có shard không trả lời,
+                  "failed": {tên shard: lỗi}}
+        """
+        if query_kps is not None:
+            query_kps = [keypoints_to_array(kps) for kps in query_kps]
+        futures = {self._pool.submit(shard.search_many, query_descs, top_n, query_kps, self.timeout): shard
+                   for shard in self.shards}
+        done, not_done = wait_futures(futures, timeout=self.timeout)
+
+        failed = {}
+        shard_results = []
+        for future, shard in futures.items():
+            if future in not_done:
+                failed[shard.name] = "quá thời gian chờ"
+                continue
+            try:
+                shard_results.append(future.result())
+            except Exception as e:
+                failed[shard.name] = str(e)
+        if failed:
+            print(f" Kết quả chưa đầy đủ: {len(failed)}/{len(self.shards)} shard không trả lời")
+
+        merged = [_merge([results[i] for results in shard_results], top_n)
+                  for i in range(len(query_descs))]
+        return {"results": merged, "partial": bool(failed), "failed": failed}
+
+    def search(self, query_desc, top_n=5, query_kps=None):
+        found = self.search_many([query_desc], top_n=top_n, query_kps=[query_kps])
+        return dict(found, results=found["results"][0])
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self._pool.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _merge(lists, top_n):
+    # Gộp top-N của các shard; một ảnh có thể tạm nằm ở hai shard khi đang rebalance -> giữ điểm cao nhất
+    best = {}
+    for results in lists:
+        for path, score in results:
+            if score > best.get(path, -1):
+                best[path] = score
+    return heapq.nsmallest(top_n, best.items(), key=lambda item: (-item[1], item[0]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chia CSDL đặc trưng thành shard, tìm kiếm scatter-gather")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("split", help="Chia một kho đặc trưng thành N shard")
+    p.add_argument("feature_dir")
+    p.add_argument("root")
+    p.add_argument("--shards", type=int, required=True)
+
+    p = sub.add_parser("rebalance", help="Đổi số shard, chỉ chuyển những ảnh cần chuyển")
+    p.add_argument("root")
+    p.add_argument("--shards", type=int, required=True)
+
+    p = sub.add_parser("search", help="Tìm kiếm ảnh truy vấn trên mọi shard")
+    p.add_argument("root")
+    p.add_argument("queries", nargs="+")
+    p.add_argument("-k", "--top-n", type=int, default=5)
+    p.add_argument("--method", choices=["BF", "FLANN", "NUMPY"], default="BF")
+    p.add_argument("--mode", choices=["scan", "global", "bow", "prune", "stream", "coarse"],
+                   default="scan")
+    p.add_argument("--timeout", type=float, default=10.0)
+    p.add_argument("--remote", nargs="+", help="Địa chỉ search_service.py của từng shard (thay cho tiến trình cục bộ)")
+    args = parser.parse_args(argv)
+
+    if args.command == "split":
+        split_store(args.feature_dir, args.root, args.shards)
+    elif args.command == "rebalance":
+        rebalance(args.root, args.shards)
+    else:
+        from feature_extraction import FeatureExtractor
+
+        # Mọi shard được index với cùng tham số -> lấy cấu hình extractor từ shard đầu tiên
+        extractor = FeatureExtractor.from_index(shard_dirs(args.root)[0])
+        descs, kps = [], []
+        for query in args.queries:
+            query_kps, query_desc = extractor.extract(extractor.preprocess(query))
+            descs.append(query_desc)
+            kps.append(query_kps)
+        options = dict(timeout=args.timeout, method=args.method, mode=args.mode)
+        searcher = (ShardedSearcher.remote(args.remote, **options) if args.remote
+                    else ShardedSearcher.local(args.root, **options))
+        with searcher:
+            found = searcher.search_many(descs, top_n=args.top_n, query_kps=kps)
+        for query, results in zip(args.queries, found["results"]):
+            print(f"\n{query}:")
+            for path, score in results:
+                print(f" - {path} | Điểm: {score}")
+        for name, error in found["failed"].items():
+            print(f" [!] {name}: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Cache ảnh thu nhỏ (thumbnail) trên đĩa cho trang kết quả
+
+Mỗi ảnh nguồn có một file JPEG nhỏ (cạnh dài THUMBNAIL_SIDE) trong feature_dir/thumbnails/,
+tên file là mã băm của đường dẫn tương đối. mtime của thumbnail được đặt bằng mtime của ảnh gốc,
+nên kiểm tra thumbnail còn đúng hay không chỉ cần stat hai file (không đọc manifest, không giải mã ảnh).
+
+- build_thumbnails(): tạo thumbnail cho mọi ảnh trong manifest (chạy sau mỗi lần index, xem index_jobs.py)
+  và xoá thumbnail của ảnh không còn trong kho.
+- get_thumbnail(): đường dẫn thumbnail của một kết quả; tạo ngay nếu thiếu (ảnh vừa thêm, kho cũ).
+
+Ảnh JPEG được giải mã thẳng ở 1/2, 1/4, 1/8 độ phân giải, nên tạo thumbnail rẻ hơn nhiều so với
+mở ảnh gốc đầy đủ ở mỗi lần hiển thị.
+
+Tạo thumbnail cho một kho có sẵn:
+    python src/thumbnails.py data features
+"""
+
+import argparse
+import hashlib
+import os
+import threading
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from feature_store import is_store, read_manifest
+from instrumentation import bind, count, stage
+from preprocessing import image_size, limit_size, read_bytes
+
+THUMBNAIL_DIR_NAME = "thumbnails"
+THUMBNAIL_SIDE = 320
+JPEG_QUALITY = 85
+
+# Cờ giải mã thẳng sang ảnh màu thu nhỏ 1/2, 1/4, 1/8
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                  (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def thumbnail_dir(feature_dir):
+    return Path(feature_dir) / THUMBNAIL_DIR_NAME
+
+
+def thumbnail_path(feature_dir, rel_path):
+    name = hashlib.blake2b(str(rel_path).encode('utf-8'), digest_size=16).hexdigest()
+    return thumbnail_dir(feature_dir) / f"{name}.jpg"
+
+
+def is_fresh(thumb_path, source_path):
+    """Thumbnail tồn tại và được tạo từ đúng phiên bản hiện tại của ảnh gốc"""
+    try:
+        return thumb_path.stat().st_mtime_ns == Path(source_path).stat().st_mtime_ns
+    except OSError:
+        return False
+
+
+def make_thumbnail(source_path, thumb_path, side=THUMBNAIL_SIDE):
+    """Ghi thumbnail JPEG của source_path; trả về False nếu không đọc / giải mã được ảnh"""
+    source_path = Path(source_path)
+    try:
+        mtime_ns = source_path.stat().st_mtime_ns
+        buf = np.frombuffer(read_bytes(source_path), dtype=np.uint8)
+    except OSError:
+        return False
+    if buf.size == 0:
+        return False
+
+    flag = cv2.IMREAD_COLOR
+    size = image_size(buf)
+    if size is not None:
+        for factor, reduced_flag in _REDUCED_FLAGS:
+            if max(size) // factor >= side:
+                flag = reduced_flag
+                break
+    with stage("thumbnail.make"):
+        img = cv2.imdecode(buf, flag)
+        if img is None:
+            return False
+        ok, encoded = cv2.imencode('.jpg', limit_size(img, side), [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        return False
+
+    thumb_path.parent.mkdir(parents=True, exist_ok=True)
+    # Ghi ra file tạm rồi os.replace: luồng / tiến trình khác không bao giờ đọc phải file dở dang
+    tmp = thumb_path.with_suffix(f".tmp{os.getpid()}-{threading.get_ident()}")
+    with open(tmp, 'wb') as f:
+        f.write(encoded.tobytes())
+    os.utime(tmp, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp, thumb_path)
+    count("thumbnail.created")
+    return True
+
+
+def get_thumbnail(data_dir, feature_dir, rel_path, side=THUMBNAIL_SIDE):
+    """Đường dẫn thumbnail của ảnh data_dir/rel_path (tạo nếu thiếu / cũ), None nếu không tạo được"""
+    source_path = Path(data_dir) / rel_path
+    thumb_path = thumbnail_path(feature_dir, rel_path)
+    if is_fresh(thumb_path, source_path):
+        count("thumbnail.hits")
+        return thumb_path
+    return thumb_path if make_thumbnail(source_path, thumb_path, side) else None
+
+
+def build_thumbnails(data_dir, feature_dir, side=THUMBNAIL_SIDE, threads=4, progress=None, cancel=None):
+    """
+    Tạo thumbnail cho mọi ảnh nguồn trong manifest của feature_dir (bỏ qua thumbnail còn đúng),
+    xoá thumbnail của ảnh không còn trong kho.
+
+    Args:
+        progress: hàm progress(done, total) được gọi sau mỗi ảnh
+        cancel: threading.Event; khi đã set thì dừng sớm (thumbnail còn thiếu được tạo khi hiển thị)
+    Returns:
+        dict thống kê: total, created, unchanged, removed, errors
+    """
+    sources = read_manifest(feature_dir).get("sources", {}) if is_store(feature_dir) else {}
+    data_dir = Path(data_dir)
+    report = {"total": len(sources), "created": 0, "unchanged": 0, "removed": 0, "errors": 0}
+
+    wanted = {thumbnail_path(feature_dir, rel_path).name for rel_path in sources}
+    for old in thumbnail_dir(feature_dir).glob("*.jpg"):
+        if old.name not in wanted:
+            old.unlink(missing_ok=True)
+            report["removed"] += 1
+
+    todo = []
+    for rel_path in sources:
+        if is_fresh(thumbnail_path(feature_dir, rel_path), data_dir / rel_path):
+            report["unchanged"] += 1
+        else:
+            todo.append(rel_path)
+
+    work = bind(lambda rel_path: make_thumbnail(data_dir / rel_path, thumbnail_path(feature_dir, rel_path), side))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # Gửi từng đợt nhỏ để huỷ có hiệu lực nhanh
+        for start in range(0, len(todo), 4 * threads):
+            if cancel is not None and cancel.is_set():
+                break
+            for ok in pool.map(work, todo[start:start + 4 * threads]):
+                report["created" if ok else "errors"] += 1
+            if progress is not None:
+                progress(min(start + 4 * threads, len(todo)), len(todo))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tạo cache thumbnail cho các ảnh trong kho đặc trưng")
+    parser.add_argument("data_dir")
+    parser.add_argument("feature_dir")
+    parser.add_argument("--side", type=int, default=THUMBNAIL_SIDE, help="Cạnh dài của thumbnail (px)")
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    report = build_thumbnails(args.data_dir, args.feature_dir, side=args.side, threads=args.threads)
+    print(f"{report['total']} ảnh: tạo {report['created']}, giữ nguyên {report['unchanged']}, "
+          f"xoá {report['removed']} thumbnail cũ, {report['errors']} lỗi")
+
+
+if __name__ == "__main__":
+    main()
@@ -95,12 +95,13 @@ def display_search_results(query_image_path, result_image_paths, scores, data_di
     plt.show()
 
 # Các hàm benchmark 
+# (bộ benchmark đầy đủ trên dataset tổng hợp: src/benchmark.py)
 def benchmark_feature_extraction(extractor, image_path, n_runs=10):
     times = []
     for _ in range(n_runs):
-        start = time.time()
-        extractor.extract_from_path(image_path)
-        end = time.time()
+        start = time.perf_counter()
+        extractor.extract(extractor.preprocess(image_path))
+        end = time.perf_counter()
         times.append((end - start) * 1000)
     avg_time = np.mean(times)
     std_time = np.std(times)
@@ -112,9 +113,9 @@ def benchmark_feature_extraction(extractor, image_path, n_runs=10):
 def benchmark_matching(matcher, desc1, desc2, n_runs=10):
     times = []
     for _ in range(n_runs):
-        start = time.time()
-        matcher.match_features(desc1, desc2)
-        end = time.time()
+        start = time.perf_counter()
+        matcher.match(desc1, desc2)
+        end = time.perf_counter()
         times.append((end - start) * 1000)
     avg_time = np.mean(times)
     std_time = np.std(times)
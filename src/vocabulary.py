@@ -0,0 +1,295 @@
+"""
+Bag-of-Visual-Words: từ điển thị giác + inverted file TF-IDF
+
+- Vocabulary: huấn luyện k-means (phẳng) hoặc cây từ vựng phân cấp (hierarchical k-means)
+  trên descriptor SIFT của CSDL, rồi lượng tử hoá mỗi descriptor thành một "từ thị giác".
+- BowIndex: mỗi ảnh là một vector TF-IDF thưa; inverted file (ma trận thưa theo cột = từ)
+  cho phép chấm điểm truy vấn chỉ trên các danh sách posting của những từ xuất hiện trong truy vấn.
+
+Lưu trên đĩa trong feature_dir/bow/:
+    vocabulary.npz     - Tâm cụm (và cấu trúc cây nếu dùng phân cấp)
+    inverted_file.npz  - Ma trận ảnh x từ (TF-IDF, đã chuẩn hoá L2), dạng CSC
+    index.json         - Danh sách ảnh, IDF, dấu vân tay CSDL lúc build và cấu hình từ điển
+                         (thuật toán, cách mã hoá / file PCA, số từ - đổi thì huấn luyện lại từ điển)
+"""
+
+import json
+import math
+import numpy as np
+import scipy.sparse as sp
+from pathlib import Path
+from sklearn.cluster import MiniBatchKMeans
+
+BOW_DIR = "bow"
+VOCABULARY_NAME = "vocabulary.npz"
+INVERTED_FILE_NAME = "inverted_file.npz"
+INDEX_NAME = "index.json"
+# Đổi khi cách tính trọng số thay đổi -> inverted file cũ trên đĩa được dựng lại
+IDF_VERSION = 2
+
+
+def vocabulary_config(db, n_words):
+    """Những gì quyết định không gian descriptor của từ điển: khác đi thì tâm cụm cũ không dùng được"""
+    return {"algo": db.algo, "encoding": db.codec.encoding, "codec_file": db.codec.filename,
+            "n_words": n_words}
+
+
+def _nearest(descs, centers, chunk=4096):
+    # argmin khoảng cách L2 tới các tâm, tính theo khối để giới hạn bộ nhớ
+    centers = centers.astype(np.float32)
+    c_norm = (centers ** 2).sum(axis=1)
+    labels = np.empty(len(descs), dtype=np.int64)
+    for start in range(0, len(descs), chunk):
+        block = np.asarray(descs[start:start + chunk], dtype=np.float32)
+        dist = c_norm[None, :] - 2.0 * block @ centers.T
+        labels[start:start + chunk] = dist.argmin(axis=1)
+    return labels
+
+
+def _kmeans(descs, n_clusters, seed):
+    n_clusters = min(n_clusters, len(descs))
+    km = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, n_init=3,
+                         batch_size=max(1024, 3 * n_clusters))
+    km.fit(descs)
+    return km.cluster_centers_.astype(np.float32)
+
+
+class Vocabulary:
+    def __init__(self, centers, branching=None):
+        """
+        Args:
+            centers: từ vựng phẳng -> mảng (n_words, dim)
+                     cây phân cấp -> mảng (n_nodes_cuối, branching, dim) cho từng tầng (list)
+            branching: None nếu từ vựng phẳng, ngược lại là số nhánh của cây
+        """
+        self.centers = centers
+        self.branching = branching
+
+    @property
+    def dim(self):
+        return self.centers.shape[-1] if self.branching is None else self.centers[0].shape[-1]
+
+    @property
+    def n_words(self):
+        if self.branching is None:
+            return len(self.centers)
+        return self.branching ** len(self.centers)
+
+    @classmethod
+    def train(cls, descs, n_words=1000, branching=None, max_samples=200000, seed=0):
+        """
+        Huấn luyện từ điển từ một tập descriptor (lấy mẫu tối đa max_samples dòng).
+        branching=None: k-means phẳng n_words cụm.
+        branching=b: cây k-means b nhánh, độ sâu sao cho b^depth ~ n_words.
+        """
+        descs = np.asarray(descs, dtype=np.float32)
+        if len(descs) > max_samples:
+            rng = np.random.default_rng(seed)
+            descs = descs[rng.choice(len(descs), max_samples, replace=False)]
+
+        if branching is None:
+            return cls(_kmeans(descs, n_words, seed))
+
+        depth = max(1, int(round(math.log(n_words) / math.log(branching))))
+        levels = []
+        # Mỗi phần tử của groups là tập descriptor rơi vào một nút ở tầng hiện tại
+        groups = [descs]
+        for _ in range(depth):
+            level = np.empty((len(groups), branching, descs.shape[1]), dtype=np.float32)
+            next_groups = []
+            for node, group in enumerate(groups):
+                if len(group) == 0:
+                    level[node] = 0
+                    next_groups.extend([group] * branching)
+                    continue
+                centers = _kmeans(group, branching, seed)
+                # Nút có ít điểm hơn số nhánh: lặp lại tâm cuối (nhánh thừa không bao giờ được chọn)
+                if len(centers) < branching:
+                    pad = np.repeat(centers[-1:], branching - len(centers), axis=0)
+                    centers = np.vstack([centers, pad])
+                level[node] = centers
+                labels = _nearest(group, centers)
+                next_groups.extend(group[labels == b] for b in range(branching))
+            levels.append(level)
+            groups = next_groups
+        return cls(levels, branching=branching)
+
+    def quantize(self, descs):
+        """Chuyển descriptor thành id từ thị giác (mảng int64)"""
+        descs = np.asarray(descs, dtype=np.float32)
+        if self.branching is None:
+            return _nearest(descs, self.centers)
+
+        nodes = np.zeros(len(descs), dtype=np.int64)
+        for level in self.centers:
+            next_nodes = np.empty_like(nodes)
+            for node in np.unique(nodes):
+                mask = nodes == node
+                next_nodes[mask] = node * self.branching + _nearest(descs[mask], level[node])
+            nodes = next_nodes
+        return nodes
+
+    def save(self, path):
+        if self.branching is None:
+            np.savez(path, centers=self.centers)
+        else:
+            np.savez(path, branching=self.branching,
+                     **{f"level_{i}": level for i, level in enumerate(self.centers)})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if "centers" in data:
+                return cls(data["centers"])
+            n_levels = sum(1 for name in data.files if name.startswith("level_"))
+            levels = [data[f"level_{i}"] for i in range(n_levels)]
+            return cls(levels, branching=int(data["branching"]))
+
+
+class BowIndex:
+    def __init__(self, vocabulary, paths, idf, matrix, fingerprint=None, idf_version=IDF_VERSION,
+                 vocabulary_config=None):
+        self.vocabulary = vocabulary
+        # vocabulary_config() lúc huấn luyện từ điển (None với index cũ)
+        self.vocabulary_config = vocabulary_config
+        self.paths = paths
+        self.idf = idf
+        self.idf_version = idf_version
+        # Ma trận ảnh x từ, CSC -> mỗi cột là danh sách posting của một từ
+        self.matrix = matrix
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def build(cls, vocabulary, items, fingerprint=None, vocabulary_config=None):
+        """Lượng tử hoá từng ảnh trong items = [(đường dẫn, descriptors), ...] và dựng inverted file"""
+        n_words = vocabulary.n_words
+        rows, cols, vals = [], [], []
+        for image_id, (_, descs) in enumerate(items):
+            words, counts = np.unique(vocabulary.quantize(descs), return_counts=True)
+            rows.append(np.full(len(words), image_id, dtype=np.int64))
+            cols.append(words)
+            vals.append(counts / counts.sum())
+
+        n_images = len(items)
+        if n_images == 0:
+            matrix = sp.csc_matrix((0, n_words), dtype=np.float32)
+            return cls(vocabulary, [], np.zeros(n_words, dtype=np.float32), matrix, fingerprint,
+                       vocabulary_config=vocabulary_config)
+
+        tf = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                           shape=(n_images, n_words), dtype=np.float32)
+        df = np.bincount(tf.indices, minlength=n_words)
+        # IDF làm trơn: luôn > 0, kể cả từ xuất hiện trong mọi ảnh hoặc CSDL chỉ có 1 ảnh
+        # (log(N / df) = 0 khiến mọi trọng số bằng 0 trên CSDL nhỏ)
+        idf = (np.log((1 + n_images) / (1 + df)) + 1).astype(np.float32)
+
+        tfidf = tf.multiply(idf[None, :]).tocsr()
+        norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1)).ravel())
+        tfidf = sp.diags(1.0 / np.maximum(norms, 1e-12)) @ tfidf
+        matrix = sp.csc_matrix(tfidf, dtype=np.float32)
+
+        paths = [path for path, _ in items]
+        return cls(vocabulary, paths, idf, matrix, fingerprint, vocabulary_config=vocabulary_config)
+
+    def query(self, query_desc, shortlist=50):
+        """
+        Trả về (chỉ số ảnh, điểm cosine) của tối đa `shortlist` ứng viên tốt nhất.
+        Chỉ duyệt posting của các từ có trong truy vấn.
+        """
+        if query_desc is None or len(query_desc) == 0 or len(self) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        words, counts = np.unique(self.vocabulary.quantize(query_desc), return_counts=True)
+        weights = (counts / counts.sum()) * self.idf[words]
+        norm = np.linalg.norm(weights)
+        if norm == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        weights = (weights / norm).astype(np.float32)
+
+        scores = np.asarray(self.matrix[:, words] @ weights).ravel()
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > shortlist:
+            top = np.argpartition(-scores[candidates], shortlist - 1)[:shortlist]
+            candidates = candidates[top]
+        order = np.argsort(-scores[candidates], kind='stable')
+        candidates = candidates[order]
+        return candidates, scores[candidates]
+
+    def save(self, bow_dir):
+        bow_dir = Path(bow_dir)
+        bow_dir.mkdir(parents=True, exist_ok=True)
+        self.vocabulary.save(bow_dir / VOCABULARY_NAME)
+        sp.save_npz(bow_dir / INVERTED_FILE_NAME, self.matrix)
+        with open(bow_dir / INDEX_NAME, 'w', encoding='utf-8') as f:
+            json.dump({"paths": self.paths, "idf": self.idf.tolist(),
+                       "fingerprint": self.fingerprint, "idf_version": self.idf_version,
+                       "vocabulary_config": self.vocabulary_config}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, bow_dir):
+        bow_dir = Path(bow_dir)
+        vocabulary = Vocabulary.load(bow_dir / VOCABULARY_NAME)
+        matrix = sp.load_npz(bow_dir / INVERTED_FILE_NAME).tocsc()
+        with open(bow_dir / INDEX_NAME, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return cls(vocabulary, meta["paths"], np.asarray(meta["idf"], dtype=np.float32),
+                   matrix, meta.get("fingerprint"), meta.get("idf_version", 1), meta.get("vocabulary_config"))
+
+
+def build_bow_index(db, n_words=1000, branching=None, vocabulary=None, save=True):
+    """
+    Dựng BowIndex cho một FeatureDatabase đã nạp. Nếu không truyền vocabulary thì huấn luyện mới
+    (vocabulary truyền vào phải được huấn luyện trên kho cùng vocabulary_config(db, n_words)).
+    Kết quả được lưu vào feature_dir/bow/ để các tiến trình sau dùng lại.
+    """
+    items = db.items()
+    if vocabulary is None:
+        if not items:
+            raise ValueError("CSDL rỗng, không thể huấn luyện từ điển thị giác")
+        all_descs = np.vstack([descs for _, descs in items])
+        print(f"Đang huấn luyện từ điển {n_words} từ trên {len(all_descs)} descriptor...")
+        vocabulary = Vocabulary.train(all_descs, n_words=n_words, branching=branching)
+
+    index = BowIndex.build(vocabulary, items, fingerprint=db.fingerprint(),
+                           vocabulary_config=vocabulary_config(db, n_words))
+    if save:
+        index.save(db.feature_dir / BOW_DIR)
+    return index
+
+
+def load_or_build_bow_index(db, n_words=1000, branching=None):
+    """
+    Nạp BowIndex từ đĩa nếu còn khớp với CSDL; nếu CSDL đã đổi thì dựng lại inverted file
+    với từ điển cũ; nếu chưa có từ điển, hoặc thuật toán / cách mã hoá / file PCA / số từ đã đổi
+    (descriptor nằm trong không gian khác, dù có thể cùng số chiều) thì huấn luyện mới.
+    """
+    bow_dir = db.feature_dir / BOW_DIR
+    vocabulary = None
+    if (bow_dir / INDEX_NAME).exists():
+        index = BowIndex.load(bow_dir)
+        if index.vocabulary_config != vocabulary_config(db, n_words):
+            print("Cấu hình descriptor / số từ đã thay đổi, huấn luyện lại từ điển...")
+        elif index.fingerprint == db.fingerprint() and index.idf_version == IDF_VERSION:
+            return index
+        else:
+            vocabulary = index.vocabulary
+            print("CSDL đã thay đổi, đang dựng lại inverted file...")
+    return build_bow_index(db, n_words=n_words, branching=branching, vocabulary=vocabulary)
+
+
+if __name__ == "__main__":
+    import sys
+    from feature_database import FeatureDatabase
+
+    if len(sys.argv) < 2:
+        print("Cách dùng: python vocabulary.py <feature_dir> [n_words] [branching]")
+    else:
+        database = FeatureDatabase(sys.argv[1])
+        database.refresh()
+        build_bow_index(database,
+                        n_words=int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+                        branching=int(sys.argv[3]) if len(sys.argv) > 3 else None)
+        print(" Đã lưu BoW index vào", database.feature_dir / BOW_DIR)
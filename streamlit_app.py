@@ -2,7 +2,9 @@
 Giao diện Web App cho hệ thống tìm kiếm ảnh tương tự (Final Fix)
 """
 
+import os
 import sys
+import urllib.error
 from pathlib import Path
 import streamlit as st
 from PIL import Image
@@ -12,10 +14,12 @@ import numpy as np
 # Thêm thư mục src vào path
 sys.path.append(str(Path(__file__).parent / 'src'))
 
-from feature_extraction import FeatureExtractor
-from image_matching import ImageMatcher
-from preprocessing import preprocess_image
+from feature_extraction import BINARY_ALGOS, FeatureExtractor
 from utils import count_files_in_directory
+from feature_store import count_indexed_images
+from search_service import SearchClient
+from index_jobs import current_job, start_job
+from thumbnails import get_thumbnail
 
 # Cấu hình trang
 st.set_page_config(
@@ -51,11 +55,19 @@ st.markdown("---")
 # Cấu hình
 DATA_DIR = "data"
 FEATURES_DIR = "features"
+SEARCH_SERVICE_URL = os.environ.get("SEARCH_SERVICE_URL", "http://127.0.0.1:8765")
 
 # Tạo thư mục
 Path(DATA_DIR).mkdir(exist_ok=True)
 Path(FEATURES_DIR).mkdir(exist_ok=True)
 
+@st.cache_resource
+def get_client():
+    # Tìm kiếm chạy trong dịch vụ nền (src/search_service.py) giữ CSDL "nóng" cho mọi phiên;
+    # Web App chỉ gửi ảnh và hiển thị kết quả
+    return SearchClient(SEARCH_SERVICE_URL)
+
+
 # Sidebar - Settings
 with st.sidebar:
     st.header(" Cài đặt")
@@ -63,39 +75,135 @@ with st.sidebar:
     # Algo selection
     algo_choice = st.radio(
         "Phương pháp trích xuất:",
-        ["SIFT"]
+        ["SIFT", "ORB"],
+        help="ORB: descriptor nhị phân so khớp bằng khoảng cách Hamming - trích xuất / tìm kiếm nhanh hơn, "
+             "kho nhỏ hơn nhiều, nhưng kém bền với thay đổi tỉ lệ / góc nhìn hơn SIFT"
     )
     
     # Matcher selection
     matcher_type = st.radio(
         "Phương pháp so khớp:",
-        ["BF", "FLANN"],
+        ["BF", "FLANN", "NUMPY"],
+        index=0,
+        help="BF: Brute Force (Chính xác nhất) | NUMPY: kết quả như BF, so khớp cả loạt ảnh một lần (nhanh hơn)"
+    )
+    
+    # Chế độ tìm kiếm
+    search_mode = st.radio(
+        "Chế độ tìm kiếm:",
+        ["scan", "global", "bow", "prune", "stream", "coarse"],
         index=0,
-        help="BF: Brute Force (Chính xác nhất)"
+        help="scan: so khớp lần lượt từng ảnh | global: một chỉ mục kNN chung cho cả CSDL (nhanh hơn) | "
+             "bow: lọc ứng viên bằng từ điển thị giác TF-IDF rồi mới so khớp (dataset lớn) | "
+             "prune: như scan, bỏ dở các ảnh không thể lọt top-N (BF / NUMPY) | "
+             "stream: như scan, đọc kho theo khối thay vì nạp cả CSDL vào RAM | "
+             "coarse: lọc bằng tập descriptor thô rồi chỉ so khớp đầy đủ phần ảnh tốt nhất "
+             "(cần index với tập thô)"
+    )
+    
+    # Kiểm chứng hình học
+    use_verify = st.checkbox(
+        "Kiểm chứng hình học (RANSAC)", value=False,
+        help="Xếp hạng lại các ứng viên tốt nhất theo số inlier của homography - chính xác hơn số match thô"
     )
     
     # Top-N
     top_n = st.slider("Số kết quả hiển thị:", 1, 20, 5)
+
+    use_profile = st.checkbox("Chạy kèm cProfile", value=False,
+                              help="Ghi lại các hàm tốn thời gian nhất của lần tìm kiếm (chậm hơn một chút)")
     
     st.markdown("---")
     
     # Dataset info
     n_images = count_files_in_directory(DATA_DIR)
-    n_features = len(list(Path(FEATURES_DIR).glob('*.csv')))
+    n_features = count_indexed_images(FEATURES_DIR)
     
     st.metric("Số ảnh trong dataset", n_images)
     st.metric("Số features đã trích xuất", n_features)
+
+    try:
+        health = get_client().health()
+        st.caption(f"Dịch vụ tìm kiếm: {health['n_images']} ảnh trong CSDL, {health['pending']} truy vấn đang xử lý")
+    except urllib.error.URLError:
+        st.caption(f"Dịch vụ tìm kiếm chưa chạy ({SEARCH_SERVICE_URL})")
     
-    if st.button(" Trích xuất Features từ Dataset"):
+    encoding = st.selectbox(
+        "Mã hoá descriptor khi trích xuất:",
+        ["float32", "uint8", "pca64", "pca32"],
+        index=0,
+        help="uint8: không mất thông tin, nhỏ hơn 4 lần | pca64/pca32: chiếu PCA, lưu float16 (nhỏ hơn 4-8 lần) | "
+             "ORB luôn lưu dạng bit nhị phân"
+    )
+
+    max_side = st.number_input("Cạnh dài tối đa (px, 0 = giữ nguyên):", 0, 8192, 1024, step=128,
+                               help="Thu nhỏ ảnh trước khi lọc nhiễu / CLAHE / SIFT - nhanh hơn nhiều với ảnh lớn")
+    max_keypoints = st.number_input("Số keypoint tối đa mỗi ảnh (0 = không giới hạn):", 0, 20000, 2000,
+                                    step=500, help="Chỉ giữ các keypoint có response mạnh nhất")
+    coarse_keypoints = st.number_input("Tập descriptor thô (0 = tắt):", 0, 512, 0, step=16,
+                                       help="Số keypoint mạnh nhất mỗi ảnh dùng cho chế độ tìm kiếm coarse")
+
+    full_rebuild = st.checkbox("Build lại toàn bộ", value=False,
+                               help="Mặc định chỉ trích xuất ảnh mới/đã sửa và xoá đặc trưng của ảnh đã bị xoá")
+    skip_duplicates = st.checkbox("Bỏ qua ảnh trùng", value=False,
+                                  help="Không trích xuất ảnh gần trùng (pHash) với một ảnh đã có trong kho")
+
+    job = current_job(FEATURES_DIR)
+    if st.button(" Trích xuất Features từ Dataset", disabled=job is not None and job.running):
         if n_images == 0:
             st.error("Không có ảnh trong dataset!")
         else:
-            with st.spinner(" Đang trích xuất features..."):
-                extractor = FeatureExtractor(algo=algo_choice)
-                extractor.process_dataset(DATA_DIR, FEATURES_DIR)
-                st.success(f" Đã trích xuất features từ {n_images} ảnh!")
+            # Index chạy nền: giao diện không bị chặn, vẫn tìm kiếm được trên kho cũ cho tới khi xong
+            extractor = FeatureExtractor(algo=algo_choice,
+                                         encoding='binary' if algo_choice in BINARY_ALGOS else encoding,
+                                         max_side=int(max_side) or None,
+                                         max_keypoints=int(max_keypoints) or None,
+                                         coarse_keypoints=int(coarse_keypoints) or None)
+            try:
+                start_job(extractor, DATA_DIR, FEATURES_DIR, workers=None, incremental=not full_rebuild,
+                          skip_duplicates=skip_duplicates)
+            except RuntimeError as e:
+                st.warning(f" {e}")
+            else:
                 st.rerun()
 
+    def show_index_job():
+        job = current_job(FEATURES_DIR)
+        if job is None:
+            return
+        status = job.status()
+        if job.running:
+            phase = "Trích xuất features" if status["phase"] == "extract" else "Tạo thumbnail"
+            st.progress(status["done"] / max(status["total"], 1),
+                        text=f" {phase}: {status['done']}/{status['total']} ảnh ({status['elapsed']:.0f} s)")
+            if st.button(" Huỷ index", key=f"cancel-{status['id']}"):
+                job.cancel()
+            return
+        if st.session_state.get("index_job_seen") != status["id"]:
+            # Job vừa kết thúc: chạy lại cả trang để cập nhật số features đã trích xuất
+            st.session_state.index_job_seen = status["id"]
+            st.rerun()
+        report = status["report"]
+        if status["state"] == "cancelled":
+            st.info(" Đã huỷ index, kho đặc trưng giữ nguyên phiên bản trước.")
+        elif status["state"] == "failed":
+            st.error(f" Index lỗi: {status['error']}")
+        elif report is not None:
+            st.success(f" Đã trích xuất features từ {report['indexed']} ảnh "
+                       f"({report['unchanged']} không đổi, {report['removed']} đã xoá) "
+                       f"trong {status['elapsed']:.0f} s!")
+            if report["duplicates"]:
+                st.info(f" Bỏ qua {len(report['duplicates'])} ảnh trùng: " +
+                        ", ".join(f"{path} = {original}" for path, original in report["duplicates"][:10]))
+            if report["errors"]:
+                st.warning(f" {len(report['errors'])} ảnh lỗi: " +
+                           ", ".join(path for path, _ in report["errors"][:10]))
+
+    # Streamlit >= 1.37: chỉ phần tiến độ được vẽ lại mỗi giây; bản cũ hơn cập nhật khi trang chạy lại
+    if hasattr(st, "fragment"):
+        show_index_job = st.fragment(run_every=1.0)(show_index_job)
+    show_index_job()
+
 # Main content
 col1, col2 = st.columns([1, 2])
 
@@ -113,31 +221,34 @@ with col1:
             if n_features == 0:
                 st.error(" Chưa có features! Hãy nhấn nút 'Trích xuất Features' bên trái.")
             else:
-                temp_path = Path("temp_query.jpg")
-                with open(temp_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                
                 try:
                     with st.spinner(" Đang xử lý..."):
-                        # 1. Khởi tạo extractor
-                        extractor = FeatureExtractor(algo=algo_choice)
-                        
-                        # 2. Tiền xử lý & Trích xuất query
-                        processed_query = preprocess_image(str(temp_path))
-                        kps, query_desc = extractor.extract(processed_query)
-                        
-                        if query_desc is None:
+                        # Gửi thẳng bytes ảnh tải lên, không cần ghi file tạm.
+                        # Dịch vụ lo tiền xử lý, trích xuất, so khớp (theo lô) và cache kết quả
+                        found = get_client().search(
+                            uploaded_file.getvalue(), top_n=top_n, method=matcher_type,
+                            mode=search_mode, verify='homography' if use_verify else None,
+                            profile=use_profile)
+
+                        if found["results"] is None:
                             st.error(" Ảnh quá mờ hoặc không có chi tiết đặc trưng.")
                         else:
-                            # 3. Tìm kiếm
-                            matcher = ImageMatcher(method=matcher_type)
-                            results = matcher.search(query_desc, FEATURES_DIR, top_n=top_n)
-                            
-                            st.session_state.results = results
-                            st.session_state.query_kp_count = len(kps)
-                    
-                    if temp_path.exists(): temp_path.unlink()
-                        
+                            st.session_state.results = found["results"]
+                            st.session_state.query_kp_count = found["query_kp_count"]
+                            st.session_state.score_unit = "inliers" if use_verify else "matches"
+                            st.session_state.prefilter = found.get("prefilter")
+                            if found["cached"]:
+                                st.toast("Kết quả lấy từ cache")
+                            if found.get("prefilter"):
+                                # Ảnh gần trùng một ảnh trong kho: không có điểm SIFT, chỉ có khoảng cách pHash
+                                st.toast("Ảnh gần trùng một ảnh đã có trong kho (pHash), bỏ qua so khớp SIFT")
+                    if found["stats"] is not None:
+                        st.session_state.stats = (found["stats"], found["profile"])
+
+                except urllib.error.URLError:
+                    # Dịch vụ chưa chạy
+                    st.error(f" Không kết nối được dịch vụ tìm kiếm tại {SEARCH_SERVICE_URL}. Hãy chạy: "
+                             f"`python src/search_service.py --feature-dir {FEATURES_DIR}`")
                 except Exception as e:
                     st.error(f" Lỗi: {e}")
 
@@ -159,27 +270,46 @@ with col2:
                 with st.container():
                     r_col1, r_col2 = st.columns([1, 2])
                     with r_col1:
-                        result_img = Image.open(full_path)
-                        st.image(result_img, width="stretch")
+                        # Thumbnail dựng sẵn khi index (tạo ngay nếu thiếu), không mở ảnh gốc đầy đủ
+                        thumb = get_thumbnail(DATA_DIR, FEATURES_DIR, img_rel_path)
+                        st.image(str(thumb or full_path), width="stretch")
                     with r_col2:
                         st.markdown(f"### #{idx}")
                         st.markdown(f"**File:** `{full_path.name}`")
                         
-                        # Đánh giá độ tin cậy dựa trên score SIFT
-                        if score < 10:
-                            quality = " Rất thấp (Nhiễu)"
-                        elif score < 30:
-                            quality = " Trung bình"
+                        prefilter = st.session_state.get("prefilter")
+                        if prefilter:
+                            # Kết quả từ pHash: không áp ngưỡng chất lượng của điểm SIFT
+                            distance = prefilter["distances"][idx - 1]
+                            st.markdown(f"**Gần trùng (pHash):** {distance}/128 bit khác")
                         else:
-                            quality = " Cao (Rất giống)"
-                            
-                        st.markdown(f"**Score:** {score} matches ({quality})")
-                        st.progress(min(score / 100, 1.0))
+                            # Đánh giá độ tin cậy dựa trên score SIFT
+                            if score < 10:
+                                quality = " Rất thấp (Nhiễu)"
+                            elif score < 30:
+                                quality = " Trung bình"
+                            else:
+                                quality = " Cao (Rất giống)"
+
+                            unit = st.session_state.get("score_unit", "matches")
+                            st.markdown(f"**Score:** {score} {unit} ({quality})")
+                            st.progress(min(score / 100, 1.0))
                     st.markdown("---")
             else:
                 st.warning(f"Không tìm thấy file: {img_rel_path}")
     else:
         st.info("Chọn ảnh và nhấn 'Tìm kiếm' để xem kết quả")
+# Hiệu năng của lần tìm kiếm gần nhất
+if 'stats' in st.session_state:
+    stats_dict, profile_text = st.session_state.stats
+    with st.sidebar:
+        with st.expander(" Hiệu năng truy vấn gần nhất", expanded=False):
+            st.table([{"Giai đoạn": name, "Tổng (ms)": round(v["seconds"] * 1000, 2), "Số lần": v["calls"]}
+                      for name, v in stats_dict["stages"].items()])
+            st.table([{"Bộ đếm": name, "Giá trị": n} for name, n in stats_dict["counters"].items()])
+            if profile_text:
+                st.code(profile_text)
+
 # Footer
 st.markdown("---")
 st.markdown(
@@ -0,0 +1,106 @@
+"""
+Kiểm tra tính nhất quán của tìm kiếm trên dataset tổng hợp (benchmark.make_synthetic_dataset):
+- các mode / method chính xác (scan, prune, stream, NUMPY) trả về cùng kết quả
+- kho sau cập nhật tăng dần giống kho dựng lại từ đầu (cùng ảnh, cùng descriptor, cùng kết quả)
+
+Chạy: python -m pytest -q tests
+"""
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent / 'src'))
+
+from benchmark import make_synthetic_dataset
+from feature_extraction import FeatureExtractor
+from feature_store import FeatureStore
+from image_matching import ImageMatcher
+
+TOP_N = 5
+# (method, mode) cho kết quả chính xác -> phải giống hệt nhau
+EXACT_CONFIGS = [('BF', 'scan'), ('BF', 'prune'), ('BF', 'stream'), ('NUMPY', 'scan')]
+
+
+def quiet(done, total):
+    pass
+
+
+def search_all(feature_dir, query_descs, method, mode):
+    matcher = ImageMatcher(method=method, mode=mode)
+    db = feature_dir if mode == 'stream' else matcher.get_database(feature_dir)
+    return matcher.search_many(query_descs, db, top_n=TOP_N)
+
+
+def store_contents(feature_dir):
+    return {path: np.array(descs) for path, descs in FeatureStore(feature_dir)}
+
+
+class SearchConsistencyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = Path(tempfile.mkdtemp())
+        cls.data_dir, cls.queries = make_synthetic_dataset(cls.tmp / "dataset", n_images=40, n_queries=6,
+                                                           size=(200, 150), seed=3)
+        cls.extractor = FeatureExtractor()
+        cls.query_descs = [cls.extractor.extract(cls.extractor.preprocess(str(q)))[1] for q, _ in cls.queries]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def build(self, data_dir, feature_dir, incremental=False):
+        return self.extractor.process_dataset(data_dir, feature_dir, incremental=incremental, progress=quiet)
+
+    def assert_modes_agree(self, feature_dir):
+        expected = search_all(feature_dir, self.query_descs, *EXACT_CONFIGS[0])
+        for method, mode in EXACT_CONFIGS[1:]:
+            with self.subTest(method=method, mode=mode):
+                self.assertEqual(search_all(feature_dir, self.query_descs, method, mode), expected)
+        return expected
+
+    def test_exact_modes_agree(self):
+        feature_dir = self.tmp / "features"
+        self.build(self.data_dir, feature_dir)
+        results = self.assert_modes_agree(feature_dir)
+        # Ảnh gốc của truy vấn phải đứng đầu
+        for (_, truth), hits in zip(self.queries, results):
+            self.assertTrue(hits)
+            self.assertEqual(hits[0][0], truth)
+
+    def test_incremental_update_matches_full_rebuild(self):
+        data_dir = self.tmp / "data_incremental"
+        shutil.copytree(self.data_dir, data_dir)
+        incremental_dir = self.tmp / "features_incremental"
+        self.build(data_dir, incremental_dir)
+
+        # Sửa một ảnh thành bản sao của ảnh khác (hai ảnh cùng điểm, ảnh sửa bị đẩy xuống cuối kho),
+        # xoá một ảnh, thêm một ảnh mới
+        shutil.copy(data_dir / "group03" / "img000013.jpg", data_dir / "group01" / "img000001.jpg")
+        (data_dir / "group02" / "img000002.jpg").unlink()
+        shutil.copy(data_dir / "group04" / "img000004.jpg", data_dir / "group04" / "new.jpg")
+        report = self.build(data_dir, incremental_dir, incremental=True)
+        self.assertEqual((report["indexed"], report["removed"]), (2, 1))
+
+        full_dir = self.tmp / "features_full"
+        self.build(data_dir, full_dir)
+
+        incremental, full = store_contents(incremental_dir), store_contents(full_dir)
+        self.assertEqual(sorted(incremental), sorted(full))
+        for path in full:
+            np.testing.assert_array_equal(incremental[path], full[path], err_msg=path)
+
+        query_descs = self.query_descs + [
+            self.extractor.extract(self.extractor.preprocess(str(data_dir / "group01" / "img000001.jpg")))[1]]
+        for method, mode in EXACT_CONFIGS:
+            with self.subTest(method=method, mode=mode):
+                self.assertEqual(search_all(incremental_dir, query_descs, method, mode),
+                                 search_all(full_dir, query_descs, method, mode))
+        self.assert_modes_agree(incremental_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()